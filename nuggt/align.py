@@ -5,25 +5,30 @@
 
 import argparse
 from copy import deepcopy
+import functools
 import logging
 import json
 import multiprocessing
-from mp_shared_memory import SharedMemory
 import neuroglancer
 import numpy as np
 import os
 from scipy.ndimage import map_coordinates
 import sys
-import tifffile
+import threading
 import time
 import tqdm
 import webbrowser
 import re
 
-from .utils.warp import Warper
+from .utils.warp import IncrementalWarper
+from .utils.warp_pool import WarpPool
+from .utils.coordinate_mapping import CoordinateMapping
 from .utils.ngutils import layer, seglayer, pointlayer
 from .utils.ngutils import red_shader, gray_shader, green_shader
 from .utils.ngutils import soft_max_brightness
+from .utils.histogram import ImageHistogram
+from .utils.tiff_volume import read_tiff, TiffVolume
+from .alignment_residuals import residual_colors
 from precomputed_tif.client import ArrayReader
 
 # Monkey-patch neuroglancer.PointAnnotationLayer to have a color
@@ -162,6 +167,22 @@ def parse_args():
     
     return parser.parse_args()
 
+def preview_dimensions(voxel_size, factor):
+    """The coordinate space of a preview of the alignment image
+
+    :param voxel_size: the size of a voxel of the reference image, in x, y,
+    z order
+    :param factor: the preview has every factor'th voxel of the reference
+    space in each direction.
+    :returns: a neuroglancer.CoordinateSpace that puts the preview's voxels
+    where they belong in the reference space
+    """
+    return neuroglancer.CoordinateSpace(
+        names=["x", "y", "z"],
+        units=["µm", "µm", "µm"],
+        scales=[factor * _ for _ in voxel_size])
+
+
 class ViewerPair:
     """The viewer pair maintains two neuroglancer viewers
 
@@ -195,6 +216,7 @@ class ViewerPair:
     IMAGE = "image"
     EDIT = "edit"
     SEGMENTATION = "segmentation"
+    RESIDUALS = "residuals"
 
     ANNOTATE_ACTION = "annotate"
     
@@ -216,10 +238,32 @@ class ViewerPair:
     REFRESH_ACTION = "refresh-view"
     
     REDO_ACTION = "redo"
+    RESIDUALS_ACTION = "residuals"
     SAVE_ACTION = "save-points"
     TRANSLATE_ACTION = "translate-point"
     UNDO_ACTION = "undo"
     WARP_ACTION = "warp"
+
+    #
+    # The warp action first shows the alignment at one of these fractions
+    # of full resolution - the finest one with at most PREVIEW_MAX_VOXELS
+    # voxels - and then refines it in the background.
+    #
+    PREVIEW_FACTORS = (4, 8)
+    PREVIEW_MAX_VOXELS = 2 ** 21
+    #
+    # The full-resolution alignment is refreshed in the viewer each time
+    # this fraction of its planes are done.
+    #
+    REFINE_UPDATE_FRACTION = .1
+    #
+    # After the first full-resolution warp, later warps only rewarp the
+    # parts of the alignment whose warped coordinates moved by more than
+    # DELTA_WARP_THRESHOLD voxels of the moving image, as long as those
+    # parts are at most DELTA_WARP_MAX_FRACTION of the volume.
+    #
+    DELTA_WARP_THRESHOLD = .5
+    DELTA_WARP_MAX_FRACTION = .5
     
 
     BRIGHTER_KEY = "shift+equal" 
@@ -239,6 +283,7 @@ class ViewerPair:
     REFRESH_KEY = "shift+keyr"
     SAVE_KEY = "shift+keys"
     REDO_KEY = "control+keyy"
+    RESIDUALS_KEY = "shift+keyo"
     TRANSLATE_KEY = "shift+keyt"
     UNDO_KEY = "control+keyz"
     WARP_KEY = "shift+keyw"
@@ -268,14 +313,6 @@ void main() {
   emitGrayscale(toNormalized(getDataValue()));
 }
 """
-    #
-    # For multiprocessing - dictionaries keyed on id(self)
-    #
-    moving_images = {}
-    original_images = {}
-    warpers = {}
-    alignment_buffers = {}
-
     def __init__(self, reference_image, moving_image, segmentation,
                  points_file, reference_voxel_size, moving_voxel_size,
                  n_workers=multiprocessing.cpu_count(), min_distance=1.0,
@@ -299,23 +336,31 @@ void main() {
         self.flip_x= flip_x
         self.flip_y = flip_y
         self.flip_z = flip_z
+        self.x_index = x_index
+        self.y_index = y_index
+        self.z_index = z_index
+        self.z_y_x_voxel = z_y_x_voxel
+        self._original_mapping = None
 
         self.moving_image = moving_image
         self.original_image=original_image
         self.segmentation = segmentation
         self.n_workers = n_workers
-        self.moving_images[id(self)] = moving_image
-        self.original_images[id(self)] = original_image
         self.decimation = max(1, np.min(reference_image.shape) // 5)
-        self.alignment_buffers[id(self)] =\
-            SharedMemory(reference_image.shape,
-                         reference_image.dtype)
+        self.warp_pool = WarpPool(moving_image, reference_image.shape,
+                                  np.float32, n_workers)
         self.reference_viewer = neuroglancer.Viewer()
         self.moving_viewer = neuroglancer.Viewer()
         self.original_viewer = neuroglancer.Viewer()
         self.points_file = points_file
         self.points_file_original = points_file_original
         self.warper = None
+        self.warp_lock = threading.Lock()
+        self.warp_generation = 0
+        self.refinement_thread = None
+        self.preview_image = None
+        self.alignment_volume = None
+        self.aligned_coefficients = None
         self.reference_voxel_size = reference_voxel_size
         self.moving_voxel_size = moving_voxel_size
         self.original_voxel_size=original_voxel_size
@@ -323,23 +368,23 @@ void main() {
         self.reference_brightness = 1.0
         self.moving_brightness = 1.0
         self.original_brightness=1.0
+        self.histograms = {}
         self.min_distance = min_distance
         self.load_points()
         self.load_points_original()
+        #
+        # The exact warp from the reference to the moving space, updated
+        # as points are added and removed.
+        #
+        self.incremental_warper = IncrementalWarper(
+            np.reshape(self.reference_pts, (-1, 3)),
+            np.reshape(self.moving_pts, (-1, 3)))
         self.init_state()
         self.refresh_brightness()
-        
-      
-        self.x_index=x_index
-        self.y_index=y_index
-        self.z_index=z_index
-        
-        self.z_y_x_voxel= z_y_x_voxel
-        
+
     @property
     def alignment_image(self):
-        with self.alignment_buffers[id(self)].txn() as memory:
-            return memory
+        return self.warp_pool.alignment_image
 
     def load_points(self):
         """Load reference/moving points from the points file"""
@@ -359,8 +404,9 @@ void main() {
         args=parse_args()
         if args.original_image!="":
             if not os.path.exists(self.points_file_original):
-                self.reference_pts = []
-                self.original_pts = []
+                self.original_pts = \
+                    self.original_mapping.moving_to_original(
+                        np.reshape(self.moving_pts, (-1, 3))).tolist()
 
             else:
                 with open(self.points_file_original, "r") as fd:
@@ -444,6 +490,7 @@ void main() {
         viewer.actions.add(self.REFRESH_ACTION, self.on_refresh)
         viewer.actions.add(self.SAVE_ACTION, self.on_save)
         viewer.actions.add(self.REDO_ACTION, self.on_redo)
+        viewer.actions.add(self.RESIDUALS_ACTION, self.on_residuals)
         viewer.actions.add(self.UNDO_ACTION, self.on_undo)
         viewer.actions.add(self.WARP_ACTION, self.on_warp)
         
@@ -471,6 +518,7 @@ void main() {
             bindings_viewer[self.REFRESH_KEY] = self.REFRESH_ACTION
             bindings_viewer[self.SAVE_KEY] = self.SAVE_ACTION
             bindings_viewer[self.REDO_KEY] = self.REDO_ACTION
+            bindings_viewer[self.RESIDUALS_KEY] = self.RESIDUALS_ACTION
             bindings_viewer[self.UNDO_KEY] = self.UNDO_ACTION
             bindings_viewer[self.WARP_KEY] = self.WARP_ACTION
             if viewer == self.reference_viewer:
@@ -518,61 +566,19 @@ void main() {
             with viewer.config_state.txn() as cs:
                 cs.status_messages[kind] = msg
 
-    def factor(self):
-        ar = ArrayReader(self.original_image)
-        self.shape_zs_ys_xs= self.moving_image.shape
-        self.z_voxel= self.z_y_x_voxel[self.z_index]
-        self.y_voxel= self.z_y_x_voxel[self.y_index]
-        self.x_voxel= self.z_y_x_voxel[self.x_index]
-        self.original_zo_yo_xo = [ar.shape[self.z_index]*self.z_voxel, ar.shape[self.y_index]*self.y_voxel,ar.shape[self.x_index]*self.x_voxel]
-        self.original_zo_yo_xo_1 = [ar.shape[self.z_index], ar.shape[self.y_index],ar.shape[self.x_index]]
-        
-        self.factor_z = self.original_zo_yo_xo[self.z_index]/self.shape_zs_ys_xs[self.z_index]
-        self.factor_y = self.original_zo_yo_xo[self.y_index]/self.shape_zs_ys_xs[self.y_index]
-        self.factor_x = self.original_zo_yo_xo[self.x_index]/self.shape_zs_ys_xs[self.x_index]
-        
-        
-    def moving_to_original(self):
-        self.factor()
-        if self.flip_z:
-            orig_z = (self.shape_zs_ys_xs[self.z_index] - self.mp[self.z_index]) * self.factor_z
-        else:
-            orig_z =  (self.mp[self.z_index] * self.factor_z)
-        if self.flip_y:
-            orig_y = (self.shape_zs_ys_xs[self.y_index] - self.mp[self.y_index]) * self.factor_y
-        else:
-            orig_y = (self.mp[self.y_index] * self.factor_y)
-
-        if self.flip_x:
-            orig_x = (self.shape_zs_ys_xs[self.x_index] - self.mp[self.x_index]) * self.factor_x
-        else:
-            orig_x = (self.mp[self.x_index] * self.factor_x)
-            
-        return orig_z, orig_y, orig_x
-    
-    def original_to_moving(self):
-        self.factor()
-        self.flip= [self.flip_z, self.flip_y,self.flip_x]
-        self.factors=[self.factor_z, self.factor_y ,self.factor_x]
-        
-        if self.flip[self.x_index]:
-            mov_x= -((self.op[self.x_index]/self.factors[self.x_index])-self.shape_zs_ys_xs[2]) 
-        else:
-            mov_x = (self.op[self.x_index]/self.factors[self.x_index])  
-        
-        if self.flip[self.y_index]:
-            mov_y= -((self.op[self.y_index]/self.factors[self.y_index])-self.shape_zs_ys_xs[1])
-        else:
-            mov_y = (self.op[self.y_index]/self.factors[self.y_index])
-            
-        if self.flip[self.z_index]:
-             mov_z= -((self.op[self.z_index]/self.factors[self.z_index])-self.shape_zs_ys_xs[0])
-        else:
-            mov_z = (self.op[self.z_index]/self.factors[self.z_index])
-            
-        return mov_z, mov_y , mov_x
-     
+    @property
+    def original_mapping(self):
+        """The mapping between moving and original image coordinates
 
+        The original image's metadata is read the first time this is used.
+        """
+        if self._original_mapping is None:
+            ar = ArrayReader(self.original_image)
+            self._original_mapping = CoordinateMapping(
+                self.moving_image.shape, ar.shape, self.z_y_x_voxel,
+                flip=(self.flip_z, self.flip_y, self.flip_x),
+                indices=(self.z_index, self.y_index, self.x_index))
+        return self._original_mapping
 
     def on_moving_annotate(self, s):
         args = parse_args()
@@ -604,7 +610,7 @@ void main() {
         if args.original_image != "":
             self.rp = self.get_reference_edit_point()
             self.mp =self.get_moving_edit_point()
-            point= self.moving_to_original()
+            point = self.original_mapping.moving_to_original(self.mp)[0]
             with self.original_viewer.txn() as txn:
                 layer = pointlayer(txn, self.EDIT, [point[0]],[point[1]], [point[2]],
                                    color=self.EDIT_ANNOTATION_COLOR, 
@@ -636,7 +642,7 @@ void main() {
             txn.layers[self.EDIT] = layer
         
         self.op = self.get_original_edit_point()
-        point= self.original_to_moving()
+        point = self.original_mapping.original_to_moving(self.op)[0]
         
         with self.moving_viewer.txn() as txn:
             layer = pointlayer(txn, self.EDIT, [point[0]],[point[1]], [point[2]], 
@@ -704,15 +710,49 @@ void main() {
                 txn.layers[self.EDIT] = neuroglancer.PointAnnotationLayer(
                     annotation_color=self.EDIT_ANNOTATION_COLOR)
 
-    def refresh_brightness(self):
+    def histogram(self, name, img):
+        """Get the cached brightness histogram of a layer's image
+
+        :param name: the name of the layer
+        :param img: the layer's image, which is counted if its histogram
+        is not cached.
+        :returns: the ImageHistogram of the image
+        """
+        if name not in self.histograms:
+            self.histograms[name] = ImageHistogram(img)
+        return self.histograms[name]
+
+    def refresh_brightness(self, alignment_changed=False):
+        """Set the brightness of the layers' shaders
+
+        :param alignment_changed: True if the alignment or preview image
+        has changed since the brightness was last refreshed, so its
+        histogram must be counted again.
+        """
         args=parse_args()
-        max_reference_img = soft_max_brightness(self.reference_image)
+        if alignment_changed:
+            self.histograms.pop(self.ALIGNMENT, None)
+        max_reference_img = soft_max_brightness(
+            self.histogram(self.REFERENCE, self.reference_image))
         if self.reference_image.dtype.kind in ("i", "u"):
             max_reference_img /= np.iinfo(self.reference_image.dtype).max
-        max_moving_img = soft_max_brightness(self.moving_image)
-        if hasattr(self, "alignment_image"):
-            max_align_img = soft_max_brightness(self.alignment_image)
-            if self.alignment_image.dtype.kind in ("i", "u"):
+        max_moving_img = soft_max_brightness(
+            self.histogram(self.IMAGE, self.moving_image))
+        #
+        # The alignment image is blank until the first warp. While it is
+        # being refined, it holds the preview, whose histogram is cached.
+        #
+        if self.preview_image is not None:
+            alignment_img = self.preview_image
+        elif self.aligned_coefficients is not None or \
+                self.ALIGNMENT in self.histograms:
+            alignment_img = self.alignment_image
+        else:
+            alignment_img = None
+        if alignment_img is not None:
+            max_align_img = soft_max_brightness(
+                self.histogram(self.ALIGNMENT, alignment_img))
+            if alignment_img.dtype.kind in ("i", "u"):
                 max_align_img /= np.iinfo(self.moving_image.dtype).max
         else:
             max_align_img = max_moving_img
@@ -880,6 +920,7 @@ void main() {
         self.post_message(self.moving_viewer, self.EDIT,
                           "Added point at %d, %d, %d" %
                           tuple(moving_point[::-1]))
+        self.incremental_warper.insert(idx, reference_point, moving_point)
         if original_point !=False:
             self.original_pts.insert(idx, original_point)
             self.post_message(self.original_viewer, self.EDIT,
@@ -910,6 +951,7 @@ void main() {
         self.post_message(self.moving_viewer, self.EDIT,
                           "removed point %d at %d, %d, %d" %
                           tuple([idx] + list(moving_point[::-1])))
+        self.incremental_warper.remove(idx)
         if args.original_image!="":
             original_point = self.original_pts.pop(idx)
             self.post_message(self.original_viewer, self.EDIT,
@@ -959,6 +1001,39 @@ void main() {
                     txn, self.EDIT, np.zeros(0), np.zeros(0), np.zeros(0),
                     color=self.EDIT_ANNOTATION_COLOR, voxel_size=voxel_size)
 
+    def on_residuals(self, s):
+        """Show the correspondences colored by their leave-one-out errors
+
+        The residuals layer holds the correspondences, worst first, colored
+        from green to red by how far the warp fitted to all of the others
+        misses each of them.
+        """
+        try:
+            errors = self.incremental_warper.leave_one_out_errors()
+        except np.linalg.LinAlgError:
+            self.post_message(None, self.RESIDUALS_ACTION,
+                              "Not enough points to compute residuals.")
+            return
+        distances = np.sqrt(np.sum(np.square(errors), 1))
+        order = np.argsort(-distances, kind="stable")
+        colors = residual_colors(distances[order])
+        for viewer, points, voxel_size in (
+                (self.reference_viewer, self.annotation_reference_pts,
+                 self.reference_voxel_size),
+                (self.moving_viewer, self.annotation_moving_pts,
+                 self.moving_voxel_size)):
+            points = np.array(points, dtype=np.float32).reshape(-1, 3)[order]
+            with viewer.txn() as txn:
+                pointlayer(
+                    txn, self.RESIDUALS,
+                    points[:, 0], points[:, 1], points[:, 2],
+                    colors=colors, voxel_size=voxel_size)
+        self.post_message(
+            None, self.RESIDUALS_ACTION,
+            "Worst correspondences (error in moving image voxels): " +
+            ", ".join(["#%d: %.1f" % (idx, distances[idx])
+                       for idx in order[:5]]))
+
     def on_refresh(self, s):
         self.refresh()
     def refresh(self):
@@ -971,7 +1046,8 @@ void main() {
                   scales=self.moving_voxel_size)
             layer(s, self.IMAGE, self.moving_image, gray_shader,
                   self.moving_brightness,
-                  voxel_size=self.moving_voxel_size)
+                  voxel_size=self.moving_voxel_size,
+                  multiscale=True)
         with self.reference_viewer.txn() as s:
             s.dimensions = neuroglancer.CoordinateSpace(
                   names=["x", "y", "z"],
@@ -979,12 +1055,16 @@ void main() {
                   scales=self.reference_voxel_size)
             layer(s, self.REFERENCE, self.reference_image, red_shader,
                   self.reference_brightness,
-                  voxel_size=self.reference_voxel_size)
-            layer(s, self.ALIGNMENT, self.alignment_image, green_shader,
-                  self.moving_brightness,
-                  voxel_size=self.moving_voxel_size)
+                  voxel_size=self.reference_voxel_size,
+                  multiscale=True)
+            self.alignment_volume = layer(
+                s, self.ALIGNMENT, self.alignment_image, green_shader,
+                self.moving_brightness,
+                voxel_size=self.reference_voxel_size)
             if self.segmentation is not None:
-                seglayer(s, self.SEGMENTATION, self.segmentation)
+                seglayer(s, self.SEGMENTATION, self.segmentation,
+                         voxel_size=self.reference_voxel_size,
+                         multiscale=True)
             if args.original_image!="":
                 with self.original_viewer.txn() as s:
                     s.dimensions = neuroglancer.CoordinateSpace(
@@ -1016,15 +1096,15 @@ void main() {
         args=parse_args()
         """Translate the editing coordinate in the reference frame to moving"""
         rp = self.get_reference_edit_point()
-        if self.warper != None and rp:
-            self.mp = self.warper(np.atleast_2d(rp))[0]
+        if self.incremental_warper.fitted and rp:
+            self.mp = self.incremental_warper(np.atleast_2d(rp))[0]
             with self.moving_viewer.txn() as txn:
                 txn.layers[self.EDIT] = neuroglancer.PointAnnotationLayer(
                     points=[self.mp[::-1]],
                     annotation_color=self.EDIT_ANNOTATION_COLOR)
                 txn.position = self.mp[::-1]
             if args.original_image!="":
-                op = self.moving_to_original()
+                op = self.original_mapping.moving_to_original(self.mp)[0]
                 with self.original_viewer.txn() as txn:
                     txn.layers[self.EDIT] = neuroglancer.PointAnnotationLayer(
                         points=[op[::-1]],
@@ -1047,6 +1127,12 @@ void main() {
             self.post_message(viewer, self.EDIT, "Saved point state")
 
     def on_warp(self, s):
+        """Warp the moving image, showing a low-resolution preview first
+
+        The preview is displayed right away and the full-resolution
+        alignment is computed in a background thread that swaps it in as
+        it progresses.
+        """
         cs, generation = \
             self.reference_viewer.config_state.state_and_generation
         cs = deepcopy(cs)
@@ -1056,38 +1142,224 @@ void main() {
         self.reference_viewer.config_state.set_state(
              cs, existing_generation=generation)
         try:
-            self.align_image()
-            with self.reference_viewer.txn() as txn:
-                layer(txn, self.ALIGNMENT, self.alignment_image,
-                      green_shader, 1.0, voxel_size=self.reference_voxel_size),
-            self.refresh_brightness()
+            warper = self.make_alignment_warper()
+            if self.delta_warp(warper):
+                return
+            factor = self.preview_factor
+            preview = self.preview_alignment(warper, factor)
+            with self.warp_lock:
+                self.warper = warper
+                self.preview_image = preview
+                self.aligned_coefficients = None
+                self.warp_generation += 1
+                with self.reference_viewer.txn() as txn:
+                    layer(txn, self.ALIGNMENT, preview, green_shader, 1.0,
+                          dimensions=preview_dimensions(
+                              self.reference_voxel_size, factor))
+                self.refresh_brightness(alignment_changed=True)
+                if self.refinement_thread is None:
+                    self.refinement_thread = threading.Thread(
+                        target=self.refine_alignment, daemon=True)
+                    self.refinement_thread.start()
             self.post_message(self.reference_viewer, self.WARP_ACTION,
-                    "Warping complete, thank you for your patience.")
+                    "Showing a 1/%d resolution preview. "
+                    "Refining in the background..." % factor)
         except:
             self.post_message(self.reference_viewer, self.WARP_ACTION,
                     "Oh my, something went wrong. See console log for details.")
             raise
 
-    def align_image(self):
-        """Warp the moving image into the reference image's space"""
-        self.warper = Warper(self.reference_pts, self.moving_pts)
+    @property
+    def preview_factor(self):
+        """The downsampling factor for the preview of the alignment"""
+        for factor in self.PREVIEW_FACTORS:
+            n_voxels = np.prod([(_ + factor - 1) // factor
+                                for _ in self.reference_image.shape])
+            if n_voxels <= self.PREVIEW_MAX_VOXELS:
+                break
+        return factor
+
+    def make_alignment_warper(self):
+        """Approximate the reference-to-moving warp on a grid for warping"""
         inputs = [
             np.arange(0,
                       self.reference_image.shape[_]+ self.decimation - 1,
                       self.decimation)
             for _ in range(3)]
-        self.warper = self.warper.approximate(*inputs)
-        self.warpers[id(self)] = self.warper
-        with multiprocessing.Pool(self.n_workers) as pool:
-            futures = []
-            for z0 in range(0, self.reference_image.shape[0]):
-                z1 = z0 + 1
-                futures.append(
-                    pool.apply_async(warp_image,
-                                     (z0, z1, id(self), self.reference_image.shape)))
-            for future in tqdm.tqdm(futures,
-                                    desc="Warping image"):
-                future.get()
+        return self.incremental_warper.approximate(*inputs)
+
+    def preview_alignment(self, warper, factor):
+        """Warp the moving image into the reference space at low resolution
+
+        :param warper: the approximator from make_alignment_warper()
+        :param factor: warp every factor'th voxel of the reference space
+        in each direction.
+        :returns: the downsampled alignment image
+        """
+        shape = self.reference_image.shape
+        preview = np.zeros([(_ + factor - 1) // factor for _ in shape],
+                           np.float32)
+        for i, z in enumerate(range(0, shape[0], factor)):
+            map_coordinates(self.moving_image,
+                            warper.warp_plane(z, shape[1:], factor),
+                            output=preview[i], order=1)
+        return preview
+
+    def refine_alignment(self):
+        """Compute the full-resolution alignment in the background
+
+        The alignment image is first filled from the preview and displayed.
+        It is then warped plane by plane and the display is refreshed as
+        planes complete. If the user warps again while this is going on,
+        the rest of the warp is cancelled and the refinement starts over
+        with the new warp.
+        """
+        try:
+            while True:
+                with self.warp_lock:
+                    generation = self.warp_generation
+                    warper = self.warper
+                    preview = self.preview_image
+                factor = self.preview_factor
+                alignment = self.alignment_image
+                y = np.arange(alignment.shape[1]) // factor
+                x = np.arange(alignment.shape[2]) // factor
+                for z in range(alignment.shape[0]):
+                    alignment[z] = preview[z // factor][y][:, x]
+                with self.warp_lock:
+                    if generation != self.warp_generation:
+                        continue
+                    self.preview_image = None
+                    with self.reference_viewer.txn() as txn:
+                        self.alignment_volume = layer(
+                            txn, self.ALIGNMENT, self.alignment_image,
+                            green_shader, 1.0,
+                            voxel_size=self.reference_voxel_size)
+                on_progress = functools.partial(self.on_refinement_progress,
+                                                generation=generation)
+                if not self.align_image(
+                        warper, on_progress,
+                        cancel=lambda: generation != self.warp_generation):
+                    continue
+                with self.warp_lock:
+                    if generation != self.warp_generation:
+                        continue
+                    self.refinement_thread = None
+                    self.aligned_coefficients = warper.coefficients.copy()
+                    self.alignment_volume.invalidate()
+                    self.refresh_brightness(alignment_changed=True)
+                self.post_message(self.reference_viewer, self.WARP_ACTION,
+                        "Warping complete, thank you for your patience.")
+                return
+        except:
+            logging.exception("Failed to refine the alignment")
+            with self.warp_lock:
+                self.refinement_thread = None
+            self.post_message(self.reference_viewer, self.WARP_ACTION,
+                    "Oh my, something went wrong. See console log for details.")
+
+    def delta_warp(self, warper):
+        """Rewarp only the parts of the alignment changed by a new warp
+
+        The coefficients of the warp that the alignment image was made
+        with are kept in self.aligned_coefficients. Only the rectangles of
+        each plane that are interpolated from coefficients that moved by
+        more than DELTA_WARP_THRESHOLD are rewarped and only those
+        coefficients are updated, so that the rest of the alignment image
+        never drifts more than twice the threshold from the current warp.
+
+        :param warper: the approximator from make_alignment_warper()
+        :returns: True if the alignment was updated, False if a full warp
+        is needed because there is no complete alignment image or too much
+        of it changed.
+        """
+        with self.warp_lock:
+            aligned_coefficients = self.aligned_coefficients
+            if aligned_coefficients is None or \
+                    aligned_coefficients.shape != warper.coefficients.shape:
+                return False
+        changed = warper.changed_coefficients(
+            aligned_coefficients, self.DELTA_WARP_THRESHOLD)
+        shape = self.reference_image.shape
+        regions = []
+        for z in range(shape[0]):
+            region = warper.changed_region(changed, z, shape[1:])
+            if region is not None:
+                regions.append((z, region))
+        n_voxels = sum([(y1 - y0) * (x1 - x0)
+                        for _, ((y0, x0), (y1, x1)) in regions])
+        if n_voxels > np.prod(shape) * self.DELTA_WARP_MAX_FRACTION:
+            return False
+        if len(regions) > 0:
+            self.align_image(warper, regions=regions)
+        with self.warp_lock:
+            aligned_coefficients[changed.ravel()] = \
+                warper.coefficients[changed.ravel()]
+            self.alignment_volume.invalidate()
+            self.refresh_brightness(alignment_changed=True)
+        self.post_message(self.reference_viewer, self.WARP_ACTION,
+                "Warping complete: rewarped %.1f%% of the alignment." %
+                (100 * n_voxels / np.prod(shape)))
+        return True
+
+    def on_refinement_progress(self, n_done, n_total, generation=None):
+        """Show the planes of the full-resolution alignment done so far
+
+        :param n_done: the number of planes done
+        :param n_total: the number of planes in all
+        :param generation: the warp generation of the refinement. Nothing
+        is shown if the user has warped again since.
+        """
+        with self.warp_lock:
+            if generation is not None and generation != self.warp_generation:
+                return
+            if self.alignment_volume is not None:
+                self.alignment_volume.invalidate()
+        self.post_message(self.reference_viewer, self.WARP_ACTION,
+                "Refining the alignment: %d of %d planes done" %
+                (n_done, n_total))
+
+    def align_image(self, warper=None, on_progress=None, regions=None,
+                    cancel=None):
+        """Warp the moving image into the reference image's space
+
+        :param warper: the approximator to use for warping. Defaults to a
+        new one from make_alignment_warper().
+        :param on_progress: a function called with the number of planes
+        done and the total number of planes each time another
+        REFINE_UPDATE_FRACTION of the planes are done.
+        :param regions: a sequence of two-tuples of a z and the (y0, x0),
+        (y1, x1) corners of the rectangle in plane z to warp. Defaults to
+        all of every plane.
+        :param cancel: a function that returns True if the warp should be
+        abandoned. It is called each time a plane is done.
+        :returns: True if the warp was completed, False if it was cancelled
+        """
+        if warper is None:
+            warper = self.make_alignment_warper()
+        self.warper = warper
+        shape = self.reference_image.shape
+        if regions is None:
+            regions = [(z, ((0, 0), shape[1:])) for z in range(shape[0])]
+        n_planes = len(regions)
+        update_interval = max(1, int(n_planes * self.REFINE_UPDATE_FRACTION))
+        progress = tqdm.tqdm(self.warp_pool.warp(warper, regions),
+                             total=n_planes, desc="Warping image")
+        try:
+            for i, _ in enumerate(progress):
+                if cancel is not None and cancel():
+                    self.warp_pool.cancel()
+                    return False
+                if on_progress is not None and \
+                        (i + 1) % update_interval == 0:
+                    on_progress(i + 1, n_planes)
+        finally:
+            progress.close()
+        return True
+
+    def close(self):
+        """Stop the warp workers and free their shared memory"""
+        self.warp_pool.close()
 
     def print_viewers(self):
         args=parse_args()
@@ -1108,17 +1380,6 @@ void main() {
 
 
 
-def warp_image(z0, z1, key, shape):
-    warper = ViewerPair.warpers[key]
-    moving_img = ViewerPair.moving_images[key]
-    with ViewerPair.alignment_buffers[key].txn() as alignment_image:
-        z, y, x = np.mgrid[z0:z1, 0:shape[1], 0:shape[2]]
-        src_coords = np.column_stack([z.flatten(),
-                                      y.flatten(), x.flatten()])
-        ii, jj, kk = [_.reshape(z.shape) for _ in warper(src_coords).transpose()]
-        map_coordinates(moving_img, [ii, jj, kk],
-                        output=alignment_image[z0:z1])
-
 def main():
     logging.basicConfig(level=logging.INFO)
     args = parse_args()
@@ -1141,9 +1402,9 @@ def main():
     original_voxel_size = \
         [float(_) * 1 for _ in args.moving_voxel_size.split(",")]
     logging.info("Reading reference image")
-    reference_image = tifffile.imread(args.reference_image).astype(np.float32)
+    reference_image = read_tiff(args.reference_image)
     logging.info("Reading moving image")
-    moving_image = tifffile.imread(args.moving_image).astype(np.float32)
+    moving_image = read_tiff(args.moving_image)
     
     if args.original_image!="":
         logging.info("Reading original image")
@@ -1151,7 +1412,7 @@ def main():
 
     if args.segmentation is not None:
         logging.info("Reading segmentation")
-        segmentation = tifffile.imread(args.segmentation).astype(np.uint32)
+        segmentation = TiffVolume(args.segmentation)
     else:
         segmentation = None
 
@@ -1162,8 +1423,11 @@ def main():
         vp.launch_viewers()
     vp.print_viewers()
     print("Hit ctrl+C to exit")
-    while True:
-        time.sleep(.1)
+    try:
+        while True:
+            time.sleep(.1)
+    finally:
+        vp.close()
 
 if __name__ == "__main__":
     main()
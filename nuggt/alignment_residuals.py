@@ -0,0 +1,105 @@
+"""alignment_residuals - find the worst correspondences in an alignment
+
+Each correspondence in an alignment file is scored by how far the warp
+fitted to all of the other correspondences misses it. A correspondence that
+disagrees with its neighbors, e.g. because it was misplaced, has a large
+error. The errors are computed in closed form from a single factorization of
+the thin-plate spline system, so this takes about as long as one fit.
+"""
+
+import argparse
+import json
+import numpy as np
+import sys
+
+from .utils.warp import leave_one_out_errors
+
+
+def parse_args(args=sys.argv[1:]):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--alignment",
+                        help="The alignment points file, e.g. from "
+                        "nuggt-align, sitk-align or make-alignment-file",
+                        required=True)
+    parser.add_argument("--output",
+                        help="The name of a .csv file to hold the errors of "
+                        "the correspondences, worst first")
+    parser.add_argument("--reference-frame",
+                        help="Score the warp from the moving frame to the "
+                        "reference frame, as used by count-points-in-region,"
+                        " instead of the warp from the reference frame to "
+                        "the moving frame, as used by nuggt-align.",
+                        action="store_true")
+    parser.add_argument("--n-worst",
+                        help="The number of correspondences to print",
+                        type=int,
+                        default=10)
+    return parser.parse_args(args)
+
+
+def residuals(src_coords, dest_coords, smooth=0):
+    """Compute the leave-one-out error of each correspondence
+
+    :param src_coords: the correspondences in the warp's source frame
+    :param dest_coords: the correspondences in the warp's destination frame
+    :param smooth: the smoothing factor of the thin-plate spline
+    :returns: a two-tuple of the N-element array of the distance in the
+    destination frame between each correspondence and where the warp
+    fitted to the others puts it, and the indices of the correspondences,
+    sorted from the largest error to the smallest.
+    """
+    errors = leave_one_out_errors(src_coords, dest_coords, smooth)
+    distances = np.sqrt(np.sum(np.square(errors), 1))
+    return distances, np.argsort(-distances, kind="stable")
+
+
+def residual_colors(distances):
+    """Color correspondences from green through yellow to red by error
+
+    :param distances: the error of each correspondence
+    :returns: a list of "#rrggbb" colors, red for the largest error and
+    green for no error.
+    """
+    distances = np.asarray(distances, float)
+    finite = np.isfinite(distances)
+    if np.any(finite) and np.max(distances[finite]) > 0:
+        fraction = distances / np.max(distances[finite])
+    else:
+        fraction = np.zeros(len(distances))
+    fraction = np.clip(np.where(finite, fraction, 1), 0, 1)
+    red = np.clip(fraction * 2, 0, 1)
+    green = np.clip(2 - fraction * 2, 0, 1)
+    return ["#%02x%02x00" % (int(r * 255), int(g * 255))
+            for r, g in zip(red, green)]
+
+
+def main():
+    args = parse_args()
+    with open(args.alignment) as fd:
+        alignment = json.load(fd)
+    reference = np.array(alignment["reference"], float).reshape(-1, 3)
+    moving = np.array(alignment["moving"], float).reshape(-1, 3)
+    if args.reference_frame:
+        distances, order = residuals(moving, reference)
+    else:
+        distances, order = residuals(reference, moving)
+    print("%6s %24s %24s %10s" %
+          ("index", "reference (z, y, x)", "moving (z, y, x)", "error"))
+    for idx in order[:args.n_worst]:
+        print("%6d %24s %24s %10.2f" % (
+            idx,
+            "%.1f, %.1f, %.1f" % tuple(reference[idx]),
+            "%.1f, %.1f, %.1f" % tuple(moving[idx]),
+            distances[idx]))
+    if args.output is not None:
+        with open(args.output, "w") as fd:
+            fd.write("index,reference_z,reference_y,reference_x,"
+                     "moving_z,moving_y,moving_x,error\n")
+            for idx in order:
+                fd.write("%d,%f,%f,%f,%f,%f,%f,%f\n" % (
+                    (idx,) + tuple(reference[idx]) + tuple(moving[idx]) +
+                    (distances[idx],)))
+
+
+if __name__ == "__main__":
+    main()
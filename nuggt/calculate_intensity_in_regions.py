@@ -22,6 +22,7 @@ except:
 
 from .brain_regions import BrainRegions
 from nuggt.utils.warp import Warper
+from nuggt.utils.warp_cache import make_warper, add_cache_argument
 
 
 def parse_args(args=sys.argv[1:]):
@@ -65,12 +66,20 @@ def parse_args(args=sys.argv[1:]):
                         help="The number of knots in the bicubic spline grid "
                         "(in the x and y directions) used to approximate the "
                         "transformation")
+    parser.add_argument("--spline-order",
+                        type=int,
+                        default=1,
+                        choices=(1, 3),
+                        help="The order of the approximating spline: 1 for "
+                        "linear or 3 for cubic B-splines which are accurate "
+                        "with a smaller --grid-size.")
+    add_cache_argument(parser)
 
     return parser.parse_args(args)
 
 
 def do_plane(filename:str, z:int, segmentation: SharedMemory, warper:Warper,
-             shrink=(1, 1), grid_size=(100, 100)):
+             shrink=(1, 1), grid_size=(100, 100), spline_order=1):
     """Process one plane
 
     :param filename: the name of the tiff file holding the plane
@@ -78,6 +87,7 @@ def do_plane(filename:str, z:int, segmentation: SharedMemory, warper:Warper,
     :param segmentation: the shared-memory holder of the segmentation.
     :param shrink: The factor to shrink the warping in the y and x direction
     :param grid_size: the number of voxels between knots in the bspline grid
+    :param spline_order: 1 for a linear or 3 for a cubic approximating spline
     :return: a two tuple of the counts per region and total intensities per
     region.
     """
@@ -86,16 +96,6 @@ def do_plane(filename:str, z:int, segmentation: SharedMemory, warper:Warper,
     if np.isscalar(grid_size):
         grid_size = (grid_size, grid_size)
     plane = tifffile.imread(filename)
-    #
-    # zz, yy and xx are the coordinates that we will convert via the warper.
-    # We subsample to reduce the runtime and because the segmentation is
-    # so much smaller than the image that subsampling has little effect on
-    # accuracy.
-    #
-    zz, yy, xx = [_.flatten() for _ in
-                  np.mgrid[z:z+1,
-                           0:plane.shape[0]:shrink[0],
-                           0:plane.shape[1]:shrink[1]]]
     yyy, xxx = np.mgrid[0:plane.shape[0],
                         0:plane.shape[1]]
     #
@@ -107,19 +107,24 @@ def do_plane(filename:str, z:int, segmentation: SharedMemory, warper:Warper,
     awarper = warper.approximate(
         np.array([z-1, z, z+1]),
         np.linspace(0, plane.shape[0] - 1, grid_size[0]),
-        np.linspace(0, plane.shape[1] - 1, grid_size[1]))
-    zseg, yseg, xseg = awarper(np.column_stack((zz, yy, xx))).transpose()
-    zseg = np.round(zseg).astype(np.int32)
-    yseg = np.round(yseg).astype(np.int32)
-    xseg = np.round(xseg).astype(np.int32)
+        np.linspace(0, plane.shape[1] - 1, grid_size[1]),
+        order=spline_order, dtype=np.float32)
+    #
+    # We warp a subsampled plane to reduce the runtime and because the
+    # segmentation is so much smaller than the image that subsampling has
+    # little effect on accuracy.
+    #
+    orig_shape = ((plane.shape[0] + shrink[0] - 1) // shrink[0],
+                  (plane.shape[1] + shrink[1] - 1) // shrink[1])
+    zseg, yseg, xseg = [_.flatten() for _ in awarper.warp_plane(
+        z, plane.shape, shrink[:2],
+        out=np.zeros((3,) + orig_shape, np.int32))]
     mask = (xseg >= 0) & (xseg < segmentation.shape[2]) &\
            (yseg >= 0) & (yseg < segmentation.shape[1]) &\
            (zseg >= 0) & (zseg < segmentation.shape[0])
     with segmentation.txn() as m:
         send = np.max(m) + 1
         seg = m[zseg[mask], yseg[mask], xseg[mask]]
-    orig_shape = ((plane.shape[0] + shrink[0] - 1) // shrink[0],
-                  (plane.shape[1] + shrink[1] - 1) // shrink[1])
     oseg = np.zeros(orig_shape, seg.dtype)
     oseg[mask.reshape(orig_shape)] = seg
     seg = oseg[yyy, xxx]
@@ -136,7 +141,8 @@ def main(args=sys.argv[1:]):
         levels.append(7)
     with open(args.alignment) as fd:
         alignment = json.load(fd)
-    warper = Warper(alignment["moving"], alignment["reference"])
+    warper = make_warper(alignment["moving"], alignment["reference"],
+                         cache_dir=args.warp_cache)
     segmentation = tifffile.imread(args.reference_segmentation)\
         .astype(np.uint16)
     sm_segmentation = SharedMemory(segmentation.shape,
@@ -151,7 +157,8 @@ def main(args=sys.argv[1:]):
     if args.n_cores == 1:
         for z, filename in tqdm.tqdm(enumerate(files), total=len(files)):
             c, s = do_plane(filename, z, sm_segmentation, warper,
-                            shrink=args.shrink, grid_size=args.grid_size)
+                            shrink=args.shrink, grid_size=args.grid_size,
+                            spline_order=args.spline_order)
             total_counts += c
             total_sums += s
     else:
@@ -161,7 +168,7 @@ def main(args=sys.argv[1:]):
                 future = pool.apply_async(
                     do_plane,
                     (filename, z, sm_segmentation, warper, args.shrink,
-                     args.grid_size))
+                     args.grid_size, args.spline_order))
                 futures.append(future)
 
             for future in tqdm.tqdm(futures):
@@ -10,7 +10,8 @@ import sys
 import tifffile
 
 from .brain_regions import BrainRegions
-from nuggt.utils.warp import Warper
+from nuggt.utils.warp import DEFAULT_MAX_BYTES
+from nuggt.utils.warp_cache import make_warper, add_cache_argument
 
 
 def parse_args(args=sys.argv[1:]):
@@ -47,19 +48,43 @@ def parse_args(args=sys.argv[1:]):
                         action="store_true",
                         help="Exclude regions from the CSV that have no points"
                         " in them")
+    parser.add_argument("--max-bytes",
+                        help="The memory budget in bytes for the temporary "
+                        "storage used while warping the points. Defaults to "
+                        "%d." % DEFAULT_MAX_BYTES,
+                        type=int,
+                        default=DEFAULT_MAX_BYTES)
+    parser.add_argument("--tolerance",
+                        help="If specified, warp the points with a fast "
+                        "approximation whose error is at most this many "
+                        "voxels in the reference space instead of exactly.",
+                        type=float)
+    add_cache_argument(parser)
     return parser.parse_args(args)
 
 
-def warp_points(pts_moving, pts_reference, points):
+def warp_points(pts_moving, pts_reference, points, max_bytes=None,
+                warp_cache=None, tolerance=None, return_error=False):
     """Warp points from the moving space to the reference
 
     :param pts_moving: points for aligning in the moving coordinate frame
     :param pts_reference: corresponding points in the reference frame
     :param points: the points to be translated
-    :return: the points in the reference frame
+    :param max_bytes: the memory budget for the warper's temporary storage.
+    The points are warped in chunks that fit within this budget.
+    :param warp_cache: a directory for caching the fitted warper between runs
+    or None to not cache it.
+    :param tolerance: the maximum error allowed in the warped coordinates
+    or None to warp the points exactly.
+    :param return_error: if True, also return the error bound of each
+    warped point
+    :return: the points in the reference frame and, if return_error is True,
+    the error bound per point, which is zero if the points were warped
+    exactly.
     """
-    warper = Warper(pts_moving, pts_reference)
-    return warper(points)
+    warper = make_warper(pts_moving, pts_reference, cache_dir=warp_cache)
+    return warper.transform(points, max_bytes=max_bytes, tolerance=tolerance,
+                            return_error=return_error)
 
 
 def main():
@@ -72,7 +97,12 @@ def main():
         alignment = json.load(fd)
     moving_pts = np.array(alignment["moving"])
     ref_pts = np.array(alignment["reference"])
-    xform = warp_points(moving_pts, ref_pts, points)
+    xform, error = warp_points(moving_pts, ref_pts, points, args.max_bytes,
+                               args.warp_cache, args.tolerance,
+                               return_error=True)
+    if args.tolerance is not None and len(error) > 0:
+        print("Maximum error of the warped points: %.3g voxels" %
+              np.max(error))
     if args.output_points is not None:
         if args.xyz:
             xformt = xform[:, ::-1]
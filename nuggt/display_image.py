@@ -5,10 +5,8 @@
 
 
 import argparse
-import glob
-import json
 import numpy as np
-import tifffile
+import os
 import neuroglancer
 import sys
 import time
@@ -16,7 +14,10 @@ import webbrowser
 from nuggt.utils.ngutils import \
     gray_shader, red_shader, green_shader, blue_shader, jet_shader, \
     cubehelix_shader, \
-    layer, seglayer, pointlayer
+    layer, seglayer, pointlayer, annotation_source_layer, INLINE_POINT_LIMIT
+from nuggt.utils.precomputed_annotations import read_points_file, \
+    serve_annotations, serve_points
+from nuggt.utils.tiff_volume import TiffVolume
 
 
 def main():
@@ -39,7 +40,15 @@ def main():
                         default=None,
                         help="Obsolete - no longer has any effect")
     parser.add_argument("--points",
-                        help="A points file in Z, Y, X order to display")
+                        help="A .json or .npy points file in Z, Y, X order "
+                        "to display or a directory written by "
+                        "make-precomputed-annotations. Large point sets are "
+                        "served as precomputed annotations.")
+    parser.add_argument("--pyramid-cache",
+                        action="store_true",
+                        help="Keep the downsampled images used for "
+                        "zoomed-out views in a directory next to each image "
+                        "so that they are only made once.")
     parser.add_argument("--show-n",
                         type=int,
                         help="Show only a certain number of randomly selected "
@@ -86,23 +95,27 @@ def main():
                     shader = shader % 1.0
                 )
                 continue
-            paths = sorted(glob.glob(filename))
-            if len(paths) == 0:
+            try:
+                img = TiffVolume(filename)
+            except FileNotFoundError:
                 sys.stderr.write("Could not find any files named %s" % filename)
                 exit(1)
-            elif len(paths) == 1:
-                img = tifffile.imread(paths[0])
-            else:
-                img = np.array([tifffile.imread(_) for _ in paths])
-            layer(txn, name, img, shader, 1.0, dimensions=default_dimensions)
+            layer(txn, name, img, shader, 1.0, dimensions=default_dimensions,
+                  pyramid_cache=args.pyramid_cache)
         if args.segmentation != None:
-            seg = tifffile.imread(args.segmentation).astype(np.uint32)
-            seglayer(txn, "segmentation", seg)
-        if args.points is not None:
-            with open(args.points) as fd:
-                points = np.array(json.load(fd))
-                if args.show_n is not None:
-                    points = points[np.random.choice(len(points), args.show_n)]
+            seglayer(txn, "segmentation", TiffVolume(args.segmentation),
+                     pyramid_cache=args.pyramid_cache)
+        if args.points is not None and os.path.isdir(args.points):
+            annotation_source_layer(txn, "points",
+                                    serve_annotations(args.points), "red")
+        elif args.points is not None:
+            points = read_points_file(args.points)
+            if args.show_n is not None:
+                points = points[np.random.choice(len(points), args.show_n)]
+            if len(points) > INLINE_POINT_LIMIT:
+                annotation_source_layer(txn, "points",
+                                        serve_points(points[:, ::-1]), "red")
+            else:
                 pointlayer(txn, "points",
                            points[:, 0], points[:, 1], points[:, 2], "red")
 
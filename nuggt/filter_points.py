@@ -1,11 +1,13 @@
 # Filter points by atlas region
 import argparse
+import functools
 import numpy as np
 import json
 import sys
 import multiprocessing
 import tifffile
-from .utils.warp import Warper
+from .utils.warp import DEFAULT_MAX_BYTES
+from .utils.warp_cache import make_warper, add_cache_argument
 from .brain_regions import BrainRegions
 
 def parse_args(args=sys.argv[1:]):
@@ -37,6 +39,17 @@ def parse_args(args=sys.argv[1:]):
                         default=multiprocessing.cpu_count(),
                         type=int,
                         help="Number of cores to use when multiprocessing")
+    parser.add_argument("--max-bytes",
+                        default=DEFAULT_MAX_BYTES,
+                        type=int,
+                        help="The memory budget in bytes for the temporary "
+                        "storage used by each core while warping points.")
+    parser.add_argument("--tolerance",
+                        type=float,
+                        help="If specified, warp the points with a fast "
+                        "approximation whose error is at most this many "
+                        "voxels in the reference space instead of exactly.")
+    add_cache_argument(parser)
     return parser.parse_args(args)
 
 warper_fn = None
@@ -49,9 +62,12 @@ def main(args=sys.argv[1:]):
         points = np.array(json.load(fd))[:, ::-1]
     with open(opts.alignment) as fd:
         alignment = json.load(fd)
-    warper = Warper(src_coords = alignment["moving"],
-                    dest_coords=alignment["reference"])
-    warper_fn = warper.transform
+    warper = make_warper(src_coords=alignment["moving"],
+                         dest_coords=alignment["reference"],
+                         cache_dir=opts.warp_cache)
+    warper_fn = functools.partial(warper.transform,
+                                  max_bytes=opts.max_bytes,
+                                  tolerance=opts.tolerance)
     with multiprocessing.Pool(opts.n_cores) as pool:
         idx_size = int((len(points) + opts.n_cores - 1) / opts.n_cores)
         idxs = np.arange(0, len(points), idx_size)
@@ -9,7 +9,7 @@ from .utils.warp import Warper
 
 
 def get_segment_ids(segmentation, fixed_pts, moving_pts, lookup_pts,
-                    warp_args={}, decimation=None):
+                    warp_args={}, decimation=None, tolerance=None):
     """Find the segment ID for every point in lookup_pts
 
     :param segmentation: a reference segmentation in the fixed space
@@ -20,6 +20,9 @@ def get_segment_ids(segmentation, fixed_pts, moving_pts, lookup_pts,
     :param decimation: downsample the fixed segmentation by this amount
     when creating the cubic splines from the thin-plate ones. Defaults
     to breaking the destination space into at least 5 blocks in each direction.
+    :param tolerance: if not None, refine the spline grid until the
+    approximation error is at most this many voxels. The decimation then
+    gives the spacing of the starting grid.
     :returns: a vector of segment ID per lookup point
     """
     if decimation is None:
@@ -30,7 +33,8 @@ def get_segment_ids(segmentation, fixed_pts, moving_pts, lookup_pts,
                   decimation)
         for _ in range(3)]
 
-    warper = Warper(moving_pts, fixed_pts, *warp_args).approximate(*inputs)
+    warper = Warper(moving_pts, fixed_pts, *warp_args).approximate(
+        *inputs, tolerance=tolerance)
     return get_segment_ids_using_warper(segmentation, warper, lookup_pts)
 
 
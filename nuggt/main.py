@@ -1,21 +1,19 @@
 import argparse
 import json
-import multiprocessing
 import neuroglancer
 import numpy as np
 import os
-import glob
 import sys
-import tempfile
-import tifffile
-import tqdm
 import webbrowser
 import time
-from scipy.spatial import KDTree
 
 from neuroglancer.server import BaseRequestHandler
 from .utils.ngutils import *
 from .ngreference import  NGReference
+from .utils.point_store import PointStore
+from .utils.precomputed_annotations import serve_points
+from .utils.prefetch import WindowPrefetcher, read_repositioning_log
+from .utils.tiff_volume import TiffVolume
 
 viewer = None
 
@@ -34,6 +32,12 @@ class NuggtViewer:
                  min_distance=10, multiplier=1.0, alt_multiplier=1.0,
                  box_coords=None):
         self.viewer = neuroglancer.Viewer()
+        self.annotation_layer = PointLayerManager(
+            self.viewer, "annotation", COLOR_POINTS)
+        self.detected_layer = PointLayerManager(
+            self.viewer, "detected", COLOR_DETECTED_POINTS)
+        self.deleting_layer = PointLayerManager(
+            self.viewer, "deleting", COLOR_DELETING_POINTS)
         self.points_file = points_file
         self.img_path = img_path
         self.alt_img_path=alt_img_path
@@ -43,29 +47,34 @@ class NuggtViewer:
         self.alt_multiplier = alt_multiplier
         if os.path.exists(points_file):
             with open(points_file) as fd:
-                self.points = np.array(json.load(fd))
+                self.points = PointStore(json.load(fd))
         else:
-            self.points = np.zeros((0, 3), np.float32)
+            self.points = PointStore()
+        self.detected_source = None
         if detected_points_file is not None:
             with open(detected_points_file) as fd:
-                self.detected_points = np.array(json.load(fd))
+                self.detected_points = PointStore(json.load(fd))
+            if len(self.detected_points) > INLINE_POINT_LIMIT:
+                #
+                # Too many to show inline - serve them all with a spatial
+                # index, placed as pointlayer would place them.
+                #
+                self.detected_source = serve_points(
+                    self.detected_points.array[:, ::-1])
         else:
             self.detected_points = None
         self.deleting_points = None
         self.box_coords = None
         self.bounding_box = box_coords
+        self.volumes = {}
+        self.prefetcher = None
         if img_path.startswith("precomputed:"):
             from precomputed_tif.client import get_info
             scale_1 = get_info(img_path).get_scale(1)
             self.x_extent, self.y_extent, self.z_extent = scale_1.shape
         else:
-            filenames = sorted(glob.glob(img_path))
-            if len(filenames) == 1:
-                self.z_extent, self.y_extent, self.x_extent = \
-                    tifffile.imread(filenames[0]).shape
-            else:
-                self.y_extent, self.x_extent = tifffile.imread(filenames[0]).shape
-                self.z_extent = len(filenames)
+            self.z_extent, self.y_extent, self.x_extent = \
+                self.volume(img_path).shape
         if x0 is not None and x1 is not None:
             self.width = x1 - x0
             self.x0 = x0
@@ -127,39 +136,60 @@ class NuggtViewer:
                  (self.y0 + self.y1) / 2,
                  (self.z0 + self.z1) / 2)
 
+    def volume(self, path):
+        """The lazily-read volume for an image path
+
+        The volume, and so its cache of the chunks read so far, is kept for
+        the life of the viewer.
+
+        :param path: the path to a 3D TIFF or a glob expression for a stack
+        of TIFF planes
+        :returns: a TiffVolume
+        """
+        if path not in self.volumes:
+            self.volumes[path] = TiffVolume(path)
+        return self.volumes[path]
+
+    def window(self, path):
+        """The part of an image to be edited
+
+        :param path: the image's path
+        :returns: the path itself for precomputed images, otherwise a view
+        of the edit window of the image's TiffVolume
+        """
+        if path.startswith("precomputed:"):
+            return path
+        return self.volume(path).window(self.z0, self.z1, self.y0, self.y1,
+                                        self.x0, self.x1)
+
     def display(self):
-        if self.img_path.startswith("precomputed:"):
-            img = self.img_path
-        else:
-            img = load_image(self.img_path, self.x0, self.x1, self.y0, self.y1,
-                             self.z0, self.z1)
+        img = self.window(self.img_path)
         if self.alt_img_path is not None:
-            if self.alt_img_path.startswith("precomputed:"):
-                alt_img = self.alt_img_path
-            else:
-                alt_img = load_image(self.alt_img_path, self.x0, self.x1,
-                                     self.y0, self.y1, self.z0, self.z1)
+            alt_img = self.window(self.alt_img_path)
         if self.seg_path is not None:
-            seg = load_image(self.seg_path, self.x0, self.x1,
-                             self.y0, self.y1, self.z0, self.z1)
+            seg = self.window(self.seg_path)
         with self.viewer.txn() as txn:
-            layer(txn, "image", img, gray_shader, self.multiplier,
+            layer(txn, "image", img, gray_shader,
+                  scale_multiplier(img, self.multiplier),
                   self.x0, self.y0, self.z0)
             if self.alt_img_path is not None:
                 layer(txn, "alt-image", alt_img, green_shader,
-                      self.alt_multiplier,
+                      scale_multiplier(alt_img, self.alt_multiplier),
                       self.x0, self.y0, self.z0)
             if self.seg_path is not None:
                 seglayer(txn, "segmentation", seg, self.x0, self.y0, self.z0)
-            self.display_points(txn, self.points, "annotation", COLOR_POINTS)
-            if self.detected_points is not None:
-                self.display_points(txn, self.detected_points, "detected",
-                                    COLOR_DETECTED_POINTS)
+            self.display_points(txn, self.points, self.annotation_layer)
+            if self.detected_source is not None:
+                annotation_source_layer(txn, "detected", self.detected_source,
+                                        COLOR_DETECTED_POINTS)
+            elif self.detected_points is not None:
+                self.display_points(txn, self.detected_points,
+                                    self.detected_layer)
             elif has_layer(txn, "detected"):
                 del txn.layers["detected"]
             if self.deleting_points is not None:
-                self.display_points(txn, self.deleting_points, "deleting",
-                                    COLOR_DELETING_POINTS)
+                self.display_points(txn, self.deleting_points,
+                                    self.deleting_layer)
             elif has_layer(txn, "deleting"):
                 del txn.layers["deleting"]
 
@@ -181,22 +211,40 @@ class NuggtViewer:
             self.center()
 
     def display_bounding_box(self, txn):
+        txn.layers["selection"] = self.selection_layer()
+
+    def selection_layer(self):
+        """The annotation layer showing the selection box"""
         box = neuroglancer.AxisAlignedBoundingBoxAnnotation()
         box.point_a = self.box_coords[0]
         box.point_b = self.box_coords[1]
         box.id = "selection"
-        txn.layers["selection"] = neuroglancer.AnnotationLayer(
-            annotations=[box])
-
-    def display_points(self, txn, points, layer_name, color):
-        mask = (points[:, 0] >= self.x0) & (points[:, 0] < self.x1) & \
-               (points[:, 1] >= self.y0) & (points[:, 1] < self.y1) & \
-               (points[:, 2] >= self.z0) & (points[:, 2] < self.z1)
-        display_points = points[mask]
-        pointlayer(txn, layer_name,
-                   display_points[:, 0], display_points[:, 1],
-                   display_points[:, 2],
-                   color)
+        return neuroglancer.AnnotationLayer(annotations=[box])
+
+    def in_window(self, points):
+        """The points within the edit window
+
+        :param points: a PointStore or an N x 3 array of the points
+        """
+        lo = (self.x0, self.y0, self.z0)
+        hi = (self.x1, self.y1, self.z1)
+        if isinstance(points, PointStore):
+            return points.in_box(lo, hi)
+        points = np.asarray(points).reshape(-1, 3)
+        return points[np.all((points >= lo) & (points < hi), 1)]
+
+    def display_points(self, txn, points, layer_manager):
+        """Display the points within the edit window
+
+        :param txn: the viewer transaction
+        :param points: a PointStore or an N x 3 array of the points
+        :param layer_manager: the PointLayerManager of the points' layer
+        """
+        display_points = self.in_window(points)
+        layer_manager.set_points(display_points[:, 0],
+                                 display_points[:, 1],
+                                 display_points[:, 2])
+        layer_manager.update(txn)
 
     def say(self, msg, category):
         with self.viewer.config_state.txn() as txn:
@@ -208,45 +256,26 @@ class NuggtViewer:
         if len(neighbors) > 0:
             self.say("Point too close to some other point!", "annotation")
             return
-        self.points = np.vstack((self.points, point))
-        with self.viewer.txn() as txn:
-            self.display_points(txn, self.points, "annotation", COLOR_POINTS)
+        self.points.add(point)
+        for x, y, z in self.in_window(point):
+            self.annotation_layer.add(x, y, z)
+        self.annotation_layer.update()
         self.say("Added point at %.2f, %.2f, %.2f" %
                  (point[0], point[1], point[2]),
             "annotation")
 
-    def find_nearby_points(self, point, return_index=False):
-        if len(self.points) == 0:
-            if return_index:
-                return np.zeros((0, 3), np.float32), np.zeros(0, int)
-            else:
-                return np.zeros((0, 3), np.float32)
-
-        diff = self.points - point[np.newaxis, :]
-        distances = np.sqrt(np.sum(np.square(diff), 1))
-        indexes = np.where(distances < self.min_distance)[0]
-        if len(indexes) == 0:
-            if return_index:
-                return np.zeros((0, 3), np.float32), np.zeros(0, int)
-            else:
-                return np.zeros((0, 3), np.float32)
-        result = self.points[indexes]
-        order = np.argsort(distances[indexes])
-        if return_index:
-            return result[order], indexes[order]
-        else:
-            return result[order]
+    def find_nearby_points(self, point):
+        """The points closer than the minimum distance, nearest first"""
+        return self.points.nearby(point, self.min_distance)
 
     def delete_handler(self, s):
         point = np.array(s.mouse_voxel_coordinates)
-        neighbors, indexes = self.find_nearby_points(point, return_index=True)
-        if len(neighbors) == 0:
+        to_delete = self.points.remove_nearest(point, self.min_distance)
+        if to_delete is None:
             self.say("No nearby point", "delete")
             return
-        to_delete = self.points[indexes[0]]
-        self.points = np.delete(self.points, indexes[0], 0)
-        with self.viewer.txn() as txn:
-            self.display_points(txn, self.points, "annotation", COLOR_POINTS)
+        self.annotation_layer.remove_point(*to_delete)
+        self.annotation_layer.update()
         self.say("Deleting %.2f, %.2f, %.2f" %
             (to_delete[0], to_delete[1], to_delete[2]), "delete")
 
@@ -258,16 +287,22 @@ class NuggtViewer:
         (x0, x1), (y0, y1), (z0, z1) = [
             [fn(self.box_coords[0][idx], self.box_coords[1][idx])
              for fn in (min, max)] for idx in range(3)]
-        all_points = self.all_points
-        mask = (all_points[:, 0] >= x0) & (all_points[:, 0] < x1) & \
-               (all_points[:, 1] >= y0) & (all_points[:, 1] < y1) & \
-               (all_points[:, 2] >= z0) & (all_points[:, 2] < z1)
-        self.points, self.deleting_points = all_points[~mask], all_points[mask]
-        with self.viewer.txn() as txn:
-            self.display_points(txn, self.points, "annotation", COLOR_POINTS)
-            self.display_points(txn, self.deleting_points,
-                                "deleting", COLOR_DELETING_POINTS)
-            self.display_bounding_box(txn)
+        if self.deleting_points is not None:
+            for x, y, z in self.in_window(self.deleting_points):
+                self.annotation_layer.add(x, y, z)
+        self.restore_deleting_points()
+        self.deleting_points = self.points.remove_box((x0, y0, z0),
+                                                      (x1, y1, z1))
+        deleting_points = self.in_window(self.deleting_points)
+        for x, y, z in deleting_points:
+            self.annotation_layer.remove_point(x, y, z)
+        self.deleting_layer.set_points(deleting_points[:, 0],
+                                       deleting_points[:, 1],
+                                       deleting_points[:, 2])
+        update_viewer_state(self.viewer, {
+            self.annotation_layer.name: self.annotation_layer.layer_json(),
+            self.deleting_layer.name: self.deleting_layer.layer_json(),
+            "selection": self.selection_layer()})
 
     def start_selection_handler(self, s):
         point = np.array(s.mouse_voxel_coordinates)
@@ -289,17 +324,22 @@ class NuggtViewer:
         if self.box_coords is not None:
             self.box_coords = None
             self.deleting_points = None
-            with self.viewer.txn() as txn:
-                del txn.layers["selection"]
-                del txn.layers["deleting"]
+            update_viewer_state(self.viewer, {"selection": None,
+                                              self.deleting_layer.name: None})
+
+    def restore_deleting_points(self):
+        """Put the points in the delete bucket back with the regular points"""
+        if self.deleting_points is not None:
+            self.points.add(self.deleting_points)
+            self.deleting_points = None
 
     @property
     def all_points(self):
         """Both the regular points and those in the delete bucket"""
         if self.deleting_points is not None:
-            return np.vstack((self.points, self.deleting_points))
+            return np.vstack((self.points.array, self.deleting_points))
         else:
-            return self.points
+            return self.points.array
 
     def save(self):
         post_message_immediately(
@@ -325,9 +365,8 @@ class NuggtViewer:
         """Reposition the UI between the given coordinates
 
         """
-        self.points = self.all_points
+        self.restore_deleting_points()
         self.box_coords = None
-        self.deleting_points = None
         self.x0 = x0
         self.x1 = x1
         self.y0 = y0
@@ -335,44 +374,31 @@ class NuggtViewer:
         self.z0 = z0
         self.z1 = z1
         self.display()
+        if self.prefetcher is not None:
+            self.prefetcher.prefetch_around(self.window_coords)
 
-def load_one_plane(imgpath, tfpath, x0, x1, y0, y1, z):
-    plane = tifffile.imread(imgpath)[y0:y1, x0:x1]
-    height, width = plane.shape
-    a = np.memmap(tfpath, dtype=plane.dtype,
-                  offset=height * width * z * plane.dtype.itemsize,
-                  shape=plane.shape)
-    a[:] = plane
-    return height, width, plane.dtype
-
-
-def load_image(path, x0=0, x1=None, y0=0, y1=None, z0=0, z1=None):
-    filenames = sorted(glob.glob(path))
-    if len(filenames) > 1:
-        if sys.prefix.startswith("linux"):
-            tempdir = "/dev/shm"
-        else:
-            tempdir = tempfile.tempdir
-        with tempfile.NamedTemporaryFile(
-                dir=tempdir,
-                prefix="proc_%d_" % os.getpid(),
-                suffix=".shm") as tf:
-            tfpath = tf.name
-            futures = []
-            with multiprocessing.Pool(6) as pool:
-                for z in range(z0, z1):
-                    futures.append(pool.apply_async(
-                        load_one_plane,
-                        (filenames[z], tfpath, x0, x1, y0, y1, z-z0)))
-                for future in tqdm.tqdm(futures):
-                    height, width, dtype = future.get()
-            result = np.memmap(tfpath,
-                               dtype=dtype,
-                               shape=(z1-z0, height, width)).copy()
-    else:
-        result = tifffile.imread(filenames[0])
-    return result.astype(np.float32)
+    @property
+    def window_coords(self):
+        """The (x0, x1, y0, y1, z0, z1) of the edit window"""
+        return (self.x0, self.x1, self.y0, self.y1, self.z0, self.z1)
+
+    def start_prefetching(self, visited=()):
+        """Read the windows around the edit window in the background
 
+        The windows adjoining the edit window are read into the image
+        caches after each reposition, so that jumping to one of them is
+        fast. Precomputed images are not prefetched.
+
+        :param visited: the windows visited so far, as (x0, x1, y0, y1, z0,
+        z1) tuples. Windows not yet visited are prefetched first.
+        """
+        paths = [_ for _ in (self.img_path, self.alt_img_path, self.seg_path)
+                 if _ is not None and not _.startswith("precomputed:")]
+        self.prefetcher = WindowPrefetcher(
+            [self.volume(_) for _ in paths],
+            (self.x_extent, self.y_extent, self.z_extent),
+            visited=visited)
+        self.prefetcher.prefetch_around(self.window_coords)
 
 class NavViewer(NGReference):
 
@@ -510,8 +536,8 @@ def main():
     print("Editing viewer: %s" % viewer.viewer.get_viewer_url())
     webbrowser.open_new(viewer.viewer.get_viewer_url())
     if args.reference_image is not None:
-        ref_img = tifffile.imread(args.reference_image).astype(np.float32)
-        ref_seg = tifffile.imread(args.reference_segmentation).astype(np.uint16)
+        ref_img = TiffVolume(args.reference_image)
+        ref_seg = TiffVolume(args.reference_segmentation)
         with open(args.point_correspondence_file) as fd:
             d = json.load(fd)
         moving = np.array(d["moving"])
@@ -521,13 +547,19 @@ def main():
         nav_viewer.bind()
         if args.repositioning_log_file is not None:
             nav_viewer.repositioning_log_file = args.repositioning_log_file
+        if args.repositioning_log_file is not None and \
+                os.path.exists(args.repositioning_log_file):
+            viewer.start_prefetching(
+                read_repositioning_log(args.repositioning_log_file))
+        else:
+            viewer.start_prefetching()
         sample = np.random.permutation(len(viewer.points))[:10000]
         if args.reference_points is not None:
             with open(args.reference_points) as fd:
                 rp = np.array(json.load(fd))
                 pts = rp[sample, ::-1]
         else:
-            pts = viewer.points[sample, ::-1]
+            pts = viewer.points.array[sample, ::-1]
         nav_viewer.add_points(pts)
         print("Navigating viewer: %s" % nav_viewer.viewer.get_viewer_url())
     print("Hit control-c to exit")
@@ -0,0 +1,49 @@
+"""make_precomputed_annotations - write points as a neuroglancer source
+
+The points are written in neuroglancer's precomputed annotation format with
+a multi-level spatial index, so that millions of points can be displayed.
+The output directory can be given to nuggt-display's --points option.
+"""
+
+import argparse
+import sys
+
+from .utils.precomputed_annotations import read_points_file, \
+    write_point_annotations, DEFAULT_LIMIT
+
+
+def parse_args(args=sys.argv[1:]):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--points",
+                        help="A .json or .npy file of points in Z, Y, X "
+                        "order",
+                        required=True)
+    parser.add_argument("--output",
+                        help="The directory to write the annotations to",
+                        required=True)
+    parser.add_argument("--xyz",
+                        action="store_true",
+                        help="Points are stored in x, y, z order")
+    parser.add_argument("--voxel-size",
+                        help="The size of a voxel in microns in x, y, z "
+                        "order, e.g. \"1.8,1.8,2.0\"",
+                        default="1,1,1")
+    parser.add_argument("--limit",
+                        help="The most points per chunk of the spatial index",
+                        type=int,
+                        default=DEFAULT_LIMIT)
+    return parser.parse_args(args)
+
+
+def main():
+    args = parse_args()
+    points = read_points_file(args.points)
+    if not args.xyz:
+        points = points[:, ::-1]
+    voxel_size = [float(_) for _ in args.voxel_size.split(",")]
+    write_point_annotations(args.output, points, voxel_size,
+                            limit=args.limit)
+
+
+if __name__ == "__main__":
+    main()
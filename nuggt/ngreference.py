@@ -20,14 +20,18 @@ class NGReference(abc.ABC):
         ya = np.linspace(0, moving_shape[1], 10)
         xa = np.linspace(0, moving_shape[2], 10)
         self.warp_to_ref = Warper(moving_pts, ref_pts).approximate(za, ya, xa)
+        #
+        # Invert the moving -> reference grid rather than fitting a second
+        # warper so that the two directions agree.
+        #
         za = np.linspace(0, ref_img.shape[0], 10)
         ya = np.linspace(0, ref_img.shape[1], 10)
         xa = np.linspace(0, ref_img.shape[2] , 10)
-        self.warp_to_moving = \
-            Warper(ref_pts, moving_pts).approximate(za, ya, xa)
+        self.warp_to_moving = self.warp_to_ref.inverse(za, ya, xa)
 
         with self.viewer.txn() as txn:
-            layer(txn, "image", ref_img, gray_shader, 1.0)
+            layer(txn, "image", ref_img, gray_shader,
+                  scale_multiplier(ref_img, 1.0))
             seglayer(txn, "segmentation", ref_seg)
 
     def add_points(self, points, layer_name="annotation", layer_color="yellow"):
@@ -46,6 +50,11 @@ class NGReference(abc.ABC):
     def on_action(self, s):
         point = s.mouse_voxel_coordinates
         moving_point = self.warp_to_moving(point[::-1].reshape(1, 3)).reshape(3)
+        if np.any(np.isnan(moving_point)):
+            with self.viewer.config_state.txn() as txn:
+                txn.status_messages["jumping"] = \
+                    "That point is outside of the moving image"
+            return
         self.action_handler(s, moving_point)
 
     @abc.abstractmethod
@@ -1,6 +1,7 @@
 import numpy as np
 import neuroglancer
 from nuggt.utils.ngutils import *
+from nuggt.utils.point_store import PointStore
 
 def to_um(scale:neuroglancer.DimensionScale):
     if scale.unit == 'm':
@@ -18,7 +19,7 @@ class PointAnnotator:
 
     def __init__(self, viewer, color="yellow", name="points", voxel_size=default_voxel_size):
         self.name = name
-        self.points = np.zeros((0, 3))
+        self.points = PointStore()
         self.voxel_size = default_voxel_size
         self.deleting_points = np.zeros((0, 3))
         self.viewer = viewer
@@ -41,7 +42,7 @@ class PointAnnotator:
             s.input_event_bindings.viewer["shift+keyx"] = "delete-selected"
 
     def set_points(self, points, txn=None):
-        self.points = points
+        self.points = PointStore(points)
         if txn is None:
             self.display_points()
         else:
@@ -52,8 +53,9 @@ class PointAnnotator:
             self.display_points_txn(txn)
 
     def display_points_txn(self, txn):
-        pointlayer(txn, self.name, self.points[:, 2], self.points[:, 1],
-                   self.points[:, 0], self.color,
+        points = self.points.array
+        pointlayer(txn, self.name, points[:, 2], points[:, 1],
+                   points[:, 0], self.color,
                    voxel_size=self.voxel_size)
         if self.deleting_points is not None:
             pointlayer(txn, "delete-%s" % self.name,
@@ -82,42 +84,22 @@ class PointAnnotator:
         if len(neighbors) > 0:
             self.say("Point too close to some other point!", "annotation")
             return
-        self.points = np.vstack((self.points, point))
+        self.points.add(point)
         self.display_points()
         self.say("Added point at %.2f, %.2f, %.2f" %
                  (point[0], point[1], point[2]),
             "annotation")
 
-    def find_nearby_points(self, point, return_index=False):
-        if len(self.points) == 0:
-            if return_index:
-                return np.zeros((0, 3), np.float32), np.zeros(0, int)
-            else:
-                return np.zeros((0, 3), np.float32)
-
-        diff = self.points - point[np.newaxis, :]
-        distances = np.sqrt(np.sum(np.square(diff), 1))
-        indexes = np.where(distances < self.min_distance)[0]
-        if len(indexes) == 0:
-            if return_index:
-                return np.zeros((0, 3), np.float32), np.zeros(0, int)
-            else:
-                return np.zeros((0, 3), np.float32)
-        result = self.points[indexes]
-        order = np.argsort(distances[indexes])
-        if return_index:
-            return result[order], indexes[order]
-        else:
-            return result[order]
+    def find_nearby_points(self, point):
+        """The points closer than the minimum distance, nearest first"""
+        return self.points.nearby(point, self.min_distance)
 
     def on_delete_point(self, s):
         point = np.array(s.mouse_voxel_coordinates)[::-1]
-        neighbors, indexes = self.find_nearby_points(point, return_index=True)
-        if len(neighbors) == 0:
+        to_delete = self.points.remove_nearest(point, self.min_distance)
+        if to_delete is None:
             self.say("No nearby point", "delete")
             return
-        to_delete = self.points[indexes[0]]
-        self.points = np.delete(self.points, indexes[0], 0)
         self.display_points()
         self.say("Deleting %.2f, %.2f, %.2f" %
             (to_delete[0], to_delete[1], to_delete[2]), "delete")
@@ -130,11 +112,10 @@ class PointAnnotator:
         (x0, x1), (y0, y1), (z0, z1) = [
             [fn(self.box_coords[0][idx], self.box_coords[1][idx])
              for fn in (min, max)] for idx in range(3)]
-        all_points = self.all_points
-        mask = (all_points[:, 0] >= x0) & (all_points[:, 0] < x1) & \
-               (all_points[:, 1] >= y0) & (all_points[:, 1] < y1) & \
-               (all_points[:, 2] >= z0) & (all_points[:, 2] < z1)
-        self.points, self.deleting_points = all_points[~mask], all_points[mask]
+        if self.deleting_points is not None:
+            self.points.add(self.deleting_points)
+        self.deleting_points = self.points.remove_box((x0, y0, z0),
+                                                      (x1, y1, z1))
         self.display_points()
 
     def start_selection_handler(self, s):
@@ -165,6 +146,6 @@ class PointAnnotator:
     def all_points(self):
         """Both the regular points and those in the delete bucket"""
         if self.deleting_points is not None:
-            return np.vstack((self.points, self.deleting_points))
+            return np.vstack((self.points.array, self.deleting_points))
         else:
-            return self.points
+            return self.points.array
@@ -10,6 +10,7 @@ import tifffile
 import tqdm
 
 from .utils.warp import Warper
+from .utils.warp_cache import WarpCache, add_cache_argument
 
 def parse_args(args=sys.argv[1:]):
     parser = argparse.ArgumentParser(
@@ -59,6 +60,31 @@ def parse_args(args=sys.argv[1:]):
         default=100,
         type=int
     )
+    parser.add_argument(
+        "--spline-order",
+        help="The order of the approximation spline: 1 for linear or 3 "
+             "for cubic B-splines. Cubic splines are more accurate, so a "
+             "larger --grid-spacing can be used with them.",
+        default=1,
+        type=int,
+        choices=(1, 3)
+    )
+    parser.add_argument(
+        "--max-error",
+        help="If specified, refine the approximation grid until the "
+             "approximation is within this many voxels of the exact warp. "
+             "--grid-spacing then gives the spacing of the starting grid.",
+        default=None,
+        type=float
+    )
+    parser.add_argument(
+        "--double-precision",
+        help="Compute the warp in double precision. By default, the "
+             "approximation grid is single precision which is more than "
+             "accurate enough to pick the nearest voxel and is faster.",
+        action="store_true"
+    )
+    add_cache_argument(parser)
     parser.add_argument(
         "--silent",
         help="Don't display the progress bar",
@@ -84,7 +110,9 @@ The warper converts coordinates in the output space to that of the segmentation
 WARPER = None
 
 
-def make_warper(alignment, downsample_factor, grid_spacing, output_shape):
+def make_warper(alignment, downsample_factor, grid_spacing, output_shape,
+                spline_order=1, warp_cache=None, max_error=None,
+                dtype=np.float32):
     """
     Make the global warper for translating between the reference and moving
     frames of reference.
@@ -93,6 +121,12 @@ def make_warper(alignment, downsample_factor, grid_spacing, output_shape):
     :param downsample_factor: How much to downsample the moving coordinates
     :param grid_spacing: the grid spacing of the approximator
     :param output_shape: the shape of the output volume
+    :param spline_order: 1 for linear or 3 for cubic approximation splines
+    :param warp_cache: a directory for caching the approximator between runs
+    or None to not cache it.
+    :param max_error: refine the grid until the approximation error is at
+    most this many voxels or None to use the grid as given.
+    :param dtype: the floating-point type of the approximation grid
     :return:
     """
     global WARPER
@@ -105,8 +139,14 @@ def make_warper(alignment, downsample_factor, grid_spacing, output_shape):
             z / downsample_factor)
            for x, y, z in alignment["moving"]]
     dest = alignment["reference"]
-    warper = Warper(src, dest)
-    approximator = warper.approximate(za, ya, xa)
+    if warp_cache is None:
+        warper = Warper(src, dest)
+        approximator = warper.approximate(za, ya, xa, order=spline_order,
+                                          tolerance=max_error, dtype=dtype)
+    else:
+        approximator = WarpCache(warp_cache).approximate(
+            src, dest, (za, ya, xa), order=spline_order,
+            tolerance=max_error, dtype=dtype)
     WARPER = approximator
 
 
@@ -128,26 +168,9 @@ def get_stack_dimensions(stack, downsample_factor):
 
 
 def write_one_z(z, dim, path, compress):
-    y, x = np.mgrid[0:dim[0], 0:dim[1]]
-    zz = np.ones(dim, int) * z
-    zf, yf, xf = [_.flatten() for _ in (zz, y, x)]
-    batch_size = 10000
-    rx, ry, rz = [ [] for _ in range(3)]
-    for i0 in range(0, np.prod(dim), batch_size):
-        i1 = min(np.prod(dim), i0+batch_size)
-        rzi, ryi, rxi = \
-            WARPER(np.column_stack((zf[i0:i1], yf[i0:i1], xf[i0:i1])))\
-                .transpose()
-        rx.append(rxi)
-        ry.append(ryi)
-        rz.append(rzi)
-    rx, ry, rz = [np.hstack(_) for _ in (rx, ry, rz)]
-    # Make NaN into out-of-bounds so they get set to zero
-    rx[np.isnan(rx)] = -1
-    ry[np.isnan(ry)] = -1
-    rz[np.isnan(rz)] = -1
-    rx, ry, rz = [np.round(_.reshape(dim)).astype(np.int32)
-                  for _ in (rx, ry, rz)]
+    # NaN coordinates are rounded to -1, out-of-bounds, so they get set to zero
+    rz, ry, rx = WARPER.warp_plane(
+        z, dim, out=np.zeros((3, dim[0], dim[1]), np.int32))
     img = map_coordinates(SEG, [rz, ry, rx], order=0, cval=0).astype(SEG.dtype)
     tifffile.imsave(path, img, compress=compress)
 
@@ -185,7 +208,9 @@ def main(argv=sys.argv[1:]):
         alignment = json.load(fd)
     output_dim = get_stack_dimensions(args.stack, args.downsample_factor)
     make_warper(alignment, args.downsample_factor, args.grid_spacing,
-                output_dim)
+                output_dim, args.spline_order, args.warp_cache,
+                args.max_error,
+                np.float64 if args.double_precision else np.float32)
     write_output(args.output, output_dim, args.silent, args.n_cores,
                  args.compress)
 
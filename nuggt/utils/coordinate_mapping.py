@@ -0,0 +1,61 @@
+"""coordinate_mapping - map points between the moving and original images
+
+The moving image that nuggt-align aligns is typically made from a full-size
+original image by transposing, shrinking and flipping it (see
+transpose-flip and rescale-image-for-alignment). Those steps amount to an
+affine transform, which is computed once so that any number of points can be
+mapped with one matrix product.
+"""
+
+import numpy as np
+
+
+class CoordinateMapping:
+    """An affine mapping between moving image and original image coordinates
+
+    Points are N x 3 arrays in z, y, x order. Original image coordinates are
+    in the units of the original image's voxel size, e.g. microns.
+    """
+
+    def __init__(self, moving_shape, original_shape, voxel_size,
+                 flip=(False, False, False), indices=(0, 1, 2)):
+        """Constructor
+
+        :param moving_shape: the shape of the moving image
+        :param original_shape: the shape of the original image
+        :param voxel_size: the size of a voxel of the original image in
+        z, y, x order
+        :param flip: whether the z, y and x axes were flipped in making the
+        moving image
+        :param indices: the indices of the z, y and x coordinates in the
+        moving image, e.g. (2, 1, 0) if the x and z axes were transposed.
+        """
+        moving_shape = np.asarray(moving_shape, float)
+        original_shape = np.asarray(original_shape, float)
+        voxel_size = np.asarray(voxel_size, float)
+        indices = np.asarray(indices)
+        extent = original_shape[indices] * voxel_size[indices]
+        scale = extent[indices] / moving_shape[indices]
+        flip = np.asarray(flip, bool)
+        self.matrix = np.zeros((3, 3))
+        self.matrix[np.arange(3), indices] = np.where(flip, -scale, scale)
+        self.offset = np.where(flip, moving_shape[indices] * scale, 0)
+        self.inverse_matrix = np.linalg.inv(self.matrix)
+
+    def moving_to_original(self, points):
+        """Map points in the moving image to the original image
+
+        :param points: an N x 3 array of points or a single point
+        :returns: an N x 3 array of the points in the original image
+        """
+        points = np.atleast_2d(np.asarray(points, float))
+        return np.dot(points, self.matrix.transpose()) + self.offset
+
+    def original_to_moving(self, points):
+        """Map points in the original image to the moving image
+
+        :param points: an N x 3 array of points or a single point
+        :returns: an N x 3 array of the points in the moving image
+        """
+        points = np.atleast_2d(np.asarray(points, float))
+        return np.dot(points - self.offset, self.inverse_matrix.transpose())
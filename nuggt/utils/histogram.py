@@ -0,0 +1,116 @@
+"""histogram - estimate the percentiles of large images in one pass
+
+numpy.percentile partitions a copy of the whole image, which is slow and
+doubles the memory of a large volume. An ImageHistogram instead counts the
+image's values a few planes at a time and answers any percentile from the
+counts.
+
+8 and 16-bit integer images are counted per value, so their percentiles
+are exact. Other images take two passes: the first finds the range of the
+values and the second counts them in fixed-width bins, keeping the mean
+value of each bin. A percentile is then exact if no two distinct values
+that bracket it share a bin and is otherwise off by at most the width of a
+bin, (max - min) / n_bins.
+"""
+
+import numpy as np
+
+"""The default number of bins for images whose values are not all counted"""
+DEFAULT_BINS = 65536
+
+"""The default number of voxels to count at a time"""
+DEFAULT_CHUNK_VOXELS = 16 * 1024 * 1024
+
+
+def iter_chunks(img, chunk_voxels=DEFAULT_CHUNK_VOXELS):
+    """Iterate over an image as blocks of whole planes
+
+    :param img: a Numpy array, memory-mapped array or TiffVolume
+    :param chunk_voxels: the most voxels per block, but at least one plane
+    :returns: an iterator of the blocks as Numpy arrays
+    """
+    if img.ndim == 0 or img.shape[0] == 0:
+        yield np.asarray(img).ravel()
+        return
+    plane_voxels = max(1, int(np.prod(img.shape[1:])))
+    step = max(1, chunk_voxels // plane_voxels)
+    for start in range(0, img.shape[0], step):
+        yield np.asarray(img[start:start + step])
+
+
+class ImageHistogram:
+    """A histogram of an image's values for estimating its percentiles"""
+
+    def __init__(self, img, n_bins=DEFAULT_BINS,
+                 chunk_voxels=DEFAULT_CHUNK_VOXELS):
+        """Constructor
+
+        :param img: a Numpy array, memory-mapped array or TiffVolume
+        :param n_bins: the number of bins for images other than 8 and 16-bit
+        integer images
+        :param chunk_voxels: the number of voxels to count at a time
+        """
+        dtype = np.dtype(img.dtype)
+        if dtype.kind == "b" or (dtype.kind in ("i", "u") and
+                                 dtype.itemsize <= 2):
+            offset = 0 if dtype.kind == "b" else np.iinfo(dtype).min
+            n_values = 2 if dtype.kind == "b" else 2 ** (8 * dtype.itemsize)
+            counts = np.zeros(n_values, np.int64)
+            for chunk in iter_chunks(img, chunk_voxels):
+                chunk = chunk.ravel()
+                if dtype.kind != "u":
+                    chunk = chunk.astype(np.int64) - offset
+                counts += np.bincount(chunk, minlength=n_values)
+            values = np.arange(n_values, dtype=float) + offset
+            self.max = float(values[counts > 0][-1]) \
+                if np.any(counts > 0) else 0.0
+        else:
+            lo, hi = np.inf, -np.inf
+            for chunk in iter_chunks(img, chunk_voxels):
+                chunk = chunk[np.isfinite(chunk)]
+                if len(chunk) > 0:
+                    lo = min(lo, float(np.min(chunk)))
+                    hi = max(hi, float(np.max(chunk)))
+            counts = np.zeros(n_bins, np.int64)
+            sums = np.zeros(n_bins)
+            if lo <= hi:
+                scale = n_bins / (hi - lo) if hi > lo else 0.0
+                for chunk in iter_chunks(img, chunk_voxels):
+                    chunk = chunk[np.isfinite(chunk)].astype(float)
+                    bins = np.minimum(((chunk - lo) * scale).astype(np.int64),
+                                      n_bins - 1)
+                    counts += np.bincount(bins, minlength=n_bins)
+                    sums += np.bincount(bins, weights=chunk,
+                                        minlength=n_bins)
+            values = sums / np.maximum(counts, 1)
+            self.max = hi if lo <= hi else 0.0
+        nonzero = counts > 0
+        self.values = values[nonzero]
+        self.counts = counts[nonzero]
+        self.cumulative = np.cumsum(self.counts)
+
+    def __len__(self):
+        """The number of values counted"""
+        return int(self.cumulative[-1]) if len(self.cumulative) > 0 else 0
+
+    def value(self, rank):
+        """The value at a rank, the rank'th smallest value counting from 0"""
+        idx = np.searchsorted(self.cumulative, rank, side="right")
+        return self.values[min(idx, len(self.values) - 1)]
+
+    def percentile(self, percentile):
+        """Estimate a percentile of the image
+
+        The percentile is interpolated between values as numpy.percentile
+        does by default.
+
+        :param percentile: the percentile, from 0 to 100
+        :returns: the value at that percentile, or 0 for an empty image
+        """
+        if len(self) == 0:
+            return 0.0
+        rank = percentile / 100 * (len(self) - 1)
+        low = int(np.floor(rank))
+        v0 = self.value(low)
+        v1 = self.value(low + 1)
+        return float(v0 + (rank - low) * (v1 - v0))
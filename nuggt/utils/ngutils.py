@@ -7,6 +7,9 @@ import numpy as np
 import neuroglancer
 import requests
 import typing
+from .histogram import ImageHistogram
+from .precomputed_image import serve_volume, precomputed_dtype
+from .tiff_volume import TiffVolume
 
 class Shader:
 
@@ -100,23 +103,49 @@ if not hasattr(neuroglancer.PointAnnotationLayer, "annotation_color"):
 
 default_voxel_size = 1,1,1
 
+"""The most points to put inline in the viewer state
+
+Larger point sets should be served as precomputed annotations, see
+nuggt.utils.precomputed_annotations.serve_points.
+"""
+INLINE_POINT_LIMIT = 50000
+
 
 def soft_max_brightness(img, percentile=99.9):
     """
     Compute a soft maximum brightness for an image based on almost all the
     voxels
 
-    :param img: The image to compute
+    :param img: The image to compute or its ImageHistogram. Pass the
+    histogram to compute the brightness repeatedly without rereading the
+    image.
     :param percentile: the percentile to use - pick the brightness at this
     percentile
     :return: the soft max brightness
     """
-    result = np.percentile(img, percentile)
+    histogram = img if isinstance(img, ImageHistogram) \
+        else ImageHistogram(img)
+    result = histogram.percentile(percentile)
     if result == 0:
-        result = max(np.finfo(np.float32).eps, np.max(img))
+        result = max(np.finfo(np.float32).eps, histogram.max)
     return result
 
 
+def scale_multiplier(img, multiplier):
+    """Scale a multiplier so integer images look as they would as floats
+
+    Neuroglancer normalizes integer data by the maximum value of its
+    type, but shows floating-point data as is.
+
+    :param img: the image or its URL
+    :param multiplier: the multiplier for the image as floating-point data
+    :returns: the multiplier to display the image with
+    """
+    if not isinstance(img, str) and img.dtype.kind in ("i", "u"):
+        return multiplier * np.iinfo(img.dtype).max
+    return multiplier
+
+
 def reverse_dimensions(img):
     for di in range(img.ndim-1):
         img = np.moveaxis(img, 0, img.ndim - 1 - di)
@@ -125,39 +154,63 @@ def reverse_dimensions(img):
 
 def layer(txn, name, img, shader=None, multiplier=1.0, 
           dimensions=None, offx=0, offy=0, offz=0,
-          voxel_size=default_voxel_size):
+          voxel_size=default_voxel_size,
+          multiscale=False, pyramid_cache=False):
     """Add an image layer to Neuroglancer
 
     :param txn: The transaction context of the viewer.
     :param name: The name of the layer as displayed in Neuroglancer.
-    :param img: The image to display in TCZYX order.
+    :param img: The image to display in TCZYX order. A TiffVolume is
+    served from the source server a chunk at a time instead of being read
+    into memory, with a multiresolution pyramid. Arrays are shown in their
+    own data type, without copying, unless neuroglancer can't display it.
     :param shader: the shader to use when displaying, e.g. gray_shader
     :param multiplier: the multiplier to apply to the normalized data value.
     This can be used to brighten or dim the image.
+    :param voxel_size: the size of a voxel (x, y, z) of a TiffVolume or
+    of a 3D array if no dimensions are given
+    :param multiscale: if True, serve a 3D Numpy array with a
+    multiresolution pyramid, like a TiffVolume. The array must not change
+    afterwards.
+    :param pyramid_cache: if True, keep the pyramid of a TiffVolume in a
+    directory next to its files so that it is only made once.
+    :returns: the layer's source - the URL or the neuroglancer.LocalVolume
+    serving the image, which can be invalidated if the image changes.
     """
 
     if isinstance(img, str):
         source=img
 
+    elif isinstance(img, TiffVolume):
+        source = serve_volume(img, voxel_size, sidecar=pyramid_cache)
+
     else:
         if dimensions is None:
             dim_names = ["xyzct"[d] for d in range(img.ndim)]
             dim_units = ["µm"] * img.ndim
-            dim_scales = [1.0] * img.ndim
+            dim_scales = list(voxel_size) if img.ndim == 3 \
+                else [1.0] * img.ndim
 
             dimensions = neuroglancer.CoordinateSpace(
                 names=dim_names,
                 units=dim_units,
                 scales=dim_scales)
 
-        source = neuroglancer.LocalVolume(
-                    data=reverse_dimensions(img),
-                    dimensions=dimensions,
-                    voxel_offset=(offx, offy, offz))
+        if multiscale and img.ndim == 3:
+            source = serve_volume(img, np.asarray(dimensions.scales) * 1e6)
+        else:
+            if img.dtype != precomputed_dtype(img.dtype):
+                img = img.astype(precomputed_dtype(img.dtype))
+            source = neuroglancer.LocalVolume(
+                data=reverse_dimensions(img),
+                dimensions=dimensions,
+                voxel_offset=(offx, offy, offz),
+                volume_type="image")
 
     shader = shader or gray_shader
 
     txn.layers[name] = neuroglancer.ImageLayer(source=source, shader=shader % multiplier)
+    return source
 #    txn.layers.append(
 #        name=name,
 #        layer=neuroglancer.ImageLayer(
@@ -166,33 +219,67 @@ def layer(txn, name, img, shader=None, multiplier=1.0,
 #    )
 
 
+def unsigned_segmentation(seg):
+    """Get a segmentation as unsigned integers, without copying if possible
+
+    :param seg: the segmentation
+    :returns: the segmentation itself if unsigned, a view of it as unsigned
+    integers of the same size if signed or boolean and otherwise a copy
+    converted to uint32.
+    """
+    if seg.dtype.kind == "u":
+        return seg
+    if seg.dtype.kind in ("i", "b"):
+        return seg.view("u%d" % seg.dtype.itemsize)
+    return seg.astype(np.uint32)
+
+
 def seglayer(txn, name, seg, 
              dimensions=None, offx=0, offy=0, offz=0,
-             voxel_size=default_voxel_size):
+             voxel_size=default_voxel_size,
+             multiscale=False, pyramid_cache=False):
     """Add a segmentation layer
 
     :param txn: the neuroglancer transaction
     :param name: the display name of the segmentation
-    :param seg: the segmentation to display
+    :param seg: the segmentation to display. A TiffVolume is served from
+    the source server a chunk at a time instead of being read into memory,
+    with a multiresolution pyramid.
+    :param voxel_size: the size of a voxel (x, y, z) of a TiffVolume or
+    of a 3D array if no dimensions are given
+    :param multiscale: if True, serve a 3D Numpy array with a
+    multiresolution pyramid, like a TiffVolume. The array must not change
+    afterwards.
+    :param pyramid_cache: if True, keep the pyramid of a TiffVolume in a
+    directory next to its files so that it is only made once.
     """
     if isinstance(seg, str):
         source = seg
 
+    elif isinstance(seg, TiffVolume):
+        source = serve_volume(seg, voxel_size, volume_type="segmentation",
+                              sidecar=pyramid_cache)
+
     else:
         if dimensions is None:
             dim_names = ["xyzct"[d] for d in range(seg.ndim)]
             dim_units = ["µm"] * seg.ndim
-            dim_scales = [1.0] * seg.ndim
+            dim_scales = list(voxel_size) if seg.ndim == 3 \
+                else [1.0] * seg.ndim
 
             dimensions = neuroglancer.CoordinateSpace(
                 names=dim_names,
                 units=dim_units,
                 scales=dim_scales)
 
-        source = neuroglancer.LocalVolume(
-            data=reverse_dimensions(seg.astype(np.uint16)),
-            dimensions=dimensions,
-            voxel_offset=(offx, offy, offz))
+        if multiscale and seg.ndim == 3:
+            source = serve_volume(seg, np.asarray(dimensions.scales) * 1e6,
+                                  volume_type="segmentation")
+        else:
+            source = neuroglancer.LocalVolume(
+                data=reverse_dimensions(unsigned_segmentation(seg)),
+                dimensions=dimensions,
+                voxel_offset=(offx, offy, offz))
 
     txn.layers[name] = neuroglancer.SegmentationLayer(source=source)
             
@@ -207,7 +294,8 @@ def pointlayer(txn, name, x, y, z,
                color="yellow",
                size=5,
                shader=pointlayer_shader,
-               voxel_size=default_voxel_size):
+               voxel_size=default_voxel_size,
+               colors=None):
     """Add a point layer.
 
     :param txn: the neuroglancer viewer transaction context
@@ -218,6 +306,8 @@ def pointlayer(txn, name, x, y, z,
     :param color: the color of the points in the layer, e.g. "red", "yellow"
     :param size: the size of the points
     :param voxel_size: the size of a voxel (x, y, z)
+    :param colors: a color per point, e.g. "#ff0000", overriding the color
+    of the layer.
     """
 
     dimensions = neuroglancer.CoordinateSpace(
@@ -225,6 +315,10 @@ def pointlayer(txn, name, x, y, z,
         units=["µm", "µm", "µm"],
         scales=voxel_size
     )
+    if colors is None:
+        props = [None] * len(x)
+    else:
+        props = [[c, float(size)] for c in colors]
     layer = neuroglancer.LocalAnnotationLayer(
         dimensions=dimensions,
         annotation_properties=[
@@ -242,13 +336,221 @@ def pointlayer(txn, name, x, y, z,
         annotations=[
             neuroglancer.PointAnnotation(
                 id=i + 1,
-                point=[zz, yy, xx]) # input points should be in zyx order
-            for i, (xx, yy, zz) in enumerate(zip(x, y, z))
+                point=[zz, yy, xx], # input points should be in zyx order
+                props=p)
+            for i, (xx, yy, zz, p) in enumerate(zip(x, y, z, props))
         ],
         shader=shader
     )
     txn.layers[name]=layer
 
+
+def annotation_source_layer(txn, name, source, color="yellow"):
+    """Add a layer showing an annotation source, e.g. from serve_points
+
+    :param txn: the neuroglancer viewer transaction context
+    :param name: the displayable name of the layer
+    :param source: the URL of the annotation source
+    :param color: the color of the annotations
+    """
+    txn.layers[name] = neuroglancer.AnnotationLayer(source=source,
+                                                    annotation_color=color)
+
+
+def update_viewer_state(viewer, layers=None, position=None):
+    """Replace layers and the position of a viewer without a transaction
+
+    A viewer transaction deep-copies the whole viewer state and compares it
+    with the old one, which is slow when layers hold many annotations. This
+    makes a new state that shares everything but the given layers with the
+    current one.
+
+    :param viewer: the neuroglancer viewer
+    :param layers: a dictionary of layer name to the layer, either a
+    neuroglancer layer or its JSON. A layer of None deletes the layer.
+    :param position: the new position of the viewer or None to leave it
+    """
+    if layers is None:
+        layers = {}
+    layers = dict([(name, None if value is None else dict(
+        neuroglancer.json_wrappers.to_json(value), name=name))
+        for name, value in layers.items()])
+    for retry in range(10):
+        raw_state, generation = viewer.shared_state.raw_state_and_generation
+        new_state = raw_state.copy()
+        new_layers = []
+        remaining = dict(layers)
+        for layer_json in raw_state.get("layers", []):
+            name = layer_json["name"]
+            if name not in remaining:
+                new_layers.append(layer_json)
+            elif remaining[name] is not None:
+                new_layers.append(remaining.pop(name))
+            else:
+                del remaining[name]
+        new_layers += [_ for _ in remaining.values() if _ is not None]
+        new_state["layers"] = new_layers
+        if position is not None:
+            new_state["position"] = [float(_) for _ in position]
+        try:
+            viewer.shared_state.set_state(
+                new_state, existing_generation=generation)
+            return
+        except neuroglancer.trackable_state.ConcurrentModificationError:
+            if retry == 9:
+                raise
+
+
+class PointLayerManager:
+    """Keep a point annotation layer in step with per-point edits
+
+    The manager keeps the JSON of each point annotation by a stable ID, so
+    adding or removing a point changes one entry instead of rebuilding an
+    annotation object per point. update() replaces just this layer in the
+    viewer state. Points added without an ID are numbered in the order they
+    are added and can be removed by their coordinates.
+    """
+
+    def __init__(self, viewer, name,
+                 color="yellow",
+                 size=5,
+                 shader=pointlayer_shader,
+                 voxel_size=default_voxel_size):
+        """Constructor
+
+        :param viewer: the neuroglancer viewer that shows the layer
+        :param name: the displayable name of the point layer
+        :param color: the color of the points in the layer
+        :param size: the size of the points
+        :param shader: the annotation shader
+        :param voxel_size: the size of a voxel (x, y, z)
+        """
+        self.viewer = viewer
+        self.name = name
+        self.size = size
+        self.annotations = {}
+        self.ids_by_point = {}
+        self.next_id = 0
+        dimensions = neuroglancer.CoordinateSpace(
+            names=["x", "y", "z"],
+            units=["µm", "µm", "µm"],
+            scales=voxel_size
+        )
+        self.template = neuroglancer.LocalAnnotationLayer(
+            dimensions=dimensions,
+            annotation_properties=[
+                neuroglancer.AnnotationPropertySpec(
+                    id='color',
+                    type='rgb',
+                    default=color,
+                ),
+                neuroglancer.AnnotationPropertySpec(
+                    id='size',
+                    type='float32',
+                    default=float(size),
+                )
+            ],
+            shader=shader
+        ).to_json()
+
+    def __len__(self):
+        return len(self.annotations)
+
+    def __contains__(self, ident):
+        return ident in self.annotations
+
+    def add(self, x, y, z, ident=None, color=None):
+        """Add or move a point
+
+        :param x: the point's x coordinate
+        :param y: the point's y coordinate
+        :param z: the point's z coordinate
+        :param ident: the point's ID. Defaults to a new ID.
+        :param color: the point's color, e.g. "#ff0000", overriding the
+        color of the layer.
+        :returns: the point's ID
+        """
+        if ident is None:
+            ident = "p%d" % self.next_id
+            self.next_id += 1
+        else:
+            self.remove(ident)
+        point = (float(x), float(y), float(z))
+        annotation = dict(type="point",
+                          id=ident,
+                          point=list(point[::-1]))
+        if color is not None:
+            annotation["props"] = [color, float(self.size)]
+        self.annotations[ident] = annotation
+        self.ids_by_point[point] = ident
+        return ident
+
+    def remove(self, ident):
+        """Remove a point, if present
+
+        :param ident: the point's ID
+        """
+        annotation = self.annotations.pop(ident, None)
+        if annotation is not None:
+            point = tuple(annotation["point"][::-1])
+            if self.ids_by_point.get(point) == ident:
+                del self.ids_by_point[point]
+
+    def remove_point(self, x, y, z):
+        """Remove the point at the given coordinates, if present
+
+        :param x: the point's x coordinate
+        :param y: the point's y coordinate
+        :param z: the point's z coordinate
+        """
+        ident = self.ids_by_point.get((float(x), float(y), float(z)))
+        if ident is not None:
+            self.remove(ident)
+
+    def set_points(self, x, y, z, ids=None, colors=None):
+        """Replace all of the points
+
+        :param x: the x coordinate per point
+        :param y: the y coordinate per point
+        :param z: the z coordinate per point
+        :param ids: the ID per point. Defaults to new IDs.
+        :param colors: a color per point, overriding the color of the layer
+        """
+        if ids is None:
+            ids = [None] * len(x)
+        if colors is None:
+            colors = [None] * len(x)
+        self.annotations = {}
+        self.ids_by_point = {}
+        for xx, yy, zz, ident, color in zip(x, y, z, ids, colors):
+            self.add(xx, yy, zz, ident, color)
+
+    def layer_json(self):
+        """The JSON of the layer, holding the current points
+
+        This is the whole layer: neuroglancer's viewer state has no way to
+        change part of an annotation list, so every update still serializes
+        and sends all of the layer's points. Only the annotation objects
+        are spared, by keeping each point's JSON.
+        """
+        result = dict(self.template)
+        result["annotations"] = list(self.annotations.values())
+        return result
+
+    def update(self, txn=None):
+        """Show the current points in the viewer
+
+        :param txn: a viewer transaction in progress. If None, the layer is
+        replaced without a transaction, which is much faster if the viewer
+        holds many annotations.
+        """
+        if txn is None:
+            update_viewer_state(self.viewer, {self.name: self.layer_json()})
+        else:
+            txn.layers[self.name] = neuroglancer.ManagedLayer(
+                self.name, self.layer_json())
+
+
 def bboxlayer(txn, name, x0, x1, y0, y1, z0, z1):
     """Add a bounding box layer
 
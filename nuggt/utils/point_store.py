@@ -0,0 +1,179 @@
+"""point_store - a set of annotation points with fast spatial queries
+
+The points are held in two parts: a KD-tree over most of them and a small
+unindexed buffer of the points added since the tree was built. Deleting an
+indexed point only marks it as deleted. The tree is rebuilt once the buffer
+and the deletions grow past a fraction of the tree's size, so adding and
+deleting points costs little and queries stay logarithmic in the number of
+points plus linear in the size of the small buffer.
+"""
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+"""Rebuild the tree when the edits are at least this fraction of its size"""
+REBUILD_FRACTION = .05
+
+"""Never rebuild the tree for fewer than this many edits"""
+MIN_REBUILD_EDITS = 1024
+
+
+class PointStore:
+    """A set of 3D points supporting neighbor and box queries
+
+    A PointStore is coordinate-order agnostic: points are N x 3 arrays in
+    whatever order the caller uses and boxes are given in the same order.
+    """
+
+    def __init__(self, points=None):
+        """Constructor
+
+        :param points: an N x 3 array of the initial points
+        """
+        if points is None:
+            points = np.zeros((0, 3))
+        self.rebuild(np.asarray(points, float).reshape(-1, 3))
+
+    def rebuild(self, points=None):
+        """Rebuild the KD-tree to hold all of the points
+
+        :param points: the points to hold. Defaults to the current points.
+        """
+        if points is None:
+            points = self.array
+        self.indexed = np.ascontiguousarray(points, float)
+        self.deleted = np.zeros(len(self.indexed), bool)
+        self.n_deleted = 0
+        self.tree = cKDTree(self.indexed) if len(self.indexed) > 0 else None
+        self.delta = np.zeros((0, 3))
+        self._array = self.indexed
+
+    def __len__(self):
+        return len(self.indexed) - self.n_deleted + len(self.delta)
+
+    @property
+    def array(self):
+        """All of the points as an N x 3 array"""
+        if self._array is None:
+            self._array = np.vstack((self.indexed[~self.deleted], self.delta))
+        return self._array
+
+    def maybe_rebuild(self):
+        """Rebuild the tree if enough points have been added or deleted"""
+        self._array = None
+        n_edits = len(self.delta) + self.n_deleted
+        if n_edits >= max(MIN_REBUILD_EDITS,
+                          REBUILD_FRACTION * len(self.indexed)):
+            self.rebuild()
+
+    def add(self, points):
+        """Add one or more points
+
+        :param points: a point or an N x 3 array of points
+        """
+        points = np.asarray(points, float).reshape(-1, 3)
+        if len(points) == 0:
+            return
+        self.delta = np.vstack((self.delta, points))
+        self.maybe_rebuild()
+
+    def nearby_indices(self, point, radius):
+        """Find the points within a radius of a point
+
+        :param point: the center of the search
+        :param radius: the search radius
+        :returns: a two-tuple of the indices into the indexed points and
+        the indices into the delta buffer of the points strictly within the
+        radius
+        """
+        point = np.asarray(point, float)
+        if self.tree is None:
+            indexed = np.zeros(0, int)
+        else:
+            indexed = np.array(self.tree.query_ball_point(point, radius),
+                               int)
+            indexed = indexed[~self.deleted[indexed]]
+            indexed = indexed[np.sqrt(np.sum(np.square(
+                self.indexed[indexed] - point), 1)) < radius]
+        distances = np.sqrt(np.sum(np.square(self.delta - point), 1))
+        return indexed, np.where(distances < radius)[0]
+
+    def nearby(self, point, radius):
+        """Find the points within a radius of a point, nearest first
+
+        :param point: the center of the search
+        :param radius: the search radius
+        :returns: an N x 3 array of the points strictly within the radius,
+        sorted by distance
+        """
+        indexed, delta = self.nearby_indices(point, radius)
+        result = np.vstack((self.indexed[indexed], self.delta[delta]))
+        distances = np.sum(np.square(result - np.asarray(point, float)), 1)
+        return result[np.argsort(distances, kind="stable")]
+
+    def remove_nearest(self, point, radius):
+        """Remove the point nearest to a point, if within a radius
+
+        :param point: the center of the search
+        :param radius: the search radius
+        :returns: the removed point or None if no point was within the radius
+        """
+        point = np.asarray(point, float)
+        indexed, delta = self.nearby_indices(point, radius)
+        candidates = np.vstack((self.indexed[indexed], self.delta[delta]))
+        if len(candidates) == 0:
+            return None
+        best = np.argmin(np.sum(np.square(candidates - point), 1))
+        if best < len(indexed):
+            self.deleted[indexed[best]] = True
+            self.n_deleted += 1
+        else:
+            self.delta = np.delete(self.delta, delta[best - len(indexed)], 0)
+        self.maybe_rebuild()
+        return candidates[best]
+
+    def box_indices(self, lo, hi):
+        """Find the points within a box
+
+        :param lo: the low corner of the box, inclusive
+        :param hi: the high corner of the box, exclusive
+        :returns: a two-tuple of the indices into the indexed points and
+        the indices into the delta buffer of the points in the box
+        """
+        lo = np.asarray(lo, float)
+        hi = np.asarray(hi, float)
+        if self.tree is None or np.any(hi <= lo):
+            indexed = np.zeros(0, int)
+        else:
+            indexed = np.array(self.tree.query_ball_point(
+                (lo + hi) / 2, np.max(hi - lo) / 2, p=np.inf), int)
+            indexed = indexed[~self.deleted[indexed]]
+            points = self.indexed[indexed]
+            indexed = indexed[np.all((points >= lo) & (points < hi), 1)]
+        delta = np.where(np.all((self.delta >= lo) & (self.delta < hi), 1))[0]
+        return indexed, delta
+
+    def in_box(self, lo, hi):
+        """The points within a box
+
+        :param lo: the low corner of the box, inclusive
+        :param hi: the high corner of the box, exclusive
+        :returns: an N x 3 array of the points in the box
+        """
+        indexed, delta = self.box_indices(lo, hi)
+        return np.vstack((self.indexed[indexed], self.delta[delta]))
+
+    def remove_box(self, lo, hi):
+        """Remove the points within a box
+
+        :param lo: the low corner of the box, inclusive
+        :param hi: the high corner of the box, exclusive
+        :returns: an N x 3 array of the removed points
+        """
+        indexed, delta = self.box_indices(lo, hi)
+        result = np.vstack((self.indexed[indexed], self.delta[delta]))
+        self.deleted[indexed] = True
+        self.n_deleted += len(indexed)
+        self.delta = np.delete(self.delta, delta, 0)
+        self.maybe_rebuild()
+        return result
@@ -0,0 +1,227 @@
+"""precomputed_annotations - serve large point sets to neuroglancer
+
+Points that are put inline in the viewer state are all sent to the browser
+and drawn at once, which is unusable beyond about a hundred thousand points.
+This module writes points in neuroglancer's precomputed annotation format
+and serves them over HTTP, so the browser loads only the parts of the
+spatial index that are in view, coarsest first.
+
+The spatial index has several levels. Level 0 is a single chunk covering
+all of the points. Each level halves the chunk size along the longest
+dimensions. Each chunk of a level holds a random sample of at most "limit"
+of the points in it that were not already placed at a coarser level, so
+neuroglancer can show a representative subset when zoomed out.
+
+The by-id index, which neuroglancer uses to look up a selected annotation,
+is written as a single array of the point coordinates in id order instead of
+as a file per point. AnnotationSource serves the records from it.
+"""
+
+import atexit
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from .source_server import serve_source
+
+"""The most points in a chunk of any level but the finest"""
+DEFAULT_LIMIT = 10000
+
+"""The most levels of the spatial index"""
+DEFAULT_MAX_LEVELS = 12
+
+"""The name of the file holding the points in id order"""
+BY_ID_FILENAME = "by_id.f4"
+
+"""An empty chunk: a little-endian uint64 count of zero"""
+EMPTY_CHUNK = np.zeros(1, "<u8").tobytes()
+
+
+def read_points_file(path):
+    """Read points from a .json or .npy file
+
+    :param path: the path to a JSON file holding a list of points or to a
+    .npy file holding an N x 3 array
+    :returns: an N x 3 array of the points
+    """
+    if path.endswith(".npy"):
+        points = np.load(path)
+    else:
+        with open(path) as fd:
+            points = np.array(json.load(fd), float)
+    return points.reshape(-1, 3)
+
+
+def encode_chunk(points, ids):
+    """Encode points in the format of a spatial index chunk
+
+    :param points: an N x 3 array of the points in x, y, z order
+    :param ids: the id of each point
+    :returns: the encoded chunk as bytes
+    """
+    return np.array([len(points)], "<u8").tobytes() + \
+        np.ascontiguousarray(points, "<f4").tobytes() + \
+        np.ascontiguousarray(ids, "<u8").tobytes()
+
+
+def write_point_annotations(path, points,
+                            voxel_size=(1.0, 1.0, 1.0),
+                            limit=DEFAULT_LIMIT,
+                            max_levels=DEFAULT_MAX_LEVELS,
+                            seed=0):
+    """Write points as a precomputed annotation source
+
+    :param path: the directory to write the source to
+    :param points: an N x 3 array of the points in x, y, z order. A point's
+    annotation id is its index in this array.
+    :param voxel_size: the size of a voxel in microns, in x, y, z order
+    :param limit: the most points per chunk at all but the finest level
+    :param max_levels: the most levels in the spatial index. All points
+    left over at the last level are written to it.
+    :param seed: the seed for the random sampling of points per chunk
+    """
+    points = np.asarray(points, np.float32).reshape(-1, 3)
+    if len(points) > 0:
+        lower_bound = np.floor(np.min(points, 0))
+        upper_bound = np.floor(np.max(points, 0)) + 1
+    else:
+        lower_bound = np.zeros(3)
+        upper_bound = np.ones(3)
+    os.makedirs(path, exist_ok=True)
+    np.ascontiguousarray(points, "<f4").tofile(
+        os.path.join(path, BY_ID_FILENAME))
+    #
+    # Shuffle once so that the first points of a chunk at any level are a
+    # random sample.
+    #
+    remaining = np.random.RandomState(seed).permutation(len(points))
+    chunk_size = upper_bound - lower_bound
+    spatial = []
+    for level in range(max_levels):
+        grid_shape = np.ceil((upper_bound - lower_bound) / chunk_size)\
+            .astype(int)
+        cells = np.clip(
+            ((points[remaining] - lower_bound) / chunk_size).astype(int),
+            0, grid_shape - 1)
+        keys = np.ravel_multi_index(cells.transpose(), grid_shape)
+        order = np.argsort(keys, kind="stable")
+        keys, remaining, cells = keys[order], remaining[order], cells[order]
+        starts = np.searchsorted(keys, keys, side="left")
+        rank = np.arange(len(keys)) - starts
+        if level == max_levels - 1 or len(keys) == 0 or \
+                np.all(rank < limit):
+            take = np.ones(len(keys), bool)
+        else:
+            take = rank < limit
+        level_limit = int(np.max(rank[take])) + 1 if np.any(take) else 1
+        key = "spatial%d" % level
+        os.makedirs(os.path.join(path, key), exist_ok=True)
+        taken_keys = keys[take]
+        boundaries = np.where(np.diff(taken_keys) != 0)[0] + 1
+        for group in np.split(np.where(take)[0], boundaries):
+            if len(group) == 0:
+                continue
+            filename = "_".join([str(_) for _ in cells[group[0]]])
+            with open(os.path.join(path, key, filename), "wb") as fd:
+                fd.write(encode_chunk(points[remaining[group]],
+                                      remaining[group]))
+        spatial.append(dict(key=key,
+                            grid_shape=[int(_) for _ in grid_shape],
+                            chunk_size=[float(_) for _ in chunk_size],
+                            limit=level_limit))
+        remaining = remaining[~take]
+        if len(remaining) == 0:
+            break
+        #
+        # Halve the chunk size along the dimensions at least half as long
+        # as the longest, keeping the chunks roughly cubic.
+        #
+        physical_size = chunk_size * np.asarray(voxel_size)
+        chunk_size = np.where(physical_size * 2 > np.max(physical_size),
+                              chunk_size / 2, chunk_size)
+    info = {
+        "@type": "neuroglancer_annotations_v1",
+        "dimensions": dict(
+            [(name, [float(size) * 1e-6, "m"])
+             for name, size in zip("xyz", voxel_size)]),
+        "lower_bound": [float(_) for _ in lower_bound],
+        "upper_bound": [float(_) for _ in upper_bound],
+        "annotation_type": "POINT",
+        "properties": [],
+        "relationships": [],
+        "by_id": dict(key="by_id"),
+        "spatial": spatial
+    }
+    with open(os.path.join(path, "info"), "w") as fd:
+        json.dump(info, fd, indent=2)
+
+
+class AnnotationSource:
+    """A source server source for an annotation source directory"""
+
+    def __init__(self, directory):
+        """Constructor
+
+        :param directory: the directory written by write_point_annotations
+        """
+        self.directory = directory
+
+    def get(self, parts):
+        """Get a file of the source
+
+        :param parts: the parts of the file's path within the source
+        :returns: a two-tuple of the file's contents and content type or
+        None if there is no such file.
+        """
+        if parts == ["info"]:
+            with open(os.path.join(self.directory, "info"), "rb") as fd:
+                return fd.read(), "application/json"
+        elif len(parts) == 2 and parts[0] == "by_id":
+            try:
+                ident = int(parts[1])
+            except ValueError:
+                return None
+            if ident < 0:
+                return None
+            with open(os.path.join(self.directory, BY_ID_FILENAME),
+                      "rb") as fd:
+                fd.seek(ident * 12)
+                record = fd.read(12)
+            if len(record) != 12:
+                return None
+            return record, "application/octet-stream"
+        elif len(parts) == 2 and parts[0].startswith("spatial") and \
+                "." not in parts[0] + parts[1]:
+            path = os.path.join(self.directory, parts[0], parts[1])
+            if not os.path.exists(path):
+                return EMPTY_CHUNK, "application/octet-stream"
+            with open(path, "rb") as fd:
+                return fd.read(), "application/octet-stream"
+        return None
+
+
+def serve_annotations(directory):
+    """Serve an annotation source from this process's source server
+
+    :param directory: the source's directory
+    :returns: the neuroglancer source URL of the annotations
+    """
+    return serve_source(AnnotationSource(directory))
+
+
+def serve_points(points, voxel_size=(1.0, 1.0, 1.0)):
+    """Write points to a temporary annotation source and serve it
+
+    The source is deleted when the process exits.
+
+    :param points: an N x 3 array of the points in x, y, z order
+    :param voxel_size: the size of a voxel in microns, in x, y, z order
+    :returns: the neuroglancer source URL of the annotations
+    """
+    directory = tempfile.mkdtemp(suffix=".annotations")
+    atexit.register(shutil.rmtree, directory, True)
+    write_point_annotations(directory, points, voxel_size)
+    return serve_annotations(directory)
@@ -0,0 +1,396 @@
+"""precomputed_image - serve volumes to neuroglancer as they are viewed
+
+A neuroglancer.LocalVolume needs its whole image in memory, so showing a
+large stack means reading all of it first. A VolumeSource instead serves
+a TiffVolume as a precomputed image source from the source server. Only the
+chunks that neuroglancer asks for are read from the TIFF files and the
+encoded chunks are kept in a least-recently-used cache shared by all
+sources, so opening a stack costs the same whatever its size and memory is
+bounded by the caches.
+
+The source is multiscale: each level of its pyramid halves the resolution
+of the one before along the dimensions with the finest voxels, until the
+whole volume fits in a chunk. A chunk of a coarse level is made from the
+chunks of the level below, which are cached in turn, so zoomed-out views
+cost a fraction of reading the full-resolution data. Images are downsampled
+by the mean of each block of voxels, segmentations by taking every other
+voxel so that labels stay whole. The coarse levels can also be kept in a
+sidecar directory so that they are only ever made once.
+"""
+
+import json
+import os
+import shutil
+import tempfile
+import threading
+import uuid
+
+import numpy as np
+
+from .source_server import serve_source
+from .tiff_volume import ChunkCache, TiffVolume
+
+"""The default maximum size of the encoded chunks in the chunk cache"""
+DEFAULT_CHUNK_CACHE_BYTES = 256 * 1024 * 1024
+
+"""The default size of a chunk in x, y and z"""
+DEFAULT_CHUNK_SIZE = (64, 64, 64)
+
+"""The data types that neuroglancer can read from a precomputed source"""
+SUPPORTED_DTYPES = ("uint8", "uint16", "uint32", "uint64",
+                    "int8", "int16", "int32", "float32")
+
+"""The name of the file describing the volume of a sidecar directory"""
+SIDECAR_INFO_FILENAME = "volume.json"
+
+"""The cache of encoded chunks of all of the image sources"""
+chunk_cache = ChunkCache(DEFAULT_CHUNK_CACHE_BYTES)
+
+
+def precomputed_dtype(dtype):
+    """The data type to serve an image of the given data type as
+
+    :param dtype: the image's numpy dtype
+    :returns: the nearest data type that neuroglancer can read
+    """
+    dtype = np.dtype(dtype)
+    if dtype.name in SUPPORTED_DTYPES:
+        return dtype
+    if dtype == np.bool_:
+        return np.dtype(np.uint8)
+    return np.dtype(np.float32)
+
+
+def pyramid_steps(shape, voxel_size, chunk_shape):
+    """The downsampling steps of the levels of a pyramid
+
+    :param shape: the shape of the full-resolution volume
+    :param voxel_size: the size of a full-resolution voxel, in the same
+    order as the shape
+    :param chunk_shape: the shape of a chunk, in the same order
+    :returns: a list of the step of each level past the first from the level
+    before it, per dimension. A level with a step of 2 along a dimension has
+    half as many voxels along it as the level before.
+    """
+    shape = np.array(shape, int)
+    voxel_size = np.array(voxel_size, float)
+    chunk_shape = np.array(chunk_shape, int)
+    steps = []
+    while np.any(shape > chunk_shape):
+        step = np.where((voxel_size < 2 * np.min(voxel_size[shape > 1])) &
+                        (shape > 1), 2, 1)
+        steps.append(tuple(int(_) for _ in step))
+        shape = (shape + step - 1) // step
+        voxel_size = voxel_size * step
+    return steps
+
+
+def downsample_mean(block, step):
+    """Downsample an image by the mean of blocks of voxels
+
+    :param block: the image to downsample
+    :param step: the size of the blocks, per dimension. The image is padded
+    by repeating its last voxels if its shape is not a multiple of this.
+    :returns: the downsampled image, of the same data type
+    """
+    padding = [(0, -n % s) for n, s in zip(block.shape, step)]
+    if any([after > 0 for _, after in padding]):
+        block = np.pad(block, padding, mode="edge")
+    shape = []
+    for n, s in zip(block.shape, step):
+        shape += [n // s, s]
+    result = block.reshape(shape).mean(axis=tuple(range(1, len(shape), 2)))
+    if block.dtype.kind in ("i", "u", "b"):
+        result = np.rint(result)
+    return result.astype(block.dtype)
+
+
+def downsample_stride(block, step):
+    """Downsample a segmentation by taking every step'th voxel
+
+    :param block: the segmentation to downsample
+    :param step: the step per dimension
+    :returns: the downsampled segmentation
+    """
+    return block[tuple(slice(None, None, s) for s in step)]
+
+
+class VolumeSource:
+    """A multiscale source server source for a TiffVolume or Numpy array"""
+
+    def __init__(self, volume, voxel_size=(1.0, 1.0, 1.0),
+                 chunk_size=DEFAULT_CHUNK_SIZE,
+                 volume_type="image",
+                 cache_directory=None):
+        """Constructor
+
+        :param volume: the TiffVolume or 3D Numpy array in z, y, x order to
+        serve. If the volume is a window of a larger TiffVolume, the voxel
+        offset of the source is the window's origin.
+        :param voxel_size: the size of a voxel in microns in x, y, z order
+        :param chunk_size: the size of a chunk in x, y, z order
+        :param volume_type: "image" or "segmentation"
+        :param cache_directory: a directory to keep the chunks of the
+        coarse levels of the pyramid in or None to only keep them in memory
+        """
+        self.volume = volume
+        self.chunk_shape = np.array(chunk_size[::-1], int)
+        self.volume_type = volume_type
+        self.cache_directory = cache_directory
+        self.dtype = precomputed_dtype(volume.dtype)
+        if volume_type == "segmentation" and self.dtype.kind != "u":
+            self.dtype = np.dtype(np.uint32)
+        if isinstance(volume, TiffVolume):
+            #
+            # Sources of the same part of the same files share their
+            # cached chunks
+            #
+            self.key = (tuple(volume.filenames), tuple(volume.origin),
+                        tuple(volume.shape), self.dtype.name, volume_type)
+            offset = np.array(volume.origin, int)
+        else:
+            self.key = (uuid.uuid4().hex,)
+            offset = np.zeros(3, int)
+        voxel_size = np.array(voxel_size[::-1], float)
+        self.steps = [(1, 1, 1)] + pyramid_steps(
+            volume.shape, voxel_size, self.chunk_shape)
+        self.levels = []
+        factor = np.ones(3, int)
+        shape = np.array(volume.shape, int)
+        for step in self.steps:
+            factor = factor * step
+            shape = (shape + np.array(step) - 1) // step
+            self.levels.append(dict(
+                key="_".join(["%g" % _ for _ in (voxel_size * factor)[::-1]]),
+                shape=shape,
+                offset=offset // factor,
+                voxel_size=voxel_size * factor))
+        self.level_keys = dict([(level["key"], idx)
+                                for idx, level in enumerate(self.levels)])
+
+    def info(self):
+        """The info file of the source as a dictionary"""
+        return {
+            "@type": "neuroglancer_multiscale_volume",
+            "type": self.volume_type,
+            "data_type": self.dtype.name,
+            "num_channels": 1,
+            "scales": [dict(
+                key=level["key"],
+                size=[int(_) for _ in level["shape"][::-1]],
+                resolution=[float(_) * 1000
+                            for _ in level["voxel_size"][::-1]],
+                voxel_offset=[int(_) for _ in level["offset"][::-1]],
+                chunk_sizes=[[int(_) for _ in self.chunk_shape[::-1]]],
+                encoding="raw") for level in self.levels]
+        }
+
+    def encode(self, block):
+        """Encode a block in raw encoding, little-endian and x-fastest"""
+        return np.ascontiguousarray(
+            block, self.dtype.newbyteorder("<")).tobytes()
+
+    def decode(self, data, shape):
+        """Decode a block encoded by "encode"
+
+        :param data: the encoded block
+        :param shape: the block's shape
+        """
+        return np.frombuffer(data, self.dtype.newbyteorder("<"))\
+            .reshape(shape)
+
+    def chunk_path(self, level, lo, hi):
+        """The path of a chunk's file in the cache directory"""
+        offset = self.levels[level]["offset"]
+        name = "_".join(["%d-%d" % (a + o, b + o) for a, b, o in
+                         zip(lo[::-1], hi[::-1], offset[::-1])])
+        return os.path.join(self.cache_directory,
+                            self.levels[level]["key"], name)
+
+    def chunk(self, level, lo, hi):
+        """Get an encoded chunk of a level of the pyramid
+
+        :param level: the index of the level
+        :param lo: the first voxel of the chunk in z, y, x order, relative
+        to the level's voxel offset
+        :param hi: the voxel after the last voxel of the chunk
+        :returns: the chunk, encoded by "encode"
+        """
+        key = self.key + (level, tuple(lo), tuple(hi))
+        data = chunk_cache.get(key)
+        if data is not None:
+            return data
+        persist = level > 0 and self.cache_directory is not None
+        if persist:
+            path = self.chunk_path(level, lo, hi)
+            if os.path.exists(path):
+                with open(path, "rb") as fd:
+                    data = fd.read()
+        if data is None:
+            data = self.encode(self.make_block(level, lo, hi))
+            if persist:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+                with os.fdopen(fd, "wb") as fd:
+                    fd.write(data)
+                os.replace(tmp_path, path)
+        chunk_cache.put(key, data)
+        return data
+
+    def make_block(self, level, lo, hi):
+        """Make a block of a level from the volume or the level below
+
+        :param level: the index of the level
+        :param lo: the first voxel of the block in z, y, x order, relative
+        to the level's voxel offset
+        :param hi: the voxel after the last voxel of the block
+        :returns: the block as a Numpy array
+        """
+        if level == 0:
+            return np.asarray(self.volume[lo[0]:hi[0],
+                                          lo[1]:hi[1],
+                                          lo[2]:hi[2]])
+        step = np.array(self.steps[level])
+        below = np.minimum(np.array(hi) * step,
+                           self.levels[level - 1]["shape"])
+        block = self.block(level - 1, np.array(lo) * step, below)
+        if self.volume_type == "segmentation":
+            return downsample_stride(block, step)
+        return downsample_mean(block, step)
+
+    def block(self, level, lo, hi):
+        """Get a block of a level, assembled from its chunks
+
+        :param level: the index of the level
+        :param lo: the first voxel of the block in z, y, x order, relative
+        to the level's voxel offset
+        :param hi: the voxel after the last voxel of the block
+        :returns: the block as a Numpy array
+        """
+        lo = np.array(lo, int)
+        hi = np.array(hi, int)
+        shape = self.levels[level]["shape"]
+        result = np.zeros(hi - lo, self.dtype)
+        first = lo // self.chunk_shape
+        last = (hi + self.chunk_shape - 1) // self.chunk_shape
+        for cell in np.ndindex(*(last - first)):
+            chunk_lo = (first + cell) * self.chunk_shape
+            chunk_hi = np.minimum(chunk_lo + self.chunk_shape, shape)
+            chunk = self.decode(self.chunk(level, chunk_lo, chunk_hi),
+                                chunk_hi - chunk_lo)
+            a = np.maximum(chunk_lo, lo)
+            b = np.minimum(chunk_hi, hi)
+            result[tuple(slice(_, __) for _, __ in zip(a - lo, b - lo))] = \
+                chunk[tuple(slice(_, __)
+                            for _, __ in zip(a - chunk_lo, b - chunk_lo))]
+        return result
+
+    def get(self, parts):
+        """Get a file of the source
+
+        :param parts: the parts of the file's path within the source
+        :returns: a two-tuple of the file's contents and content type or
+        None if there is no such file.
+        """
+        if parts == ["info"]:
+            return json.dumps(self.info()).encode("utf-8"), \
+                "application/json"
+        if len(parts) != 2 or parts[0] not in self.level_keys:
+            return None
+        level = self.level_keys[parts[0]]
+        try:
+            bounds = [int(_) for xyz in parts[1].split("_")
+                      for _ in xyz.split("-")]
+        except ValueError:
+            return None
+        if len(bounds) != 6:
+            return None
+        shape = self.levels[level]["shape"]
+        offset = self.levels[level]["offset"]
+        lo = np.array(bounds[4::-2]) - offset
+        hi = np.array(bounds[5::-2]) - offset
+        if np.any(lo < 0) or np.any(hi > shape) or np.any(hi <= lo):
+            return None
+        if np.all(lo % self.chunk_shape == 0) and \
+                np.all(hi == np.minimum(lo + self.chunk_shape, shape)):
+            data = self.chunk(level, lo, hi)
+        else:
+            data = self.encode(self.block(level, lo, hi))
+        return data, "application/octet-stream"
+
+
+def sidecar_directory(volume, volume_type="image"):
+    """Get the sidecar directory for the pyramid of a TiffVolume
+
+    The directory is next to the volume's first file. It is emptied if it
+    was made for files that have changed since.
+
+    :param volume: the TiffVolume
+    :param volume_type: "image" or "segmentation"
+    :returns: the path to the directory
+    """
+    path = "%s.%s-pyramid" % (volume.filenames[0], volume_type)
+    description = dict(
+        filenames=[os.path.basename(_) for _ in volume.filenames],
+        mtimes=[os.path.getmtime(_) for _ in volume.filenames],
+        origin=[int(_) for _ in volume.origin],
+        shape=[int(_) for _ in volume.shape])
+    info_path = os.path.join(path, SIDECAR_INFO_FILENAME)
+    if os.path.exists(info_path):
+        with open(info_path) as fd:
+            if json.load(fd) == description:
+                return path
+        shutil.rmtree(path)
+    os.makedirs(path, exist_ok=True)
+    with open(info_path, "w") as fd:
+        json.dump(description, fd)
+    return path
+
+
+"""The URLs of the volumes served by serve_volume, by volume and options"""
+_served_volumes = {}
+_served_volumes_lock = threading.Lock()
+
+
+def serve_volume(volume, voxel_size=(1.0, 1.0, 1.0), volume_type="image",
+                 sidecar=False):
+    """Serve a volume as a multiscale source from this process's server
+
+    Serving the same volume again with the same options returns the URL of
+    the source that is already being served, so refreshing a layer does not
+    add a source to the server each time. TiffVolumes are the same if they
+    are of the same part of the same files, arrays if they are the same
+    object.
+
+    :param volume: a TiffVolume, the path or glob expression of the TIFF
+    file or files or a 3D Numpy array in z, y, x order which must not change
+    while it is served
+    :param voxel_size: the size of a voxel in microns in x, y, z order
+    :param volume_type: "image" or "segmentation"
+    :param sidecar: if True, keep the coarse levels of the pyramid of a
+    TiffVolume in a directory next to its files, see sidecar_directory.
+    :returns: the neuroglancer URL of the volume
+    """
+    if isinstance(volume, str):
+        volume = TiffVolume(volume)
+    cache_directory = None
+    if sidecar and isinstance(volume, TiffVolume):
+        cache_directory = sidecar_directory(volume, volume_type)
+    if isinstance(volume, TiffVolume):
+        volume_key = (tuple(volume.filenames), tuple(volume.origin),
+                      tuple(volume.shape))
+    else:
+        #
+        # The source keeps the array alive, so its id is not reused while
+        # it is served.
+        #
+        volume_key = id(volume)
+    key = (volume_key, tuple([float(_) for _ in voxel_size]), volume_type,
+           cache_directory)
+    with _served_volumes_lock:
+        if key not in _served_volumes:
+            _served_volumes[key] = serve_source(VolumeSource(
+                volume, voxel_size,
+                volume_type=volume_type,
+                cache_directory=cache_directory))
+        return _served_volumes[key]
@@ -0,0 +1,176 @@
+"""prefetch - read the windows around nuggt's edit window in the background
+
+When nuggt is driven by the navigation viewer, the user annotates a window
+and then typically jumps to the next window over. A WindowPrefetcher reads
+the windows around the current one into the TiffVolume caches while the user
+annotates, so that the jump is served from memory. Windows that have not
+been visited, according to the repositioning log, are read first.
+
+Windows are (x0, x1, y0, y1, z0, z1) tuples, as in the repositioning log.
+"""
+
+import itertools
+import json
+import threading
+
+import numpy as np
+
+
+def read_repositioning_log(path):
+    """Read the windows visited from a repositioning log file
+
+    :param path: the path to the log file written by nuggt's
+    --repositioning-log-file option.
+    :returns: a list of (x0, x1, y0, y1, z0, z1) windows in the order they
+    were visited
+    """
+    windows = []
+    with open(path) as fd:
+        for line in fd:
+            line = line.strip()
+            if len(line) == 0:
+                continue
+            d = json.loads(line)
+            windows.append(tuple(
+                int(d[key]) for key in ("x0", "x1", "y0", "y1", "z0", "z1")))
+    return windows
+
+
+def neighboring_windows(window, extent):
+    """The windows of the same size adjoining a window
+
+    Windows are shifted by their width, height and depth and kept within
+    the volume, the way nuggt positions a window when jumping.
+
+    :param window: the (x0, x1, y0, y1, z0, z1) of the current window
+    :param extent: the (x, y, z) size of the volume
+    :returns: a list of the distinct neighboring windows, those sharing a
+    face first, then those sharing an edge, then those sharing a corner.
+    """
+    starts = window[::2]
+    sizes = [stop - start for start, stop in zip(starts, window[1::2])]
+    neighbors = []
+    offsets = sorted(itertools.product((-1, 0, 1), repeat=3),
+                     key=lambda offset: np.count_nonzero(offset))
+    for offset in offsets:
+        neighbor = []
+        for start, size, e, o in zip(starts, sizes, extent, offset):
+            start = max(0, min(start + o * size, e - size))
+            neighbor += [start, start + size]
+        neighbor = tuple(neighbor)
+        if neighbor != tuple(window) and neighbor not in neighbors:
+            neighbors.append(neighbor)
+    return neighbors
+
+
+class WindowPrefetcher:
+    """Prefetch the windows around the current one in a background thread"""
+
+    def __init__(self, volumes, extent, visited=(), max_bytes=None):
+        """Constructor
+
+        :param volumes: the TiffVolumes to prefetch
+        :param extent: the (x, y, z) size of the volumes
+        :param visited: the windows visited so far, e.g. from
+        read_repositioning_log
+        :param max_bytes: the most to prefetch around a window. Defaults to
+        half of the smallest volume cache, so that prefetching does not push
+        the current window out of the cache.
+        """
+        self.volumes = list(volumes)
+        self.extent = tuple(extent)
+        if max_bytes is None:
+            max_bytes = min([_.cache.max_bytes for _ in self.volumes]) // 2 \
+                if len(self.volumes) > 0 else 0
+        self.max_bytes = max_bytes
+        self.visited = [tuple(_) for _ in visited]
+        self.window = None
+        self.cancel = threading.Event()
+        self.condition = threading.Condition()
+        self.stopped = False
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def is_visited(self, window):
+        """Whether the center of a window lies in any visited window"""
+        with self.condition:
+            if len(self.visited) == 0:
+                return False
+            visited = np.array(self.visited)
+        center = [(start + stop) / 2
+                  for start, stop in zip(window[::2], window[1::2])]
+        inside = np.ones(len(visited), bool)
+        for d, c in enumerate(center):
+            inside &= (visited[:, 2 * d] <= c) & (c < visited[:, 2 * d + 1])
+        return bool(np.any(inside))
+
+    def window_bytes(self, window):
+        """The size of a window, summed over all of the volumes"""
+        n_voxels = np.prod([stop - start for start, stop in
+                            zip(window[::2], window[1::2])])
+        return int(sum([n_voxels * _.dtype.itemsize for _ in self.volumes]))
+
+    def candidates(self, window):
+        """The windows to prefetch around a window, in the order to fetch
+
+        Unvisited windows come before visited ones and the windows are
+        limited to those that fit in the prefetcher's budget.
+        """
+        neighbors = neighboring_windows(window, self.extent)
+        neighbors = sorted(neighbors, key=self.is_visited)
+        result = []
+        total = 0
+        for neighbor in neighbors:
+            total += self.window_bytes(neighbor)
+            if total > self.max_bytes:
+                break
+            result.append(neighbor)
+        return result
+
+    def prefetch_around(self, window):
+        """Start prefetching the windows around a new current window
+
+        Any prefetching around the previous window is abandoned. The window
+        is recorded as visited.
+
+        :param window: the (x0, x1, y0, y1, z0, z1) of the current window
+        """
+        window = tuple(int(_) for _ in window)
+        with self.condition:
+            self.cancel.set()
+            self.visited.append(window)
+            self.window = window
+            self.condition.notify()
+
+    def prefetch(self, window, cancel):
+        """Read the windows around a window into the volume caches
+
+        :param window: the current window
+        :param cancel: a threading.Event that stops the prefetch when set
+        :returns: True if all of the windows were read, False if cancelled
+        """
+        for x0, x1, y0, y1, z0, z1 in self.candidates(window):
+            for volume in self.volumes:
+                if not volume.prefetch(z0, z1, y0, y1, x0, x1, cancel):
+                    return False
+        return True
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.window is None and not self.stopped:
+                    self.condition.wait()
+                if self.stopped:
+                    return
+                window = self.window
+                self.window = None
+                self.cancel.clear()
+            self.prefetch(window, self.cancel)
+
+    def close(self):
+        """Stop the prefetching thread"""
+        with self.condition:
+            self.cancel.set()
+            self.stopped = True
+            self.condition.notify()
+        self.thread.join()
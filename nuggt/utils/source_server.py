@@ -0,0 +1,104 @@
+"""source_server - a local HTTP server for neuroglancer precomputed sources
+
+Neuroglancer reads precomputed sources - images and annotations - from
+files that it fetches by URL. A SourceServer serves sources that are made
+on demand by this process, so that data can be shown without writing it out
+in full or sending it through the viewer state.
+
+A source is any object with a "get" method that takes the parts of the path
+after the source's key, e.g. ["info"] or ["spatial0", "0_0_0"], and returns
+a two-tuple of the bytes and content type of the file or None if there is no
+such file.
+"""
+
+import http.server
+import socket
+import threading
+import uuid
+
+import neuroglancer
+
+
+class SourceRequestHandler(http.server.BaseHTTPRequestHandler):
+    """Serve the files of the sources of a SourceServer"""
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_bytes(self, data, content_type="application/octet-stream"):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.send_header("Access-Control-Allow-Origin", "*")
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        parts = self.path.split("?")[0].strip("/").split("/")
+        source = self.server.sources.get(parts[0])
+        result = None if source is None else source.get(parts[1:])
+        if result is None:
+            self.send_error(404)
+        else:
+            self.send_bytes(*result)
+
+
+class SourceServer:
+    """A local HTTP server for precomputed sources"""
+
+    def __init__(self, bind_address=None, port=0):
+        """Constructor
+
+        :param bind_address: the address to bind to. Defaults to the
+        address neuroglancer's server binds to.
+        :param port: the port to bind to. Defaults to any free port.
+        """
+        if bind_address is None:
+            bind_address = \
+                neuroglancer.server.global_server_args["bind_address"]
+        self.httpd = http.server.ThreadingHTTPServer(
+            (bind_address, port), SourceRequestHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.sources = {}
+        if bind_address in ("0.0.0.0", "::", ""):
+            hostname = socket.getfqdn()
+        else:
+            hostname = bind_address
+        self.url = "http://%s:%d" % (hostname, self.httpd.server_address[1])
+        self.thread = threading.Thread(target=self.httpd.serve_forever,
+                                       daemon=True)
+        self.thread.start()
+
+    def serve(self, source):
+        """Serve a source
+
+        :param source: the source, an object with a "get" method
+        :returns: the neuroglancer URL of the source
+        """
+        key = uuid.uuid4().hex
+        self.httpd.sources[key] = source
+        return "precomputed://%s/%s" % (self.url, key)
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+_source_server = None
+_source_server_lock = threading.Lock()
+
+
+def serve_source(source):
+    """Serve a source from this process's source server
+
+    The server is started on first use, bound to the address that
+    neuroglancer's server binds to.
+
+    :param source: the source, an object with a "get" method
+    :returns: the neuroglancer URL of the source
+    """
+    global _source_server
+    with _source_server_lock:
+        if _source_server is None:
+            _source_server = SourceServer()
+        return _source_server.serve(source)
@@ -0,0 +1,345 @@
+"""tiff_volume - lazily-read volumes backed by TIFF files
+
+A TiffVolume looks enough like a numpy array - shape, dtype, ndim, slicing
+and transposition - to be the data of a neuroglancer.LocalVolume, but it only
+reads the parts of the image that are sliced out. These are read a tile at a
+time and kept in a least-recently-used cache of bounded size, so the viewer
+can open a huge stack instantly and only pays for the chunks it displays.
+
+The volume is either a stack of 2D TIFF files, one per z, or a single 3D TIFF
+file. Uncompressed files are memory-mapped so that reading a tile reads only
+that tile. Compressed planes are decoded whole and all of their tiles are
+cached.
+"""
+
+import collections
+import copy
+import glob
+import threading
+
+import numpy as np
+import tifffile
+
+"""The default maximum size of the tiles kept in a TiffVolume's cache"""
+DEFAULT_CACHE_BYTES = 512 * 1024 * 1024
+
+"""The default width and height of the tiles that are read and cached"""
+DEFAULT_TILE_SIZE = 256
+
+
+class ChunkCache:
+    """A thread-safe least-recently-used cache of arrays
+
+    The cache holds as many arrays as fit within its byte budget. The least
+    recently used are dropped to make room for new ones.
+    """
+
+    def __init__(self, max_bytes):
+        """Constructor
+
+        :param max_bytes: the maximum total size of the cached values
+        """
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        """Get a value from the cache
+
+        :param key: the value's key
+        :returns: the value or None if it is not in the cache
+        """
+        with self.lock:
+            value = self.entries.get(key)
+            if value is not None:
+                self.entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        """Put a value in the cache, dropping old values if need be
+
+        :param key: the value's key
+        :param value: a numpy array or bytes
+        """
+        nbytes = len(value) if isinstance(value, bytes) else value.nbytes
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.nbytes -= \
+                    len(old) if isinstance(old, bytes) else old.nbytes
+            self.entries[key] = value
+            self.nbytes += nbytes
+            while self.nbytes > self.max_bytes and len(self.entries) > 1:
+                _, old = self.entries.popitem(last=False)
+                self.nbytes -= \
+                    len(old) if isinstance(old, bytes) else old.nbytes
+
+
+def normalize_key(key, shape):
+    """Turn an indexing expression into a tuple of start, stop pairs
+
+    :param key: an index, slice or tuple of them, as for a numpy array.
+    Slices must have a step of 1.
+    :param shape: the shape of the array being indexed
+    :returns: a two-tuple of a list of (start, stop) per dimension and a
+    list of the dimensions that were indexed by integers and should be
+    dropped from the result.
+    """
+    if not isinstance(key, tuple):
+        key = (key,)
+    if len(key) > len(shape):
+        raise IndexError("Too many indices for a %d-d volume" % len(shape))
+    key = key + (slice(None),) * (len(shape) - len(key))
+    ranges = []
+    drop = []
+    for d, (k, size) in enumerate(zip(key, shape)):
+        if isinstance(k, slice):
+            start, stop, step = k.indices(size)
+            if step != 1:
+                raise IndexError("Only slices with a step of 1 are supported")
+            ranges.append((start, max(start, stop)))
+        else:
+            k = int(k)
+            if k < 0:
+                k += size
+            if k < 0 or k >= size:
+                raise IndexError("Index %d is out of bounds" % k)
+            ranges.append((k, k + 1))
+            drop.append(d)
+    return ranges, drop
+
+
+def read_tiff(path):
+    """Read a TIFF file as an array without copying it if possible
+
+    :param path: the path to the TIFF file
+    :returns: the file's image, memory-mapped read-only if the file is
+    uncompressed and read into memory otherwise.
+    """
+    try:
+        return tifffile.memmap(path, mode="r")
+    except ValueError:
+        return tifffile.imread(path)
+
+
+class TiffVolume:
+    """A 3D volume in z, y, x order that is read from TIFF files on demand"""
+
+    def __init__(self, path, cache_bytes=DEFAULT_CACHE_BYTES,
+                 tile_size=DEFAULT_TILE_SIZE):
+        """Constructor
+
+        :param path: the path to a 3D TIFF file or a glob expression for a
+        stack of 2D TIFF files, e.g. /path/to/*.tiff, which are sorted by
+        name to give the z order.
+        :param cache_bytes: the maximum size of the cached tiles
+        :param tile_size: the width and height of the tiles that are read
+        """
+        self.filenames = sorted(glob.glob(path))
+        if len(self.filenames) == 0:
+            raise FileNotFoundError("No TIFF files match %s" % path)
+        self.tile_size = tile_size
+        self.cache = ChunkCache(cache_bytes)
+        self.lock = threading.Lock()
+        with tifffile.TiffFile(self.filenames[0]) as tf:
+            series = tf.series[0]
+            plane_shape = tuple(series.shape)
+            self.dtype = np.dtype(series.dtype)
+        if len(self.filenames) > 1:
+            self.full_shape = (len(self.filenames),) + plane_shape[-2:]
+            self.tiff_file = None
+            self.stack = None
+        else:
+            if len(plane_shape) == 2:
+                plane_shape = (1,) + plane_shape
+            self.full_shape = plane_shape
+            try:
+                self.stack = tifffile.memmap(self.filenames[0], mode="r")\
+                    .reshape(self.full_shape)
+                self.tiff_file = None
+            except ValueError:
+                self.stack = None
+                self.tiff_file = tifffile.TiffFile(self.filenames[0])
+        self.origin = (0, 0, 0)
+        self.shape = self.full_shape
+
+    @property
+    def ndim(self):
+        return 3
+
+    def window(self, z0=0, z1=None, y0=0, y1=None, x0=0, x1=None):
+        """A view of part of the volume that shares this volume's cache
+
+        :param z0: the first plane of the view
+        :param z1: the plane after the last plane of the view
+        :param y0: the first row of the view
+        :param y1: the row after the last row of the view
+        :param x0: the first column of the view
+        :param x1: the column after the last column of the view
+        :returns: a TiffVolume of the windowed region.
+        """
+        z1 = self.full_shape[0] if z1 is None else z1
+        y1 = self.full_shape[1] if y1 is None else y1
+        x1 = self.full_shape[2] if x1 is None else x1
+        view = copy.copy(self)
+        view.origin = (z0, y0, x0)
+        view.shape = (z1 - z0, y1 - y0, x1 - x0)
+        return view
+
+    def transpose(self, *axes):
+        """A lazy view of the volume with its axes permuted
+
+        :param axes: the permutation as for numpy.ndarray.transpose
+        """
+        if len(axes) == 1 and not np.isscalar(axes[0]):
+            axes = axes[0]
+        if len(axes) == 0:
+            axes = (2, 1, 0)
+        return TransposedVolume(self, axes)
+
+    def read_plane(self, z):
+        """Read a whole plane of the full volume
+
+        The plane is memory-mapped if possible so that no data is read
+        until it is sliced.
+        """
+        if self.stack is not None:
+            return self.stack[z]
+        if self.tiff_file is not None:
+            with self.lock:
+                return self.tiff_file.pages[z].asarray()
+        filename = self.filenames[z]
+        try:
+            return tifffile.memmap(filename, mode="r")
+        except ValueError:
+            return tifffile.imread(filename)
+
+    def tile(self, z, ty, tx):
+        """Get a tile of the full volume, reading it if it is not cached
+
+        :param z: the plane of the tile
+        :param ty: the tile's row index in the grid of tiles
+        :param tx: the tile's column index in the grid of tiles
+        :returns: the tile's array
+        """
+        key = (z, ty, tx)
+        tile = self.cache.get(key)
+        if tile is not None:
+            return tile
+        plane = self.read_plane(z)
+        size = self.tile_size
+        if isinstance(plane, np.memmap):
+            tile = np.array(plane[ty * size:(ty + 1) * size,
+                                  tx * size:(tx + 1) * size])
+            self.cache.put(key, tile)
+            return tile
+        #
+        # The plane was decoded whole, so keep all of its tiles
+        #
+        for tyy in range(0, (plane.shape[0] + size - 1) // size):
+            for txx in range(0, (plane.shape[1] + size - 1) // size):
+                t = np.ascontiguousarray(
+                    plane[tyy * size:(tyy + 1) * size,
+                          txx * size:(txx + 1) * size])
+                self.cache.put((z, tyy, txx), t)
+                if (tyy, txx) == (ty, tx):
+                    tile = t
+        return tile
+
+    def prefetch(self, z0, z1, y0, y1, x0, x1, cancel=None):
+        """Read the tiles of a region of the full volume into the cache
+
+        :param z0: the first plane of the region
+        :param z1: the plane after the last plane of the region
+        :param y0: the first row of the region
+        :param y1: the row after the last row of the region
+        :param x0: the first column of the region
+        :param x1: the column after the last column of the region
+        :param cancel: a threading.Event that stops the prefetch when set
+        :returns: True if all of the tiles were read, False if cancelled
+        """
+        size = self.tile_size
+        for z in range(max(0, z0), min(z1, self.full_shape[0])):
+            for ty in range(max(0, y0) // size, (y1 + size - 1) // size):
+                for tx in range(max(0, x0) // size, (x1 + size - 1) // size):
+                    if cancel is not None and cancel.is_set():
+                        return False
+                    self.tile(z, ty, tx)
+        return True
+
+    def __getitem__(self, key):
+        ranges, drop = normalize_key(key, self.shape)
+        (z0, z1), (y0, y1), (x0, x1) = ranges
+        oz, oy, ox = self.origin
+        result = np.zeros((z1 - z0, y1 - y0, x1 - x0), self.dtype)
+        size = self.tile_size
+        for z in range(z0, z1):
+            for ty in range((y0 + oy) // size, (y1 + oy + size - 1) // size):
+                for tx in range((x0 + ox) // size,
+                                (x1 + ox + size - 1) // size):
+                    tile = self.tile(z + oz, ty, tx)
+                    ty0 = max(ty * size, y0 + oy)
+                    ty1 = min(ty * size + tile.shape[0], y1 + oy)
+                    tx0 = max(tx * size, x0 + ox)
+                    tx1 = min(tx * size + tile.shape[1], x1 + ox)
+                    if ty1 <= ty0 or tx1 <= tx0:
+                        continue
+                    result[z - z0,
+                           ty0 - oy - y0:ty1 - oy - y0,
+                           tx0 - ox - x0:tx1 - ox - x0] = \
+                        tile[ty0 - ty * size:ty1 - ty * size,
+                             tx0 - tx * size:tx1 - tx * size]
+        if len(drop) > 0:
+            result = result.reshape(
+                [r[1] - r[0] for d, r in enumerate(ranges) if d not in drop])
+        return result
+
+    def __array__(self, dtype=None, copy=None):
+        result = self[:]
+        return result if dtype is None else result.astype(dtype)
+
+
+class TransposedVolume:
+    """A lazy view of a TiffVolume with permuted axes"""
+
+    def __init__(self, volume, axes):
+        """Constructor
+
+        :param volume: the TiffVolume
+        :param axes: the permutation - axis i of the view is axis axes[i]
+        of the volume.
+        """
+        self.volume = volume
+        self.axes = tuple(int(_) for _ in axes)
+        self.shape = tuple(volume.shape[a] for a in self.axes)
+        self.dtype = volume.dtype
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    def transpose(self, *axes):
+        if len(axes) == 1 and not np.isscalar(axes[0]):
+            axes = axes[0]
+        if len(axes) == 0:
+            axes = tuple(range(self.ndim))[::-1]
+        return TransposedVolume(self.volume, [self.axes[a] for a in axes])
+
+    def __getitem__(self, key):
+        ranges, drop = normalize_key(key, self.shape)
+        inner = [None] * self.ndim
+        for d, a in enumerate(self.axes):
+            inner[a] = slice(*ranges[d])
+        result = self.volume[tuple(inner)].transpose(self.axes)
+        if len(drop) > 0:
+            result = result.reshape(
+                [r[1] - r[0] for d, r in enumerate(ranges) if d not in drop])
+        return result
+
+    def __array__(self, dtype=None, copy=None):
+        result = self[:]
+        return result if dtype is None else result.astype(dtype)
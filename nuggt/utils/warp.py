@@ -2,30 +2,980 @@
 
 """
 
+import itertools
+import math
 import numpy as np
-from scipy.interpolate import Rbf, RegularGridInterpolator
+from scipy.interpolate import Rbf
+from scipy.linalg import lu_factor, lu_solve
+from scipy.sparse import coo_matrix
+from scipy.sparse.linalg import cg, splu
+from scipy.ndimage import distance_transform_edt, spline_filter1d
+from scipy.spatial import cKDTree
+from scipy.spatial.distance import cdist
+
+"""The default memory budget for the temporary arrays of a warp evaluation"""
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+
+
+def thin_plate_kernel(r, overwrite=False):
+    """The thin-plate radial basis function, r ** 2 * log(r)
+
+    :param r: an array of distances
+    :param overwrite: if True, compute the result in place in "r", which must
+    then be a floating-point array.
+    :returns: the kernel evaluated at each distance, zero where r is zero
+    """
+    if not overwrite:
+        r = np.array(r, float)
+    mask = r == 0
+    r[mask] = 1
+    r2 = np.square(r)
+    np.log(r, out=r)
+    r *= r2
+    r[mask] = 0
+    return r
+
+
+def evaluate_in_chunks(fn, coords, output_dim, bytes_per_point,
+                       max_bytes=None, chunk_size=None, out=None):
+    """Evaluate a function of coordinates a chunk of coordinates at a time
+
+    :param fn: a function that takes a K x M array of coordinates and
+    returns a K x M' array of values
+    :param coords: an N x M array of coordinates
+    :param output_dim: M', the number of values per coordinate
+    :param bytes_per_point: the number of bytes of temporary storage that
+    "fn" needs per coordinate
+    :param max_bytes: the memory budget for the temporary storage of each
+    chunk. Defaults to DEFAULT_MAX_BYTES
+    :param chunk_size: the number of coordinates per chunk. If specified,
+    this overrides max_bytes.
+    :param out: an N x M' array to receive the result. If None, one is
+    allocated.
+    :returns: the N x M' array of values
+    """
+    if out is None:
+        out = np.zeros((len(coords), output_dim))
+    if chunk_size is None:
+        if max_bytes is None:
+            max_bytes = DEFAULT_MAX_BYTES
+        chunk_size = max(1, int(max_bytes // max(1, bytes_per_point)))
+    for i0 in range(0, len(coords), chunk_size):
+        i1 = min(len(coords), i0 + chunk_size)
+        out[i0:i1] = fn(coords[i0:i1])
+    return out
+
+
+def round_to_int(values, out=None):
+    """Round warped coordinates to the nearest integer
+
+    Coordinates that are NaN, e.g. because they were warped from outside of
+    an approximator's grid, become -1 so that they are out of bounds of any
+    array that they index.
+
+    :param values: a floating-point array of warped coordinates. It is
+    overwritten with the rounded values.
+    :param out: an integer array of the same shape to receive the result.
+    If None, an int32 array is allocated.
+    :returns: the integer array
+    """
+    if out is None:
+        out = np.zeros(values.shape, np.int32)
+    values[np.isnan(values)] = -1
+    np.rint(values, out=values)
+    out[...] = values
+    return out
+
+
+def thin_plate_system(nodes, smooth=0):
+    """The linear system whose solution gives a thin-plate spline
+
+    :param nodes: an N x M array of node coordinates
+    :param smooth: smoothing factor, added to the kernel's diagonal. Zero
+    interpolates the nodes exactly and larger values fit them more loosely.
+    :returns: the (N + M + 1) x (N + M + 1) matrix of the kernel between
+    the nodes, bordered by the affine block - a column of ones and the node
+    coordinates.
+    """
+    n_nodes, input_dim = nodes.shape
+    n_affine = input_dim + 1
+    a = np.zeros((n_nodes + n_affine, n_nodes + n_affine))
+    a[:n_nodes, :n_nodes] = thin_plate_kernel(cdist(nodes, nodes))
+    a[:n_nodes, :n_nodes] += np.eye(n_nodes) * smooth
+    a[:n_nodes, n_nodes] = 1
+    a[:n_nodes, n_nodes + 1:] = nodes
+    a[n_nodes:, :n_nodes] = a[:n_nodes, n_nodes:].transpose()
+    return a
+
+
+class ThinPlateSpline:
+    """A thin-plate spline that maps an M-D space to an M'-D space
+
+    The kernel matrix and its affine block are built and factorized once and
+    the coefficients for all output dimensions are found with a single
+    multi-right-hand-side solve.
+    """
+
+    def __init__(self, src_coords, dest_coords, smooth=0):
+        """Constructor
+
+        :param src_coords: an N x M array of node coordinates
+        :param dest_coords: an N x M' array of the values at the nodes
+        :param smooth: smoothing factor. Zero interpolates the nodes exactly.
+        """
+        self.nodes = np.atleast_2d(np.asarray(src_coords, float))
+        dest_coords = np.atleast_2d(np.asarray(dest_coords, float))
+        n_nodes, input_dim = self.nodes.shape
+        n_affine = input_dim + 1
+        a = thin_plate_system(self.nodes, smooth)
+        rhs = np.zeros((n_nodes + n_affine, dest_coords.shape[1]))
+        rhs[:n_nodes] = dest_coords
+        lu, piv = lu_factor(a, check_finite=False)
+        if np.any(np.diag(lu) == 0):
+            raise np.linalg.LinAlgError(
+                "The thin-plate system is singular. At least %d affinely "
+                "independent points are needed." % n_affine)
+        coefs = lu_solve((lu, piv), rhs, check_finite=False)
+        self.weights = coefs[:n_nodes]
+        self.affine = coefs[n_nodes:]
+
+    @classmethod
+    def from_coefficients(cls, nodes, weights, affine):
+        """Make a thin-plate spline from previously fitted coefficients
+
+        :param nodes: the N x M array of node coordinates
+        :param weights: the N x M' array of kernel weights
+        :param affine: the (M + 1) x M' array of the affine part's
+        coefficients - the offset followed by the linear coefficients.
+        """
+        tps = cls.__new__(cls)
+        tps.nodes = np.asarray(nodes, float)
+        tps.weights = np.asarray(weights, float)
+        tps.affine = np.asarray(affine, float)
+        return tps
+
+    @property
+    def input_dim(self):
+        return self.nodes.shape[1]
+
+    @property
+    def output_dim(self):
+        return self.weights.shape[1]
+
+    @property
+    def bytes_per_point(self):
+        """Bytes of temporary storage needed to evaluate one coordinate"""
+        return 3 * 8 * len(self.nodes)
+
+    def __call__(self, coords):
+        """Evaluate the spline
+
+        :param coords: a K x M array of coordinates
+        :returns: a K x M' array of values
+        """
+        coords = np.atleast_2d(np.asarray(coords, float))
+        result = np.dot(
+            thin_plate_kernel(cdist(coords, self.nodes), overwrite=True),
+            self.weights)
+        result += self.affine[0]
+        result += np.dot(coords, self.affine[1:])
+        return result
+
+    @property
+    def far_field(self):
+        """The ThinPlateFarField of the nodes, built on first use"""
+        if getattr(self, "_far_field", None) is None:
+            self._far_field = ThinPlateFarField(self.nodes, self.weights)
+        return self._far_field
+
+    def evaluate(self, coords, tolerance, max_bytes=None):
+        """Evaluate the spline to within a tolerance
+
+        :param coords: a K x M array of coordinates
+        :param tolerance: the maximum allowed error in each output coordinate
+        :param max_bytes: the memory budget for temporary storage
+        :returns: a two-tuple of the K x M' array of values and a K-element
+        array of bounds on the error of each point's values.
+        """
+        coords = np.atleast_2d(np.asarray(coords, float))
+        result, error = self.far_field.evaluate(coords, tolerance, max_bytes)
+        result += self.affine[0]
+        result += np.dot(coords, self.affine[1:])
+        return result, error
+
+
+"""The highest number of Chebyshev nodes per axis of a far-field interpolant"""
+MAX_FAR_FIELD_ORDER = 8
+
+
+def chebyshev_nodes(n):
+    """The n Chebyshev nodes of the first kind on the interval [-1, 1]"""
+    return np.cos((2 * np.arange(n) + 1) * np.pi / (2 * n))
+
+
+def lagrange_weights(t, nodes):
+    """The Lagrange interpolation weights of each node at each coordinate
+
+    :param t: a K-element array of coordinates
+    :param nodes: the n interpolation nodes
+    :returns: a K x n array of the Lagrange basis polynomials of the nodes
+    evaluated at the coordinates
+    """
+    t = np.asarray(t, float)
+    result = np.ones((len(t), len(nodes)))
+    for j, node in enumerate(nodes):
+        for k, other in enumerate(nodes):
+            if j != k:
+                result[:, j] *= (t - other) / (node - other)
+    return result
+
+
+def far_field_error_factor(n, half_widths):
+    """Bound the error of interpolating the thin-plate kernel over a box
+
+    The function y -> |x - y| ** 2 log |x - y| is interpolated on a tensor
+    grid of n Chebyshev nodes per axis over a box of the given half widths.
+    Along any line, its n'th derivative is at most
+    (n - 3)! (4 n ** 2 - 8 n + 2) / r ** (n - 2), where r is the distance
+    from x to the box, which gives the one-dimensional Chebyshev error bound.
+    The tensor-product interpolation error is at most the sum of these,
+    amplified by the Lebesgue constant of the other axes.
+
+    :param n: the number of nodes per axis, at least 3
+    :param half_widths: the half widths of the box along each axis
+    :returns: the factor that, multiplied by r ** (2 - n), bounds the error
+    """
+    half_widths = np.asarray(half_widths, float)
+    lebesgue = 2 / np.pi * np.log(n + 1) + 1
+    derivative = math.factorial(n - 3) * (4 * n * n - 8 * n + 2)
+    return lebesgue ** (len(half_widths) - 1) * derivative * \
+        np.sum(2 * (half_widths / 2) ** n) / math.factorial(n)
+
+
+class ThinPlateFarField:
+    """Evaluate the thin-plate kernel sum to within a tolerance
+
+    The points being evaluated are split into boxes. For each box, the
+    nodes within a margin of the box are summed exactly. The sum over the
+    rest of the nodes is a smooth function within the box, so it is
+    computed exactly only on a small grid of Chebyshev nodes and
+    interpolated at the points. The interpolation error is bounded by
+    far_field_error_factor() using the distance from each far node to the
+    box, and the fewest Chebyshev nodes that are within the tolerance are
+    used. Boxes that would need too many, or that have too many nodes
+    nearby for interpolation to pay off, are split in two.
+
+    With a box holding many points, each point costs an interpolation plus
+    the nearby nodes instead of a sum over all nodes. If the points are too
+    sparse or the warp too rough, the exact sum is used.
+    """
+
+    def __init__(self, nodes, weights, separation=1.0,
+                 max_order=MAX_FAR_FIELD_ORDER):
+        """Constructor
+
+        :param nodes: the N x M array of node coordinates
+        :param weights: the N x M' array of kernel weights
+        :param separation: the margin around a box within which nodes are
+        summed exactly, as a multiple of the box's half diagonal
+        :param max_order: the most Chebyshev nodes to use per axis
+        """
+        self.nodes = np.atleast_2d(np.asarray(nodes, float))
+        self.weights = np.atleast_2d(np.asarray(weights, float))
+        self.tree = cKDTree(self.nodes)
+        self.separation = separation
+        self.orders = np.arange(3, max_order + 1)
+
+    @property
+    def bytes_per_point(self):
+        """Bytes of temporary storage needed to evaluate one coordinate"""
+        input_dim = self.nodes.shape[1]
+        output_dim = self.weights.shape[1]
+        return 8 * (2 * self.orders[-1] ** (input_dim - 1) * output_dim +
+                    2 * input_dim * self.orders[-1] + 6 * output_dim)
+
+    def exact(self, coords, indices, max_bytes=None):
+        """Sum the weighted kernels of some of the nodes exactly
+
+        :param coords: a K x M array of coordinates
+        :param indices: the indices of the nodes to sum
+        :param max_bytes: the memory budget for temporary storage
+        :returns: a K x M' array of sums
+        """
+        nodes = self.nodes[indices]
+        weights = self.weights[indices]
+        return evaluate_in_chunks(
+            lambda c: np.dot(thin_plate_kernel(cdist(c, nodes),
+                                               overwrite=True), weights),
+            coords, weights.shape[1], 3 * 8 * max(1, len(nodes)),
+            max_bytes=max_bytes)
+
+    def evaluate(self, coords, tolerance, max_bytes=None):
+        """Sum the weighted kernels at each coordinate to within a tolerance
+
+        :param coords: a K x M array of coordinates
+        :param tolerance: the maximum allowed error in each output coordinate
+        :param max_bytes: the memory budget for the exact sums
+        :returns: a two-tuple of the K x M' array of sums and a K-element array
+        of bounds on the error of each point's sums.
+        """
+        coords = np.atleast_2d(np.asarray(coords, float))
+        input_dim = coords.shape[1]
+        result = np.zeros((len(coords), self.weights.shape[1]))
+        error = np.zeros(len(coords))
+        all_nodes = np.arange(len(self.nodes))
+        stack = [np.arange(len(coords))]
+        while stack:
+            points = stack.pop()
+            if len(points) < self.orders[0] ** input_dim:
+                result[points] = self.exact(coords[points], all_nodes,
+                                            max_bytes)
+                continue
+            lo = np.min(coords[points], 0)
+            hi = np.max(coords[points], 0)
+            center = (lo + hi) / 2
+            half_widths = np.maximum((hi - lo) / 2, .5)
+            radius = np.sqrt(np.sum(np.square(half_widths)))
+            near = np.array(self.tree.query_ball_point(
+                center, radius * (1 + self.separation)), int)
+            is_far = np.ones(len(self.nodes), bool)
+            is_far[near] = False
+            far = all_nodes[is_far]
+            distances = np.sqrt(np.sum(np.square(
+                self.nodes[far] - center), 1)) - radius
+            order = None
+            if len(far) > 0:
+                abs_weights = np.abs(self.weights[far])
+                for n in self.orders:
+                    bound = far_field_error_factor(n, half_widths) * np.max(
+                        np.dot(distances ** (2.0 - n), abs_weights))
+                    if bound <= tolerance:
+                        order = n
+                        break
+            worthwhile = order is not None and \
+                order ** input_dim * (len(far) + len(points)) + \
+                len(points) * len(near) < len(points) * len(all_nodes)
+            if not worthwhile:
+                #
+                # Either the box is too big for the far field to be smooth
+                # enough or there are too many nodes near it for
+                # interpolation to pay off. Split it, but only if it holds
+                # enough points that the parts that are small enough are
+                # still worth interpolating.
+                #
+                min_points = 2 * self.orders[0] ** input_dim
+                if order is None and len(far) > 0:
+                    min_points *= max(1, bound / tolerance)
+                if radius > 1 and len(points) >= min_points:
+                    dim = np.argmax(hi - lo)
+                    split = np.argsort(coords[points, dim], kind="stable")
+                    middle = len(points) // 2
+                    stack.append(points[split[:middle]])
+                    stack.append(points[split[middle:]])
+                else:
+                    result[points] = self.exact(coords[points], all_nodes,
+                                                max_bytes)
+                continue
+            cheb = chebyshev_nodes(order)
+            grid = np.meshgrid(*[c + cheb * a for c, a in
+                                 zip(center, half_widths)], indexing="ij")
+            grid = np.column_stack([_.flatten() for _ in grid])
+            values = self.exact(grid, far, max_bytes).reshape(
+                (order,) * input_dim + (-1,))
+            offsets = (coords[points] - center) / half_widths
+            for d in range(input_dim):
+                w = lagrange_weights(offsets[:, d], cheb)
+                if d == 0:
+                    values = np.dot(w, values.reshape(order, -1))
+                else:
+                    values = np.einsum(
+                        "ka,ka...->k...", w,
+                        values.reshape((len(points), order, -1)))
+            result[points] = values.reshape(len(points), -1)
+            result[points] += self.exact(coords[points], near, max_bytes)
+            error[points] = bound
+        return result, error
+
+
+def wendland_kernel(r, radius):
+    """The Wendland C2 compactly-supported radial basis function
+
+    (1 - r / radius) ** 4 * (4 * r / radius + 1), which is zero beyond the
+    radius and positive definite in up to three dimensions.
+
+    :param r: an array of distances
+    :param radius: the radius of support
+    :returns: the kernel evaluated at each distance
+    """
+    t = np.clip(1 - np.asarray(r, float) / radius, 0, 1)
+    return np.square(np.square(t)) * (5 - 4 * t)
+
+
+"""The default radius of a WendlandSpline's kernel is the median distance
+from a node to its DEFAULT_WENDLAND_NEIGHBORS'th nearest neighbor"""
+DEFAULT_WENDLAND_NEIGHBORS = 30
+
+
+class WendlandSpline:
+    """A compactly-supported radial basis function warp
+
+    The affine part of the warp is fit to the nodes by least squares and the
+    residuals are interpolated with the Wendland C2 kernel. The kernel is
+    zero past its radius, so the kernel matrix is sparse. It is also
+    symmetric positive definite and well-conditioned, so it is solved by
+    conjugate gradients. Each point is only evaluated against the nodes
+    within the radius, found with a KD tree. This keeps tens of
+    thousands of nodes tractable, where the thin-plate spline's dense system
+    is not.
+    """
+
+    def __init__(self, src_coords, dest_coords, radius=None, smooth=0):
+        """Constructor
+
+        :param src_coords: an N x M array of node coordinates
+        :param dest_coords: an N x M' array of the values at the nodes
+        :param radius: the radius of support of the kernel. Each node only
+        affects the warp within this distance. Defaults to the median
+        distance to a node's DEFAULT_WENDLAND_NEIGHBORS'th nearest neighbor.
+        :param smooth: smoothing factor. Zero interpolates the nodes exactly.
+        """
+        self.nodes = np.atleast_2d(np.asarray(src_coords, float))
+        dest_coords = np.atleast_2d(np.asarray(dest_coords, float))
+        n_nodes = len(self.nodes)
+        self.tree = cKDTree(self.nodes)
+        if radius is None:
+            k = min(DEFAULT_WENDLAND_NEIGHBORS, n_nodes - 1)
+            if k > 0:
+                distances, _ = self.tree.query(self.nodes, k + 1)
+                radius = np.median(distances[:, -1])
+            if not radius:
+                radius = 1.0
+        self.radius = float(radius)
+        a = np.column_stack([np.ones(n_nodes), self.nodes])
+        self.affine = np.linalg.lstsq(a, dest_coords, rcond=None)[0]
+        residuals = dest_coords - np.dot(a, self.affine)
+        pairs = self.tree.sparse_distance_matrix(
+            self.tree, self.radius, output_type="ndarray")
+        pairs = pairs[pairs["i"] != pairs["j"]]
+        diagonal = np.arange(n_nodes)
+        kernel = coo_matrix(
+            (np.hstack([wendland_kernel(pairs["v"], self.radius),
+                        np.ones(n_nodes) + smooth]),
+             (np.hstack([pairs["i"], diagonal]),
+              np.hstack([pairs["j"], diagonal]))),
+            shape=(n_nodes, n_nodes))
+        kernel = kernel.tocsr()
+        self.weights = np.zeros(residuals.shape)
+        for d in range(residuals.shape[1]):
+            try:
+                self.weights[:, d], info = cg(kernel, residuals[:, d],
+                                              rtol=1e-10)
+            except TypeError:
+                # SciPy before 1.12 calls the tolerance "tol"
+                self.weights[:, d], info = cg(kernel, residuals[:, d],
+                                              tol=1e-10)
+            if info != 0:
+                # Fall back to a direct solve if CG stalls
+                self.weights = splu(kernel.tocsc()).solve(residuals)
+                break
+        self.mean_neighbors = 1 + len(pairs) / n_nodes
+
+    @property
+    def input_dim(self):
+        return self.nodes.shape[1]
+
+    @property
+    def output_dim(self):
+        return self.weights.shape[1]
+
+    @property
+    def bytes_per_point(self):
+        """Bytes of temporary storage needed to evaluate one coordinate"""
+        return 6 * 8 * (self.mean_neighbors + self.output_dim)
+
+    def __call__(self, coords):
+        """Evaluate the spline
+
+        :param coords: a K x M array of coordinates
+        :returns: a K x M' array of values
+        """
+        coords = np.atleast_2d(np.asarray(coords, float))
+        pairs = cKDTree(coords).sparse_distance_matrix(
+            self.tree, self.radius, output_type="ndarray")
+        kernel = coo_matrix(
+            (wendland_kernel(pairs["v"], self.radius),
+             (pairs["i"], pairs["j"])),
+            shape=(len(coords), len(self.nodes)))
+        result = kernel.tocsr().dot(self.weights)
+        result += self.affine[0]
+        result += np.dot(coords, self.affine[1:])
+        return result
+
+
+class RbfStack:
+    """One scipy.interpolate.Rbf per output dimension
+
+    This is used for radial basis functions other than the thin-plate spline.
+    """
+
+    def __init__(self, src_coords, dest_coords, **kwds):
+        """Constructor
+
+        :param src_coords: an N x M array of node coordinates
+        :param dest_coords: an N x M' array of the values at the nodes
+        :param kwds: keyword arguments for scipy.interpolate.Rbf
+        """
+        src_args = [src_coords[:, _] for _ in range(src_coords.shape[1])]
+        self.rbfs = [
+            Rbf(*tuple(src_args + [dest_coords[:, _]]), **kwds)
+            for _ in range(dest_coords.shape[1])
+        ]
+
+    @property
+    def nodes(self):
+        """The N x M array of node coordinates"""
+        return self.rbfs[0].xi.transpose()
+
+    @property
+    def bytes_per_point(self):
+        """Bytes of temporary storage needed to evaluate one coordinate"""
+        rbf = self.rbfs[0]
+        return (rbf.xi.shape[0] + 3) * 8 * rbf.xi.shape[1]
+
+    def __call__(self, coords):
+        """Evaluate the radial basis functions
+
+        :param coords: a K x M array of coordinates
+        :returns: a K x M' array of values
+        """
+        coords = np.atleast_2d(coords)
+        return np.column_stack([
+            rbf(*coords.transpose()) for rbf in self.rbfs])
+
+
+"""The number of nodes added to each edge of a cubic B-spline grid
+
+The grid is extended by point reflection about its edge nodes before
+computing the spline coefficients, so that linear trends (e.g. the identity
+part of a warp) continue smoothly past the edges instead of being bent flat.
+"""
+BSPLINE_PAD = 12
+
+
+def bspline_weights(t):
+    """The weights of the four cubic B-spline basis functions
+
+    :param t: the fractional position within the interval, between 0 and 1
+    :returns: a K x 4 array of weights for the nodes at offsets -1, 0, 1
+    and 2 from the start of the interval
+    """
+    t2 = t * t
+    t3 = t2 * t
+    return np.column_stack([
+        (1 - t) ** 3 / 6,
+        (3 * t3 - 6 * t2 + 4) / 6,
+        (-3 * t3 + 3 * t2 + 3 * t + 1) / 6,
+        t3 / 6])
+
+
+def bspline_derivative_weights(t):
+    """The derivatives of the four cubic B-spline basis functions
+
+    :param t: the fractional position within the interval, between 0 and 1
+    :returns: a K x 4 array of the derivatives of the weights with respect
+    to t for the nodes at offsets -1, 0, 1 and 2 from the start of the
+    interval
+    """
+    t2 = t * t
+    return np.column_stack([
+        -(1 - t) ** 2 / 2,
+        (3 * t2 - 4 * t) / 2,
+        (-3 * t2 + 2 * t + 1) / 2,
+        t2 / 2])
 
 
 class Approximator:
-    def __init__(self, interpolators):
-        self.interpolators = interpolators
+    """Approximate a warp by interpolating values sampled on a grid
+
+    The warped coordinates at the grid nodes are held in a single array with
+    one trailing dimension per output coordinate so that the grid search and
+    interpolation weights are computed once per point for all outputs.
+    Points outside of the grid are warped to NaN.
+    """
+
+    def __init__(self, axes, values, order=1, dtype=np.float64):
+        """Constructor
+
+        :param axes: one array per source dimension giving the nodes of the
+        grid in ascending order.
+        :param values: an array of the warped coordinates at each node of the
+        grid, e.g. of shape (Z, Y, X, 3) for a 3D grid in a 3D space.
+        :param order: the interpolation order - 1 for linear interpolation
+        or 3 for cubic B-splines. Cubic B-splines treat the grid as evenly
+        spaced in index space and interpolate the values at the nodes.
+        :param dtype: the floating-point type of the grid and of the warped
+        coordinates. np.float32 halves the memory traffic of warping at the
+        cost of precision, which is ample for voxel coordinates.
+        """
+        if order not in (1, 3):
+            raise ValueError("Order must be 1 or 3, not %s" % str(order))
+        self.axes = [np.asarray(axis, float) for axis in axes]
+        self.dtype = np.dtype(dtype)
+        self.values = np.asarray(values, self.dtype)
+        self.order = order
+        self.input_dim = len(self.axes)
+        self.output_dim = self.values.shape[-1]
+        assert self.values.shape[:-1] == tuple(map(len, self.axes))
+        coefficients = self.values
+        if order == 3:
+            self.pad = BSPLINE_PAD
+            coefficients = np.pad(
+                coefficients.astype(float),
+                [(self.pad, self.pad)] * self.input_dim + [(0, 0)],
+                mode="reflect", reflect_type="odd")
+            for axis in range(self.input_dim):
+                coefficients = spline_filter1d(
+                    coefficients, order=3, axis=axis, mode="mirror")
+            coefficients = coefficients.astype(self.dtype)
+        else:
+            self.pad = 0
+        self.coefficient_shape = coefficients.shape[:-1]
+        self.coefficients = coefficients.reshape(-1, self.output_dim)
+
+    @property
+    def bytes_per_point(self):
+        """Bytes of temporary storage needed to warp one coordinate"""
+        n_corners = (self.order + 1) ** self.input_dim
+        return 8 * 4 * self.input_dim * (self.order + 1) + \
+            self.dtype.itemsize * (3 * self.output_dim + n_corners)
+
+    def locate(self, coords, derivatives=False):
+        """Find the grid nodes and interpolation weights for coordinates
+
+        :param coords: a K x M array of coordinates in the source space
+        :param derivatives: if True, also return the derivatives of the
+        weights with respect to the coordinates.
+        :returns: a 3-tuple of a sequence of K x (order + 1) indices into the
+        coefficients per axis, a sequence of K x (order + 1) weights per axis
+        and a K-element mask of the coordinates that are within the grid.
+        If derivatives is True, the sequence of K x (order + 1) weight
+        derivatives per axis is returned as a fourth element.
+        """
+        mask = np.ones(len(coords), bool)
+        indices = []
+        weights = []
+        dweights = []
+        for d, x in enumerate(coords.transpose()):
+            index, weight, axis_mask, dweight = \
+                self.locate_on_axis(d, x, derivatives)
+            mask &= axis_mask
+            indices.append(index)
+            weights.append(weight)
+            dweights.append(dweight)
+        if derivatives:
+            return indices, weights, mask, dweights
+        return indices, weights, mask
+
+    def locate_on_axis(self, d, x, derivatives=False):
+        """Find the nodes and interpolation weights along one axis
+
+        :param d: the index of the axis
+        :param x: a K-element array of coordinates along the axis
+        :param derivatives: if True, compute the derivatives of the weights
+        :returns: a 4-tuple of the K x (order + 1) indices into the
+        coefficients along the axis, the K x (order + 1) weights, a K-element
+        mask of the coordinates within the grid and the K x (order + 1)
+        weight derivatives (None if not requested).
+        """
+        axis = self.axes[d]
+        x = np.asarray(x, float)
+        n = len(axis)
+        mask = (x >= axis[0]) & (x <= axis[-1])
+        i = np.clip(np.searchsorted(axis, x, side="right") - 1,
+                    0, max(0, n - 2))
+        if n == 1:
+            t = np.zeros(len(x))
+            dtdx = np.zeros(len(x))
+        else:
+            dtdx = 1 / (axis[i + 1] - axis[i])
+            with np.errstate(invalid="ignore"):
+                t = (x - axis[i]) * dtdx
+        t[~ mask] = 0
+        dweight = None
+        if self.order == 1:
+            index = np.column_stack([i, np.minimum(i + 1, n - 1)])
+            weight = np.column_stack([1 - t, t])
+            if derivatives:
+                dweight = np.column_stack([-dtdx, dtdx])
+        else:
+            index = i[:, np.newaxis] + self.pad + \
+                np.arange(-1, 3)[np.newaxis, :]
+            weight = bspline_weights(t)
+            if derivatives:
+                dweight = bspline_derivative_weights(t) * dtdx[:, np.newaxis]
+        return index, weight, mask, dweight
+
+    def interpolate(self, coords):
+        """Interpolate the grid at the given coordinates
+
+        :param coords: a K x M array of coordinates in the source space
+        :returns: a K x M' array of coordinates in the destination space
+        """
+        coords = np.atleast_2d(np.asarray(coords, float))
+        indices, weights, mask = self.locate(coords)
+        shape = self.coefficient_shape
+        result = np.zeros((len(coords), self.output_dim), self.dtype)
+        for corner in itertools.product(range(self.order + 1),
+                                        repeat=self.input_dim):
+            idx = np.ravel_multi_index(
+                [index[:, c] for index, c in zip(indices, corner)], shape)
+            w = weights[0][:, corner[0]].astype(self.dtype)
+            for weight, c in zip(weights[1:], corner[1:]):
+                w *= weight[:, c]
+            result += self.coefficients[idx] * w[:, np.newaxis]
+        result[~ mask] = np.nan
+        return result
+
+    def warp_plane(self, z, shape, stride=1, out=None, start=0):
+        """Warp every point in a plane of constant z
+
+        The tensor-product spline is separable, so the grid is interpolated
+        along z once for the whole plane, then along x for each column and
+        finally along y for each row, without building per-point
+        coordinate arrays.
+
+        :param z: the z coordinate of the plane
+        :param shape: the height and width of the plane
+        :param stride: the spacing between the warped points in the y and x
+        directions, either a single number or a (y, x) two-tuple. Points
+        0, stride, 2 * stride... are warped.
+        :param out: an array of shape (M', H', W') to receive the result.
+        If it has an integer type, the coordinates are rounded as by
+        round_to_int(), without making a floating-point copy of the plane.
+        :param start: the coordinates of the first point to warp in the y
+        and x directions, either a single number or a (y, x) two-tuple. The
+        points start, start + stride... up to but not including shape are
+        warped, so a rectangle within the plane can be warped by giving its
+        corners as start and shape.
+        :returns: an array of shape (M', H', W') giving the warped coordinates
+        of each point, e.g. three maps of the z, y and x coordinates.
+        Points outside of the grid are NaN.
+        """
+        assert self.input_dim == 3, "warp_plane needs a 3D source space"
+        if np.isscalar(stride):
+            stride = (stride, stride)
+        if np.isscalar(start):
+            start = (start, start)
+        coefficients = self.coefficients.reshape(
+            self.coefficient_shape + (self.output_dim,))
+        zindex, zweight, zmask, _ = self.locate_on_axis(0, [z])
+        slab = np.zeros(coefficients.shape[1:], self.dtype)
+        for a in range(zindex.shape[1]):
+            slab += coefficients[zindex[0, a]] * zweight[0, a]
+        y = np.arange(start[0], shape[0], stride[0])
+        x = np.arange(start[1], shape[1], stride[1])
+        yindex, yweight, ymask, _ = self.locate_on_axis(1, y)
+        xindex, xweight, xmask, _ = self.locate_on_axis(2, x)
+        yweight = yweight.astype(self.dtype)
+        xweight = xweight.astype(self.dtype)
+        if out is None:
+            out = np.zeros((self.output_dim, len(y), len(x)), self.dtype)
+        is_integer = np.issubdtype(out.dtype, np.integer)
+        mask = zmask[0] & ymask[:, np.newaxis] & xmask[np.newaxis, :]
+        for d in range(self.output_dim):
+            columns = np.zeros((slab.shape[0], len(x)), self.dtype)
+            for b in range(xindex.shape[1]):
+                columns += slab[:, xindex[:, b], d] * xweight[:, b]
+            if is_integer:
+                plane = np.zeros((len(y), len(x)), self.dtype)
+            else:
+                plane = out[d]
+                plane[:] = 0
+            for a in range(yindex.shape[1]):
+                plane += columns[yindex[:, a]] * yweight[:, a, np.newaxis]
+            plane[~ mask] = np.nan
+            if is_integer:
+                round_to_int(plane, out[d])
+        return out
+
+    def changed_coefficients(self, reference, threshold):
+        """Find the coefficients that differ from those of another grid
+
+        The interpolation weights are non-negative and sum to one, so a point
+        whose interpolation involves none of the changed coefficients is
+        warped to within the threshold of where the reference warps it.
+
+        :param reference: an Approximator with the same grid and order or
+        an array of its coefficients.
+        :param threshold: coefficients that differ by more than this in
+        any output dimension are changed.
+        :returns: a boolean array of shape coefficient_shape that is True
+        for the changed coefficients.
+        """
+        if isinstance(reference, Approximator):
+            assert reference.order == self.order
+            assert all([len(a) == len(b) and np.all(a == b)
+                        for a, b in zip(reference.axes, self.axes)]), \
+                "The approximators must have the same grid"
+            reference = reference.coefficients
+        reference = np.asarray(reference).reshape(self.coefficients.shape)
+        with np.errstate(invalid="ignore"):
+            changed = np.abs(self.coefficients - reference) > threshold
+        changed |= np.isnan(self.coefficients) != np.isnan(reference)
+        return np.any(changed, 1).reshape(self.coefficient_shape)
+
+    def changed_region(self, changed, z, shape):
+        """Find the rectangle of a plane that uses changed coefficients
 
-    def __call__(self, *src_coords):
+        :param changed: the boolean array from changed_coefficients()
+        :param z: the z coordinate of the plane
+        :param shape: the height and width of the plane
+        :returns: None if no point in the plane is interpolated from a
+        changed coefficient, otherwise the (y0, x0) and (y1, x1) corners of
+        the smallest rectangle holding every point that is, suitable for
+        the start and shape arguments of warp_plane().
+        """
+        assert self.input_dim == 3, "changed_region needs a 3D source space"
+        zindex, _, _, _ = self.locate_on_axis(0, [z])
+        slab = np.any(changed[zindex[0]], 0)
+        corners = []
+        for d, (axis_changed, size) in enumerate(
+                ((np.any(slab, 1), shape[0]), (np.any(slab, 0), shape[1]))):
+            index, _, _, _ = self.locate_on_axis(d + 1, np.arange(size))
+            hits = np.where(np.any(axis_changed[index], 1))[0]
+            if len(hits) == 0:
+                return None
+            corners.append((hits[0], hits[-1] + 1))
+        (y0, y1), (x0, x1) = corners
+        return (y0, x0), (y1, x1)
+
+    def jacobian(self, coords):
+        """Interpolate the grid and its derivatives at the given coordinates
+
+        :param coords: a K x M array of coordinates in the source space
+        :returns: a two-tuple of the K x M' array of coordinates in the
+        destination space and the K x M' x M array of the derivatives of
+        each destination coordinate with respect to each source coordinate.
+        """
+        coords = np.atleast_2d(np.asarray(coords, float))
+        indices, weights, mask, dweights = self.locate(coords, True)
+        shape = self.coefficient_shape
+        result = np.zeros((len(coords), self.output_dim))
+        jacobian = np.zeros((len(coords), self.output_dim, self.input_dim))
+        for corner in itertools.product(range(self.order + 1),
+                                        repeat=self.input_dim):
+            idx = np.ravel_multi_index(
+                [index[:, c] for index, c in zip(indices, corner)], shape)
+            coefficients = self.coefficients[idx]
+            w = [weight[:, c] for weight, c in zip(weights, corner)]
+            dw = [dweight[:, c] for dweight, c in zip(dweights, corner)]
+            result += coefficients * np.prod(w, 0)[:, np.newaxis]
+            for d in range(self.input_dim):
+                wd = np.prod(w[:d] + [dw[d]] + w[d+1:], 0)
+                jacobian[:, :, d] += coefficients * wd[:, np.newaxis]
+        result[~ mask] = np.nan
+        jacobian[~ mask] = np.nan
+        return result, jacobian
+
+    def inverse(self, *args, tolerance=.01, max_iterations=50):
+        """Create an approximator of the inverse of this one
+
+        The inverse is sampled on a grid in the destination space. Each node
+        of that grid is mapped back into the source space using Newton's
+        method, starting from the source grid node whose warped position is
+        nearest. Nodes that don't converge, e.g. because their preimage lies
+        outside of this approximator's grid, are set to NaN. Cubic B-splines
+        are filtered over the whole grid, so for them the unconverged nodes
+        take the value of the nearest converged node before filtering and
+        are only NaN in the inverse's "values".
+
+        :param args: one array per destination dimension giving the nodes of
+        the inverse's grid in ascending order. Defaults to a grid spanning
+        the warped grid's bounding box with as many nodes per axis as this
+        grid.
+        :param tolerance: the Newton iteration stops for a node when the
+        warped position of its estimate is this close to the node.
+        :param max_iterations: the maximum number of Newton iterations.
+        :returns: an Approximator from the destination space to the source
+        space. Its "converged" attribute is a boolean array with the shape
+        of its grid that is True for nodes that converged.
+        """
+        assert self.input_dim == self.output_dim, \
+            "Only warps between spaces of the same dimension can be inverted"
+        nodes = self.values.reshape(-1, self.output_dim)
+        finite = np.all(np.isfinite(nodes), 1)
+        if len(args) == 0:
+            args = [np.linspace(np.min(nodes[finite, d]),
+                                np.max(nodes[finite, d]), len(axis))
+                    for d, axis in enumerate(self.axes)]
+        axes = [np.asarray(arg, float) for arg in args]
+        assert len(axes) == self.output_dim
+        grid = np.meshgrid(*axes, indexing="ij")
+        targets = np.column_stack([_.flatten() for _ in grid])
+        src_grid = np.meshgrid(*self.axes, indexing="ij")
+        src_nodes = np.column_stack([_.flatten() for _ in src_grid])[finite]
+        _, nearest = cKDTree(nodes[finite]).query(targets)
+        x = src_nodes[nearest]
+        lo = np.array([axis[0] for axis in self.axes])
+        hi = np.array([axis[-1] for axis in self.axes])
+        converged = np.zeros(len(targets), bool)
+        active = np.arange(len(targets))
+        for iteration in range(max_iterations + 1):
+            fx, jx = self.jacobian(x[active])
+            residual = fx - targets[active]
+            done = np.sqrt(np.sum(np.square(residual), 1)) <= tolerance
+            converged[active[done]] = True
+            active, residual, jx = \
+                active[~ done], residual[~ done], jx[~ done]
+            if len(active) == 0 or iteration == max_iterations:
+                break
+            invertible = np.abs(np.linalg.det(jx)) > np.finfo(float).eps
+            active, residual, jx = \
+                active[invertible], residual[invertible], jx[invertible]
+            step = np.linalg.solve(jx, residual[:, :, np.newaxis])[:, :, 0]
+            x[active] = np.clip(x[active] - step, lo, hi)
+        x = x.reshape(grid[0].shape + (self.input_dim,))
+        converged = converged.reshape(grid[0].shape)
+        if self.order != 1 and np.any(converged):
+            _, indices = distance_transform_edt(~ converged,
+                                                return_indices=True)
+            x = x[tuple(indices)]
+        else:
+            x[~ converged] = np.nan
+        inverse = Approximator(axes, x, order=self.order, dtype=self.dtype)
+        inverse.values[~ converged] = np.nan
+        inverse.converged = converged
+        return inverse
+
+    def __call__(self, src_coords, max_bytes=None, out=None):
         """Warp source coordinates to destination
 
         :param src_coords: an NxM array of source coordinates
-        :param dest_coords: an NxM' array of destination coordinates,
+        :param max_bytes: the memory budget for temporary storage
+        :param out: an NxM' array to receive the result. If it has an
+        integer type, the coordinates are rounded as by round_to_int().
+        :returns: an NxM' array of destination coordinates,
         approximated by the gridding of the warper
         """
         src_coords = np.atleast_2d(src_coords)
-        return np.column_stack([interpolator(src_coords).flatten()
-                                for interpolator in self.interpolators])
+        if out is None:
+            out = np.zeros((len(src_coords), self.output_dim), self.dtype)
+        if np.issubdtype(out.dtype, np.integer):
+            fn = lambda coords: round_to_int(self.interpolate(coords))
+        else:
+            fn = self.interpolate
+        return evaluate_in_chunks(
+            fn, src_coords, self.output_dim,
+            self.bytes_per_point, max_bytes=max_bytes, out=out)
 
 
 class Warper:
     """Warp arbitrary points in one ND space to another
 
-    Use an array of Rbfs to warp one space to another.
+    The thin-plate spline (the default) is solved for all output dimensions
+    at once. The "wendland" function is a compactly-supported spline with a
+    sparse solve for large numbers of points (see WendlandSpline). Other
+    radial basis functions use an array of Rbfs, one per output dimension.
     """
     def __init__(self, src_coords,
                  dest_coords,
@@ -42,10 +992,15 @@ class Warper:
         than the source.
         :param function: the radial basis function (see scipy.interpolate.Rbf).
         The default, unlike Rbf, is "thin_plate" for thin-plate splines.
+        "wendland" selects the compactly-supported WendlandSpline.
         :param epsilon: Adjustable constant if required by the radial basis
-        function (see scipy.interpolate.Rbf)
+        function (see scipy.interpolate.Rbf). For "wendland", this is the
+        radius of support.
         :param smooth: Smoothing factor. Zero means always go through each node
-        Defaults to zero.
+        Defaults to zero. For the thin-plate and Wendland splines, it is added
+        to the diagonal of the kernel matrix, so larger values give a
+        smoother warp that fits the nodes more loosely. Other functions use
+        scipy.interpolate.Rbf's convention, which subtracts it.
         :param norm: A function that computes the distance between two points.
         Defaults to Euclidean.
         """
@@ -55,52 +1010,448 @@ class Warper:
             ("smooth", smooth),
             ("norm", norm)
         ) if v is not None])
-        src_coords = np.atleast_2d(src_coords)
+        src_coords = np.atleast_2d(np.asarray(src_coords, float))
         self.input_dim = src_coords.shape[1]
-        dest_coords = np.atleast_2d(dest_coords)
+        dest_coords = np.atleast_2d(np.asarray(dest_coords, float))
         self.output_dim = dest_coords.shape[1]
-        src_args = [src_coords[:, _] for _ in range(self.input_dim)]
-        self.rbfs = [
-            Rbf(*tuple(src_args + [dest_coords[:, _]]), **kwds)
-            for _ in range(self.output_dim)
-        ]
+        if function == "thin_plate" and norm is None:
+            self.engine = ThinPlateSpline(src_coords, dest_coords,
+                                          smooth=smooth or 0)
+        elif function == "wendland":
+            self.engine = WendlandSpline(src_coords, dest_coords,
+                                         radius=epsilon, smooth=smooth or 0)
+        else:
+            self.engine = RbfStack(src_coords, dest_coords, **kwds)
 
-    def approximate(self, *args):
-        """Create an alternative warper based on cubic splines
+    @classmethod
+    def from_engine(cls, engine):
+        """Make a warper from an already-fitted engine, e.g. a ThinPlateSpline
+
+        :param engine: a function object with "input_dim", "output_dim" and
+        "bytes_per_point" attributes that transforms a K x M array of
+        coordinates into a K x M' array.
+        """
+        warper = cls.__new__(cls)
+        warper.engine = engine
+        warper.input_dim = engine.input_dim
+        warper.output_dim = engine.output_dim
+        return warper
+
+    def approximate(self, *args, order=1, tolerance=None,
+                    max_iterations=8, min_spacing=1.0, dtype=np.float64):
+        """Create an alternative warper based on splines
 
         For computational efficiency, compute a set of multivariate splines
         on a hyper-rectangular grid that approximate the warping.
 
+        If a tolerance is given, the grid is refined until the approximation
+        is within the tolerance of the exact warp at the center of every grid
+        cell. Only the grid intervals of the cells that are out of tolerance
+        are split, so the axes become non-uniform, concentrating nodes where
+        the warp bends the most. The maximum error at the centers of the
+        final grid's cells is stored in the approximator's "max_error"
+        attribute. It includes the cells that were left out of tolerance
+        because they reached min_spacing or max_iterations ran out. Cubic
+        B-splines assume evenly-spaced nodes, so for them, every interval
+        of an axis is split if any needs to be.
+
         :param args: one array per source dimension giving the nodes of the
-                     grid in ascending order.
+                     grid in ascending order. If a tolerance is given, this
+                     is the starting grid, which can be coarse.
+        :param order: 1 for linear interpolation between grid nodes or 3
+        for cubic B-splines, which reach the same accuracy on a coarser grid.
+        :param tolerance: the maximum allowed error, in destination units
+        (e.g. voxels), or None to use the grid as given.
+        :param max_iterations: the maximum number of refinement rounds
+        :param min_spacing: grid intervals this small or smaller are never
+        split.
+        :param dtype: the floating-point type of the approximator's grid and
+        output, e.g. np.float32 to halve its memory traffic.
         :returns: a function that can be used to transform
         to the destination space, valid between the first and last coordinates
         specified in the grid.
         """
         assert len(args) == self.input_dim
-        slices = tuple([slice(0, len(arg)) for arg in args])
-        grid = np.mgrid[slices]
-        gshape = grid.shape[1:]
-        arrays = [
-            rbf(*tuple([arg[grid[in_idx].flatten()]
-                        for in_idx, arg in enumerate(args)])).reshape(gshape)
-            for rbf in self.rbfs]
+        axes = [np.asarray(arg, float) for arg in args]
+        values = self.sample_grid(axes)
+        if tolerance is None:
+            return Approximator(axes, values, order=order, dtype=dtype)
+        #
+        # new_intervals marks the intervals that were split in the last
+        # round. Only cells bordering on them need to be checked again for
+        # linear interpolation. Cubic splines are not local, so all cells
+        # are checked every time. cell_errors holds the last error measured
+        # at the center of each cell, which stays valid for linear
+        # interpolation until one of the cell's intervals is split.
+        #
+        new_intervals = [np.ones(len(axis) - 1, bool) for axis in axes]
+        cell_errors = np.zeros([len(axis) - 1 for axis in axes])
+        for iteration in range(max_iterations + 1):
+            approximator = Approximator(axes, values, order=order,
+                                        dtype=dtype)
+            if order != 1:
+                new_intervals = [np.ones(len(axis) - 1, bool)
+                                 for axis in axes]
+            check = np.zeros([len(axis) - 1 for axis in axes], bool)
+            for d, new_interval in enumerate(new_intervals):
+                check |= new_interval.reshape(
+                    [-1 if _ == d else 1 for _ in range(len(axes))])
+            cells = np.column_stack(np.where(check))
+            centers = np.column_stack([
+                (axis[cells[:, d]] + axis[cells[:, d] + 1]) / 2
+                for d, axis in enumerate(axes)])
+            if len(centers) == 0:
+                errors = np.zeros(0)
+            else:
+                errors = np.max(np.abs(
+                    approximator(centers) - self.transform(centers)), 1)
+            cell_errors[check] = errors
+            approximator.max_error = \
+                float(np.max(cell_errors)) if cell_errors.size > 0 else 0.0
+            bad_cells = cells[errors > tolerance]
+            splits = []
+            for d, axis in enumerate(axes):
+                intervals = np.unique(bad_cells[:, d])
+                if order != 1 and len(intervals) > 0:
+                    intervals = np.arange(len(axis) - 1)
+                intervals = intervals[
+                    axis[intervals + 1] - axis[intervals] > min_spacing]
+                splits.append(intervals)
+            if iteration == max_iterations or \
+                    all([len(_) == 0 for _ in splits]):
+                return approximator
+            for d, intervals in enumerate(splits):
+                axis = axes[d]
+                new_coords = (axis[intervals] + axis[intervals + 1]) / 2
+                slab_axes = axes[:d] + [new_coords] + axes[d+1:]
+                slab = self.sample_grid(slab_axes)
+                order_d = np.argsort(np.hstack([axis, new_coords]),
+                                     kind="stable")
+                axes[d] = np.hstack([axis, new_coords])[order_d]
+                values = np.take(np.concatenate([values, slab], d),
+                                 order_d, axis=d)
+                parents = np.searchsorted(axis, axes[d][:-1], side="right") - 1
+                cell_errors = np.take(cell_errors, parents, axis=d)
+                #
+                # Both halves of a split interval are new.
+                #
+                is_new = np.zeros(len(axes[d]), bool)
+                is_new[np.searchsorted(axes[d], new_coords)] = True
+                new_intervals[d] = is_new[1:] | is_new[:-1]
+        return approximator
 
-        interpolators = [RegularGridInterpolator(
-            args, array, bounds_error=False)
-                         for array in arrays]
+    def inverse(self, *args, src_axes=None, order=1, **kwargs):
+        """Create an approximator of the inverse of this warp
+
+        This approximates the warp on a grid in the source space and then
+        inverts that grid (see Approximator.inverse), which is much cheaper
+        than fitting a second warper in the other direction and is
+        consistent with the forward warp.
+
+        :param args: one array per destination dimension giving the nodes of
+        the inverse's grid. Defaults to the bounding box of the warped source
+        grid.
+        :param src_axes: the axes of the grid in the source space. The
+        inverse is only defined for points that are warped from within this
+        grid. Defaults to 20 nodes per axis spanning the warper's nodes.
+        :param order: 1 for linear or 3 for cubic B-spline interpolation
+        :param kwargs: keyword arguments for Approximator.inverse
+        :returns: an Approximator from the destination to the source space
+        """
+        if src_axes is None:
+            nodes = self.engine.nodes
+            src_axes = [np.linspace(np.min(nodes[:, d]), np.max(nodes[:, d]),
+                                    20) for d in range(self.input_dim)]
+        return self.approximate(*src_axes, order=order).inverse(
+            *args, **kwargs)
 
-        return Approximator(interpolators)
+    def sample_grid(self, axes):
+        """Evaluate the warp at every node of a grid
+
+        :param axes: one array per source dimension giving the grid nodes
+        :returns: an array of shape (len(axes[0]), ..., len(axes[-1]), M')
+        of the warped coordinates at each node.
+        """
+        axes = [np.asarray(axis, float) for axis in axes]
+        grid = np.meshgrid(*axes, indexing="ij")
+        values = self.transform(np.column_stack(
+            [_.flatten() for _ in grid]))
+        return values.reshape(grid[0].shape + (self.output_dim,))
 
     def __call__(self, src_coords):
         """Transform source coordinates to destination"""
         return self.transform(src_coords)
 
-    def transform(self, src_coords):
+    def transform(self, src_coords, max_bytes=None, chunk_size=None,
+                  out=None, tolerance=None, return_error=False):
         """Transform source coordinates to destination
 
-        :param src_coords:
+        The coordinates are transformed a chunk at a time so that the
+        temporary storage stays within a memory budget.
+
+        If a tolerance is given, the thin-plate spline is evaluated with a
+        hierarchical far-field approximation (see ThinPlateFarField),
+        which only sums the nodes near each point exactly. This makes
+        warping millions of points against thousands of nodes fast.
+
+        :param src_coords: an N x M array of coordinates in the source space
+        :param max_bytes: the memory budget for temporary storage. Defaults
+        to DEFAULT_MAX_BYTES.
+        :param chunk_size: the number of coordinates to transform at a time.
+        If specified, this overrides max_bytes.
+        :param out: an N x M' array to hold the result. If None, the result
+        is allocated.
+        :param tolerance: the maximum allowed error in each destination
+        coordinate or None to evaluate the warp exactly. Only supported
+        for thin-plate splines.
+        :param return_error: if True, also return a bound on the error of
+        each point
+        :returns: an N x M' array of coordinates in the destination space.
+        If return_error is True, a two-tuple of that and an N-element array
+        of the error bounds.
         """
         src_coords = np.atleast_2d(src_coords)
-        return np.column_stack([
-            rbf(*src_coords.transpose()) for rbf in self.rbfs])
+        if tolerance is None:
+            result = evaluate_in_chunks(
+                self.engine, src_coords, self.output_dim,
+                self.engine.bytes_per_point,
+                max_bytes=max_bytes, chunk_size=chunk_size, out=out)
+            if return_error:
+                return result, np.zeros(len(src_coords))
+            return result
+        if not isinstance(self.engine, ThinPlateSpline):
+            raise ValueError(
+                "A tolerance can only be used with thin-plate splines")
+        #
+        # The error bound is evaluated as an extra output column.
+        #
+        fn = lambda coords: np.column_stack(
+            self.engine.evaluate(coords, tolerance, max_bytes))
+        result = evaluate_in_chunks(
+            fn, src_coords, self.output_dim + 1,
+            self.engine.far_field.bytes_per_point,
+            max_bytes=max_bytes, chunk_size=chunk_size)
+        if out is None:
+            out = result[:, :-1]
+        else:
+            out[:] = result[:, :-1]
+        if return_error:
+            return out, result[:, -1]
+        return out
+
+
+def leave_one_out_from_inverse(inverse_system, dest_coords):
+    """Compute leave-one-out errors from the inverse of a thin-plate system
+
+    The spline fitted to all nodes but the k'th warps node k's source
+    coordinates to dest_coords[k] - w[k] / inverse_system[k, k] where w are
+    the spline's weights (Rippa, "An algorithm for selecting a good value
+    for the parameter c in radial basis function interpolation", 1999), so
+    all N errors come from one inverse instead of N refits.
+
+    :param inverse_system: the inverse of thin_plate_system() for the nodes
+    :param dest_coords: the N x M' destination coordinates of the nodes
+    :returns: an N x M' array of the differences between each node's
+    destination coordinates and where the spline fitted to the other nodes
+    warps it. Nodes without which the system is singular have infinite
+    errors.
+    """
+    dest_coords = np.asarray(dest_coords, float)
+    n_nodes = len(dest_coords)
+    weights = np.dot(inverse_system[:n_nodes, :n_nodes], dest_coords)
+    diagonal = np.diagonal(inverse_system)[:n_nodes]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        errors = weights / diagonal[:, np.newaxis]
+    errors[np.abs(diagonal) <= np.finfo(float).eps *
+           np.max(np.abs(inverse_system))] = np.inf
+    return errors
+
+
+def leave_one_out_errors(src_coords, dest_coords, smooth=0):
+    """Compute the leave-one-out errors of a thin-plate spline's nodes
+
+    :param src_coords: an N x M array of the nodes' source coordinates
+    :param dest_coords: an N x M' array of the nodes' destination coordinates
+    :param smooth: the smoothing factor of the spline
+    :returns: an N x M' array of the differences between each node's
+    destination coordinates and where the spline fitted to the other nodes
+    warps it (see leave_one_out_from_inverse).
+    """
+    src_coords = np.atleast_2d(np.asarray(src_coords, float))
+    inverse = np.linalg.inv(thin_plate_system(src_coords, smooth))
+    return leave_one_out_from_inverse(inverse, dest_coords)
+
+
+"""The number of updates after which an IncrementalWarper solves its system
+from scratch to keep rounding errors from accumulating"""
+REFACTOR_INTERVAL = 200
+
+
+class IncrementalWarper(Warper):
+    """A thin-plate spline warper that is updated one node at a time
+
+    The inverse of the thin-plate system (see thin_plate_system) is kept
+    up to date as nodes are inserted, removed or moved. Inserting a node
+    borders the inverse with a row and column and removing one takes the
+    Schur complement of its row and column, each O(N^2) instead of the
+    O(N^3) of solving the system again. The inverse only exists once there
+    are enough affinely independent nodes. Until then, the warper is not
+    fitted and evaluating it raises np.linalg.LinAlgError.
+    """
+
+    def __init__(self, src_coords, dest_coords, smooth=0):
+        """Constructor
+
+        :param src_coords: an N x M array of coordinates in the space to be
+        warped. N may be zero.
+        :param dest_coords: an N x M' array of coordinates in the target space.
+        :param smooth: Smoothing factor. Zero means always go through each node
+        """
+        self.src_coords = np.array(src_coords, float)
+        self.dest_coords = np.array(dest_coords, float)
+        self.input_dim = self.src_coords.shape[1]
+        self.output_dim = self.dest_coords.shape[1]
+        self.smooth = smooth
+        self.refactor()
+
+    def __len__(self):
+        return len(self.src_coords)
+
+    @property
+    def fitted(self):
+        """True if there are enough nodes to warp"""
+        return self.inverse_system is not None
+
+    @property
+    def engine(self):
+        """The ThinPlateSpline for the current nodes"""
+        if self._engine is None:
+            if self.inverse_system is None:
+                raise np.linalg.LinAlgError(
+                    "The thin-plate system is singular. At least %d "
+                    "affinely independent points are needed." %
+                    (self.input_dim + 1))
+            n_nodes = len(self.src_coords)
+            coefs = np.dot(self.inverse_system[:, :n_nodes], self.dest_coords)
+            self._engine = ThinPlateSpline.from_coefficients(
+                self.src_coords, coefs[:n_nodes], coefs[n_nodes:])
+        return self._engine
+
+    def refactor(self):
+        """Invert the thin-plate system from scratch"""
+        self.inverse_system = None
+        self.n_updates = 0
+        self._engine = None
+        if len(self.src_coords) <= self.input_dim:
+            return
+        a = thin_plate_system(self.src_coords, self.smooth)
+        try:
+            inverse = np.linalg.inv(a)
+        except np.linalg.LinAlgError:
+            return
+        #
+        # A nearly-singular system, e.g. from coplanar or duplicate nodes,
+        # may not raise an exception, but its inverse will be inaccurate.
+        #
+        if not np.allclose(np.dot(a, inverse), np.eye(len(a)), atol=1e-6):
+            return
+        self.inverse_system = inverse
+
+    def leave_one_out_errors(self):
+        """Compute the leave-one-out errors of the nodes
+
+        This uses the inverse that is kept up to date, so it costs no
+        factorization.
+
+        :returns: an N x M' array of the differences between each node's
+        destination coordinates and where the spline fitted to the other
+        nodes warps it (see leave_one_out_from_inverse).
+        """
+        if self.inverse_system is None:
+            raise np.linalg.LinAlgError(
+                "The thin-plate system is singular. At least %d "
+                "affinely independent points are needed." %
+                (self.input_dim + 1))
+        return leave_one_out_from_inverse(self.inverse_system,
+                                          self.dest_coords)
+
+    def insert(self, idx, src_coord, dest_coord):
+        """Insert a node
+
+        :param idx: the index of the new node in the list of nodes
+        :param src_coord: the node's coordinates in the source space
+        :param dest_coord: the node's coordinates in the destination space
+        """
+        src_coord = np.asarray(src_coord, float)
+        old_nodes = self.src_coords
+        self.src_coords = np.insert(self.src_coords, idx, src_coord, 0)
+        self.dest_coords = np.insert(self.dest_coords, idx, dest_coord, 0)
+        self._engine = None
+        if self.inverse_system is None or \
+                self.n_updates >= REFACTOR_INTERVAL:
+            self.refactor()
+            return
+        border = np.hstack([
+            thin_plate_kernel(cdist(src_coord[np.newaxis], old_nodes))[0],
+            [1], src_coord])
+        projection = np.dot(self.inverse_system, border)
+        schur = self.smooth - np.dot(border, projection)
+        scale = np.dot(np.dot(np.abs(border), np.abs(self.inverse_system)),
+                       np.abs(border))
+        if np.abs(schur) <= 1e-9 * scale:
+            # The new node makes the system singular, e.g. a duplicate
+            self.refactor()
+            return
+        size = len(border)
+        inverse = np.zeros((size + 1, size + 1))
+        inverse[:size, :size] = self.inverse_system + \
+            np.outer(projection, projection) / schur
+        inverse[:size, size] = inverse[size, :size] = -projection / schur
+        inverse[size, size] = 1 / schur
+        #
+        # Move the new row and column from the end to the node's place
+        #
+        order = np.hstack([np.arange(idx), [size], np.arange(idx, size)])
+        self.inverse_system = inverse[order][:, order]
+        self.n_updates += 1
+
+    def remove(self, idx):
+        """Remove a node
+
+        :param idx: the index of the node to remove
+        :returns: a two-tuple of the node's source and destination coordinates
+        """
+        src_coord = self.src_coords[idx]
+        dest_coord = self.dest_coords[idx]
+        self.src_coords = np.delete(self.src_coords, idx, 0)
+        self.dest_coords = np.delete(self.dest_coords, idx, 0)
+        self._engine = None
+        if self.inverse_system is None or \
+                self.n_updates >= REFACTOR_INTERVAL or \
+                len(self.src_coords) <= self.input_dim:
+            self.refactor()
+            return src_coord, dest_coord
+        inverse = self.inverse_system
+        keep = np.arange(len(inverse)) != idx
+        pivot = inverse[idx, idx]
+        if np.abs(pivot) <= 1e-9 * np.max(np.abs(inverse[idx])):
+            # The remaining nodes make the system singular
+            self.refactor()
+            return src_coord, dest_coord
+        self.inverse_system = inverse[keep][:, keep] - \
+            np.outer(inverse[keep, idx], inverse[idx, keep]) / pivot
+        self.n_updates += 1
+        return src_coord, dest_coord
+
+    def move(self, idx, src_coord, dest_coord):
+        """Move a node
+
+        :param idx: the index of the node to move
+        :param src_coord: the node's new coordinates in the source space
+        :param dest_coord: the node's new coordinates in the destination space
+        :returns: a two-tuple of the node's old source and destination
+        coordinates
+        """
+        old = self.remove(idx)
+        self.insert(idx, src_coord, dest_coord)
+        return old
@@ -0,0 +1,250 @@
+"""warp_cache - a persistent on-disk cache of fitted warps
+
+Fitting a thin-plate spline to an alignment and sampling it on an
+approximation grid can take minutes. The cache stores the fitted spline
+coefficients and the sampled grids in .npz files, keyed by a hash of the
+alignment points, the grid axes and the warp's keyword arguments, so that
+repeated runs against the same alignment skip both steps.
+
+The cache directory is capped in size. When it grows past the cap, the least
+recently used files are deleted.
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+import zipfile
+
+import numpy as np
+
+from .warp import Warper, ThinPlateSpline, Approximator
+
+"""The environment variable that holds the default cache directory"""
+CACHE_DIR_ENV = "NUGGT_WARP_CACHE"
+
+"""The default maximum size of the cache directory in bytes"""
+DEFAULT_CACHE_BYTES = 1024 * 1024 * 1024
+
+"""Bump this if the file format changes so that old entries are ignored"""
+CACHE_VERSION = 2
+
+
+def default_cache_dir():
+    """The cache directory to use if none is specified
+
+    :returns: the value of the NUGGT_WARP_CACHE environment variable or
+    ~/.cache/nuggt/warps if it is not set.
+    """
+    return os.environ.get(
+        CACHE_DIR_ENV,
+        os.path.join(os.path.expanduser("~"), ".cache", "nuggt", "warps"))
+
+
+class WarpCache:
+    """A directory of cached thin-plate splines and approximation grids"""
+
+    def __init__(self, cache_dir=None, max_bytes=DEFAULT_CACHE_BYTES):
+        """Constructor
+
+        :param cache_dir: the directory for the cache files. Defaults to
+        default_cache_dir()
+        :param max_bytes: the maximum total size of the cache files. The least
+        recently used files are removed to stay under this limit.
+        """
+        self.cache_dir = cache_dir or default_cache_dir()
+        self.max_bytes = max_bytes
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def key(self, kind, src_coords, dest_coords, axes=(), **kwargs):
+        """Compute the cache key for a warp
+
+        :param kind: "warper" or "approximator"
+        :param src_coords: the alignment points in the source space
+        :param dest_coords: the alignment points in the destination space
+        :param axes: the grid axes of an approximator
+        :param kwargs: any other arguments that affect the result
+        :returns: a hex digest that identifies the warp
+        """
+        md5 = hashlib.md5()
+        md5.update(("%s:%d" % (kind, CACHE_VERSION)).encode("utf-8"))
+        for a in [src_coords, dest_coords] + list(axes):
+            a = np.ascontiguousarray(a, np.float64)
+            md5.update(str(a.shape).encode("utf-8"))
+            md5.update(a.tobytes())
+        md5.update(json.dumps(
+            dict([(k, repr(v)) for k, v in kwargs.items()]),
+            sort_keys=True).encode("utf-8"))
+        return md5.hexdigest()
+
+    def path(self, key):
+        """The path to the cache file for a key"""
+        return os.path.join(self.cache_dir, key + ".npz")
+
+    def load(self, key):
+        """Load the arrays cached under a key
+
+        A file that can't be read, e.g. because it is truncated, is removed
+        so that it is made again.
+
+        :param key: the key from WarpCache.key()
+        :returns: a dictionary of the arrays or None if not in the cache
+        """
+        path = self.path(key)
+        if not os.path.exists(path):
+            return None
+        try:
+            with np.load(path) as npz:
+                result = dict([(k, npz[k]) for k in npz.files])
+        except (IOError, ValueError, EOFError, KeyError,
+                zipfile.BadZipFile):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return result
+
+    def store(self, key, **arrays):
+        """Store arrays in the cache under a key
+
+        The file is written under a temporary name and then renamed so that
+        concurrent readers never see a partial file.
+
+        :param key: the key from WarpCache.key()
+        :param arrays: the arrays to store
+        """
+        fd, tmp_path = tempfile.mkstemp(
+            dir=self.cache_dir, prefix=".tmp-", suffix=".npz")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.savez(f, **arrays)
+            os.replace(tmp_path, self.path(key))
+        except:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        self.prune()
+
+    def prune(self):
+        """Remove least recently used files until under the size limit"""
+        entries = []
+        for filename in os.listdir(self.cache_dir):
+            if not filename.endswith(".npz") or filename.startswith("."):
+                continue
+            path = os.path.join(self.cache_dir, filename)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        total = sum([size for _, size, _ in entries])
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+    def warper(self, src_coords, dest_coords, **warp_kwargs):
+        """Get a warper, fitting it only if it is not in the cache
+
+        Only thin-plate splines are cached. Other warps are fit every time.
+
+        :param src_coords: the alignment points in the source space
+        :param dest_coords: the alignment points in the destination space
+        :param warp_kwargs: keyword arguments for the Warper
+        :returns: a Warper
+        """
+        src_coords = np.atleast_2d(np.asarray(src_coords, float))
+        dest_coords = np.atleast_2d(np.asarray(dest_coords, float))
+        if warp_kwargs.get("function", "thin_plate") != "thin_plate" or \
+                warp_kwargs.get("norm") is not None:
+            return Warper(src_coords, dest_coords, **warp_kwargs)
+        key = self.key("warper", src_coords, dest_coords, **warp_kwargs)
+        d = self.load(key)
+        if d is not None:
+            return Warper.from_engine(ThinPlateSpline.from_coefficients(
+                d["nodes"], d["weights"], d["affine"]))
+        warper = Warper(src_coords, dest_coords, **warp_kwargs)
+        self.store(key,
+                   nodes=warper.engine.nodes,
+                   weights=warper.engine.weights,
+                   affine=warper.engine.affine)
+        return warper
+
+    def approximate(self, src_coords, dest_coords, axes, warp_kwargs={},
+                    **approximate_kwargs):
+        """Get an approximator, sampling the warp only if not in the cache
+
+        :param src_coords: the alignment points in the source space
+        :param dest_coords: the alignment points in the destination space
+        :param axes: one array per source dimension giving the nodes of the
+        grid (see Warper.approximate)
+        :param warp_kwargs: keyword arguments for the Warper
+        :param approximate_kwargs: keyword arguments for Warper.approximate
+        :returns: an Approximator. If a tolerance was given, its "max_error"
+        attribute is restored along with its grid.
+        """
+        src_coords = np.atleast_2d(np.asarray(src_coords, float))
+        dest_coords = np.atleast_2d(np.asarray(dest_coords, float))
+        kwargs = dict(warp_kwargs)
+        kwargs.update(
+            [("approximate_" + k, v) for k, v in approximate_kwargs.items()])
+        key = self.key("approximator", src_coords, dest_coords, axes,
+                       **kwargs)
+        d = self.load(key)
+        if d is not None:
+            n_axes = int(d["n_axes"])
+            approximator = Approximator(
+                [d["axis_%d" % i] for i in range(n_axes)],
+                d["values"], order=int(d["order"]),
+                dtype=d["values"].dtype)
+            if "max_error" in d:
+                approximator.max_error = float(d["max_error"])
+            return approximator
+        warper = self.warper(src_coords, dest_coords, **warp_kwargs)
+        approximator = warper.approximate(*axes, **approximate_kwargs)
+        arrays = dict([("axis_%d" % i, axis)
+                       for i, axis in enumerate(approximator.axes)])
+        if hasattr(approximator, "max_error"):
+            arrays["max_error"] = approximator.max_error
+        self.store(key,
+                   n_axes=len(approximator.axes),
+                   values=approximator.values,
+                   order=approximator.order,
+                   **arrays)
+        return approximator
+
+
+def make_warper(src_coords, dest_coords, cache_dir=None, **warp_kwargs):
+    """Make a warper, using the cache if a cache directory is given
+
+    :param src_coords: the alignment points in the source space
+    :param dest_coords: the alignment points in the destination space
+    :param cache_dir: the cache directory or None to always fit the warper
+    :param warp_kwargs: keyword arguments for the Warper
+    :returns: a Warper
+    """
+    if cache_dir is None:
+        return Warper(src_coords, dest_coords, **warp_kwargs)
+    return WarpCache(cache_dir).warper(src_coords, dest_coords, **warp_kwargs)
+
+
+def add_cache_argument(parser):
+    """Add the --warp-cache argument to a command-line parser
+
+    :param parser: an argparse.ArgumentParser
+    """
+    parser.add_argument(
+        "--warp-cache",
+        default=os.environ.get(CACHE_DIR_ENV),
+        help="A directory for caching fitted warps between runs against the "
+        "same alignment. Defaults to the %s environment variable. "
+        "If neither is given, warps are not cached." % CACHE_DIR_ENV)
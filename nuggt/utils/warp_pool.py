@@ -0,0 +1,257 @@
+"""warp_pool - a persistent pool of processes for warping image planes
+
+The moving image, the warp's approximation grid and the output volume live
+in named shared memory. The worker processes attach to them once, by name,
+so they can be started by either fork or spawn and nothing large is pickled
+per task: each task is a plane, a rectangle within it and a small token
+naming the version of the grid to warp with.
+
+Each warp is numbered and the number of the current warp is kept in shared
+memory, so a warp can be cancelled: the workers skip the queued tasks of
+any warp but the current one.
+
+The moving image is spline-filtered once, when the pool is made, rather
+than by every call to map_coordinates.
+"""
+
+import collections
+import multiprocessing
+from multiprocessing import shared_memory
+
+import numpy as np
+from scipy.ndimage import map_coordinates, spline_filter
+
+from .warp import Approximator
+
+
+class SharedArray:
+    """A numpy array in named shared memory
+
+    A SharedArray pickles as its name, shape and dtype, so a copy sent to
+    another process attaches to the same memory. Only the SharedArray that
+    created the memory unlinks it when closed.
+    """
+
+    def __init__(self, shape, dtype, name=None):
+        """Constructor
+
+        :param shape: the shape of the array
+        :param dtype: the dtype of the array
+        :param name: the name of existing shared memory to attach to.
+        Defaults to creating new shared memory.
+        """
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.owner = name is None
+        if self.owner:
+            size = max(1, int(np.prod(self.shape)) * self.dtype.itemsize)
+            self.shm = shared_memory.SharedMemory(create=True, size=size)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+        self.array = np.ndarray(self.shape, self.dtype, buffer=self.shm.buf)
+
+    @classmethod
+    def copy_of(cls, a):
+        """Make a SharedArray holding a copy of an array"""
+        a = np.asarray(a)
+        result = cls(a.shape, a.dtype)
+        result.array[:] = a
+        return result
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def __reduce__(self):
+        return SharedArray, (self.shape, self.dtype, self.name)
+
+    def close(self):
+        """Detach from the shared memory, unlinking it if we made it
+
+        The memory stays mapped until any views of the array are freed.
+        """
+        if self.owner:
+            self.shm.unlink()
+        self.array = None
+        try:
+            self.shm.close()
+        except BufferError:
+            pass
+
+
+"""Identifies the grid of a warp in shared memory
+
+version is bumped each time the grid changes so that workers know when to
+reload it. name, shape and dtype locate the shared array of the warped
+coordinates at the grid nodes. axes and order are as for Approximator.
+"""
+GridToken = collections.namedtuple(
+    "GridToken", ["version", "name", "shape", "dtype", "axes", "order"])
+
+#
+# The per-process state of a worker
+#
+WORKER_STATE = {}
+
+
+def initialize_worker(moving, alignment, order, current_warp):
+    """Attach a worker process to the shared moving and alignment images
+
+    :param moving: a SharedArray of the moving image, spline-filtered if
+    order is greater than 1
+    :param alignment: a SharedArray of the alignment image
+    :param order: the spline order for interpolating the moving image
+    :param current_warp: a shared value holding the number of the current
+    warp
+    """
+    WORKER_STATE.clear()
+    WORKER_STATE.update(moving=moving, alignment=alignment, order=order,
+                        current_warp=current_warp,
+                        version=None, approximator=None)
+
+
+def worker_approximator(token):
+    """Get the approximator for a grid token, loading it if it is new"""
+    if WORKER_STATE["version"] != token.version:
+        grid = SharedArray(token.shape, token.dtype, token.name)
+        values = grid.array.copy()
+        grid.close()
+        WORKER_STATE["approximator"] = Approximator(
+            token.axes, values, order=token.order, dtype=token.dtype)
+        WORKER_STATE["version"] = token.version
+    return WORKER_STATE["approximator"]
+
+
+def warp_region(token, warp_number, z, start, stop):
+    """Warp a rectangle of one plane of the alignment image
+
+    The rectangle is left as it is if its warp is no longer the current
+    one.
+
+    :param token: the GridToken of the warp to use
+    :param warp_number: the number of the warp that the task is part of
+    :param z: the plane to warp
+    :param start: the (y0, x0) corner of the rectangle
+    :param stop: the (y1, x1) corner of the rectangle, exclusive
+    :returns: z
+    """
+    current_warp = WORKER_STATE["current_warp"]
+    if current_warp.value != warp_number:
+        return z
+    approximator = worker_approximator(token)
+    (y0, x0), (y1, x1) = start, stop
+    alignment = WORKER_STATE["alignment"].array
+    output = np.empty((y1 - y0, x1 - x0), alignment.dtype)
+    map_coordinates(WORKER_STATE["moving"].array,
+                    approximator.warp_plane(z, stop, start=start),
+                    output=output,
+                    order=WORKER_STATE["order"],
+                    prefilter=False)
+    if current_warp.value == warp_number:
+        alignment[z, y0:y1, x0:x1] = output
+    return z
+
+
+class WarpPool:
+    """A pool of worker processes that warp a moving image plane by plane
+
+    Warps are done into the shared alignment image, whose array is
+    available as WarpPool.alignment_image. Only one warp should be in
+    progress at a time.
+    """
+
+    def __init__(self, moving_image, shape, dtype, n_workers=None, order=3,
+                 start_method=None):
+        """Constructor
+
+        :param moving_image: the image to be warped
+        :param shape: the shape of the alignment image
+        :param dtype: the dtype of the alignment image
+        :param n_workers: the number of worker processes. Defaults to the
+        number of CPUs.
+        :param order: the spline order for interpolating the moving image,
+        as for scipy.ndimage.map_coordinates
+        :param start_method: "fork", "spawn" or "forkserver" to start the
+        workers that way. Defaults to multiprocessing's default.
+        """
+        self.order = order
+        self.moving = SharedArray(moving_image.shape, np.float32)
+        if order > 1:
+            spline_filter(moving_image, order, output=self.moving.array,
+                          mode="constant")
+        else:
+            self.moving.array[:] = moving_image
+        self.alignment = SharedArray(shape, dtype)
+        self.version = 0
+        self.grid = None
+        self.token = None
+        self.approximator = None
+        context = multiprocessing.get_context(start_method)
+        self.current_warp = context.RawValue("q", 0)
+        self.pool = context.Pool(
+            n_workers, initializer=initialize_worker,
+            initargs=(self.moving, self.alignment, order, self.current_warp))
+
+    @property
+    def alignment_image(self):
+        """The array of the shared alignment image"""
+        return self.alignment.array
+
+    def set_grid(self, approximator):
+        """Publish the grid of an approximator to the workers
+
+        :param approximator: the Approximator to warp with
+        :returns: the GridToken for the grid
+        """
+        if approximator is not self.approximator:
+            if self.grid is not None:
+                self.grid.close()
+            self.grid = SharedArray.copy_of(approximator.values)
+            self.version += 1
+            self.token = GridToken(
+                self.version, self.grid.name, self.grid.shape,
+                self.grid.dtype, approximator.axes, approximator.order)
+            self.approximator = approximator
+        return self.token
+
+    def warp(self, approximator, regions):
+        """Warp regions of the moving image into the alignment image
+
+        :param approximator: the Approximator from alignment image
+        coordinates to moving image coordinates
+        :param regions: a sequence of two-tuples of a z and the (y0, x0),
+        (y1, x1) corners of the rectangle in plane z to warp
+        :returns: an iterator over the z of each region, in the order in
+        which they are completed. The warp is done when the iterator is
+        exhausted. Starting another warp or calling cancel() cancels the
+        regions that have not been warped yet.
+        """
+        token = self.set_grid(approximator)
+        self.current_warp.value += 1
+        warp_number = self.current_warp.value
+        return self.pool.imap_unordered(
+            warp_region_task,
+            [(token, warp_number, z, start, stop)
+             for z, (start, stop) in regions])
+
+    def cancel(self):
+        """Cancel the warp in progress
+
+        The workers skip the regions of the warp that they have not started.
+        A region that is being warped is not written to the alignment image.
+        """
+        self.current_warp.value += 1
+
+    def close(self):
+        """Stop the workers and free the shared memory"""
+        self.pool.terminate()
+        self.pool.join()
+        if self.grid is not None:
+            self.grid.close()
+        self.moving.close()
+        self.alignment.close()
+
+
+def warp_region_task(args):
+    """Unpack the arguments of a warp_region task from imap_unordered"""
+    return warp_region(*args)
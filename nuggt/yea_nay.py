@@ -9,7 +9,8 @@ import sys
 
 import neuroglancer
 from nuggt.utils.ngutils import *
-import tifffile
+from nuggt.utils.precomputed_annotations import serve_points
+from nuggt.utils.tiff_volume import TiffVolume
 import threading
 import webbrowser
 
@@ -24,7 +25,8 @@ class NuggtYeaNay:
 
 
         :param imgs: a sequence of three-tuples: image, name, shader. The
-        possible shaders are nuggt.utils.ngutils.{gray, red, green, blue}_shader
+        image is either a Numpy array or a TiffVolume, which is read as it
+        is viewed. The possible shaders are nuggt.utils.ngutils.{gray, red, green, blue}_shader
 
         :param points: an Nx3 array of points where points[:, 0] is the z
         coordinate, points[:, 1] is the y coordinate and points[:, 2] is the
@@ -40,10 +42,29 @@ class NuggtYeaNay:
         self.viewer = neuroglancer.Viewer()
         self._yea = np.zeros(len(points), bool)
         self._nay = np.zeros(len(points), bool)
+        self.layers = dict(
+            yea=PointLayerManager(self.viewer, "yea", "green"),
+            nay=PointLayerManager(self.viewer, "nay", "red"))
+        if len(points) > INLINE_POINT_LIMIT:
+            #
+            # Too many points to show inline - serve all of them, with the
+            # point indices as their IDs, and show the marked ones on top.
+            #
+            self.points_source = serve_points(points)
+        else:
+            self.points_source = None
+            self.layers["unmarked"] = PointLayerManager(
+                self.viewer, "unmarked", "yellow")
+            self.layers["unmarked"].set_points(
+                points[:, 2], points[:, 1], points[:, 0],
+                ids=[str(_) for _ in range(len(points))])
         with self.viewer.txn() as txn:
             for img, name, shader in imgs:
-                layer(txn, name, img.astype(np.float32), shader, 1.0)
-        self.display_points()
+                layer(txn, name, img, shader, scale_multiplier(img, 1.0))
+            if self.points_source is not None:
+                annotation_source_layer(txn, "points", self.points_source)
+            for layer_manager in self.layers.values():
+                layer_manager.update(txn)
         self.go_to()
         self.viewer.actions.add("quit", self.on_quit)
         self.viewer.actions.add("yea", self.on_yea)
@@ -86,16 +107,33 @@ class NuggtYeaNay:
     def on_yea(self, s):
         self._nay[self.idx] = False
         self._yea[self.idx] = True
-        self.idx = (self.idx + 1) % len(self.points)
-        self.display_points()
-        self.go_to()
+        self.move_point(self.idx, "yea")
 
     def on_nay(self, s):
         self._nay[self.idx] = True
         self._yea[self.idx] = False
+        self.move_point(self.idx, "nay")
+
+    def move_point(self, idx, layer_name):
+        """Move a point to the given layer and go on to the next point
+
+        :param idx: the index of the point
+        :param layer_name: "unmarked", "yea" or "nay". Unmarked points
+        have no layer of their own if all points are served as a source.
+        """
+        ident = str(idx)
+        z, y, x = self.points[idx]
+        for name, layer_manager in self.layers.items():
+            if name == layer_name:
+                layer_manager.add(x, y, z, ident)
+            else:
+                layer_manager.remove(ident)
         self.idx = (self.idx + 1) % len(self.points)
-        self.display_points()
-        self.go_to()
+        update_viewer_state(
+            self.viewer,
+            dict([(name, layer_manager.layer_json())
+                  for name, layer_manager in self.layers.items()]),
+            position=self.points[self.idx])
 
     def on_next(self, s):
         self.idx = (self.idx + 1) % len(self.points)
@@ -132,18 +170,17 @@ class NuggtYeaNay:
         self.go_to()
 
     def on_go_to(self, s):
-        for layer_name in ("unmarked", "yea", "nay"):
+        layer_names = list(self.layers)
+        if self.points_source is not None:
+            layer_names.append("points")
+        for layer_name in layer_names:
             layer = s.viewerState.layers[layer_name].layer
             d = layer.to_json()
             if "selectedAnnotation" in d:
-                idx = int(d["selectedAnnotation"])
-                if layer_name == "unmarked":
-                    mask = ~ (self._yea | self._nay)
-                elif layer_name == "yea":
-                    mask = self._yea
-                else:
-                    mask = self._nay
-                self.idx = np.where(mask)[0][idx]
+                #
+                # The annotation IDs are the indices of the points
+                #
+                self.idx = int(d["selectedAnnotation"])
                 self.go_to()
                 break
         else:
@@ -163,24 +200,8 @@ class NuggtYeaNay:
             with self.viewer.config_state.txn() as txn:
                 txn.status_message[MSG_ERROR] = str(e)
 
-    def _get_masked_points(self, mask):
-        """Return the masked points, in x, y, z form"""
-        mp = self.points[mask]
-        return mp[:, 2], mp[:, 1], mp[:, 0]
-
-    def display_points(self):
-        with self.viewer.txn() as txn:
-            pointlayer(txn, "unmarked",
-                       *self._get_masked_points(~(self._yea | self._nay)),
-                       color="yellow")
-            pointlayer(txn, "yea", *self._get_masked_points(self._yea),
-                       color="green")
-            pointlayer(txn, "nay", *self._get_masked_points(self._nay),
-                       color="red")
-
     def go_to(self):
-        with self.viewer.txn() as txn:
-            txn.position = self.points[self.idx]
+        update_viewer_state(self.viewer, position=self.points[self.idx])
 
 
 def sort_points(imgs, points, launch_ui=False, save_cb=None):
@@ -194,9 +215,9 @@ def sort_points(imgs, points, launch_ui=False, save_cb=None):
     You may want to call "neuroglancer.stop()" to recover resources if you
     are repeatedly calling sort_points.
 
-    :param imgs: A sequence of 3-tuples of Numpy 3D array image, its name and
-    the shader to use (gray_shader, red_shader, green_shader or blue_shader or
-    a custom one of your own)
+    :param imgs: A sequence of 3-tuples of Numpy 3D array image or TiffVolume,
+    its name and the shader to use (gray_shader, red_shader, green_shader or
+    blue_shader or a custom one of your own)
     :param points: An Nx3 array of points in X, Y, Z order (call with
     points[:, ::-1] to reverse from Z, Y, X).
     :param launch_ui: Launch the UI in a browser if true, launch in a new
@@ -288,7 +309,7 @@ def main():
             (args.green_image, args.green_image_name, green_shader),
             (args.blue_image, args.blue_image_name, blue_shader)):
         if path is not None:
-            img = tifffile.imread(path)
+            img = TiffVolume(path)
             imgs.append((img, name, shader))
 
     def save_cb(yea, nay):
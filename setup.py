@@ -25,12 +25,14 @@ setup(
         "tifffile",
         "tqdm"
     ],
+    python_requires=">=3.8",
     setup_requires=[
         "Cython"
     ],
     author="Kwanghun Chung Lab",
     packages=["nuggt", "nuggt.utils"],
     entry_points={ 'console_scripts': [
+        'alignment-residuals=nuggt.alignment_residuals:main',
         'calculate-intensity-in-regions=nuggt.calculate_intensity_in_regions:main',
         'count-points-in-region=nuggt.count_points_in_region:main',
         'counts2svg=nuggt.counts2svg:main',
@@ -41,6 +43,7 @@ setup(
         'nuggt-align=nuggt.align:main',
         'nuggt-display=nuggt.display_image:main',
         'make-alignment-file=nuggt.make_alignment_file:main',
+        'make-precomputed-annotations=nuggt.make_precomputed_annotations:main',
         'rescale-alignment-file=nuggt.rescale_alignment_file:main',
         'rescale-image-for-alignment=nuggt.rescale_image_for_alignment:main',
         'segmentation2stack=nuggt.segmentation2stack:main',
@@ -52,7 +55,11 @@ setup(
     license="MIT",
     classifiers=[
         "Development Status :: 3 - Alpha",
-        'Programming Language :: Python :: 3.5',
+        'Programming Language :: Python :: 3',
+        'Programming Language :: Python :: 3.8',
+        'Programming Language :: Python :: 3.9',
+        'Programming Language :: Python :: 3.10',
+        'Programming Language :: Python :: 3.11',
     ],
     ext_modules=[sitk_align_extension],
     zip_safe=False
@@ -0,0 +1,32 @@
+import unittest
+
+import neuroglancer
+import numpy as np
+
+from nuggt.align import preview_dimensions
+from nuggt.utils.ngutils import layer
+
+
+class TestPreviewDimensions(unittest.TestCase):
+    def test_preview_dimensions(self):
+        dimensions = preview_dimensions((1.8, 1.8, 2.0), 4)
+        self.assertEqual(list(dimensions.names), ["x", "y", "z"])
+        np.testing.assert_allclose(dimensions.scales,
+                                   [7.2e-6, 7.2e-6, 8e-6])
+
+    def test_preview_matches_alignment(self):
+        voxel_size = (1.8, 1.5, 2.0)
+        factor = 3
+        viewer = neuroglancer.Viewer()
+        with viewer.txn() as txn:
+            alignment = layer(txn, "alignment", np.zeros((9, 9, 9)),
+                              voxel_size=voxel_size)
+            preview = layer(txn, "preview", np.zeros((3, 3, 3)),
+                            dimensions=preview_dimensions(voxel_size,
+                                                          factor))
+        np.testing.assert_allclose(preview.dimensions.scales,
+                                   alignment.dimensions.scales * factor)
+
+
+if __name__ == '__main__':
+    unittest.main()
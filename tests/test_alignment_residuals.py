@@ -0,0 +1,24 @@
+import unittest
+
+import numpy as np
+
+from nuggt.alignment_residuals import residuals, residual_colors
+
+
+class TestAlignmentResiduals(unittest.TestCase):
+    def test_residuals(self):
+        r = np.random.RandomState(1234)
+        reference = r.uniform(0, 100, (30, 3))
+        moving = reference * 1.1 + r.normal(0, .5, (30, 3))
+        moving[12] += 30
+        distances, order = residuals(reference, moving)
+        self.assertEqual(order[0], 12)
+        self.assertTrue(np.all(np.diff(distances[order]) <= 0))
+
+    def test_colors(self):
+        colors = residual_colors([0, 1, 2, np.inf])
+        self.assertEqual(colors, ["#00ff00", "#ffff00", "#ff0000", "#ff0000"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,49 @@
+import itertools
+import unittest
+
+import numpy as np
+
+from nuggt.utils.coordinate_mapping import CoordinateMapping
+
+
+def scalar_moving_to_original(mp, moving_shape, original_shape, voxel_size,
+                              flip, indices):
+    """The per-point mapping that CoordinateMapping vectorizes"""
+    extent = [original_shape[i] * voxel_size[i] for i in indices]
+    result = []
+    for k, i in enumerate(indices):
+        factor = extent[i] / moving_shape[i]
+        if flip[k]:
+            result.append((moving_shape[i] - mp[i]) * factor)
+        else:
+            result.append(mp[i] * factor)
+    return result
+
+
+class TestCoordinateMapping(unittest.TestCase):
+    def test_moving_to_original(self):
+        r = np.random.RandomState(1234)
+        moving_shape = (40, 50, 60)
+        original_shape = (400, 1000, 900)
+        voxel_size = (2.0, 1.8, 1.8)
+        points = r.uniform(0, 40, (20, 3))
+        for indices in ((0, 1, 2), (2, 1, 0), (1, 0, 2), (0, 2, 1)):
+            for flip in itertools.product((False, True), repeat=3):
+                mapping = CoordinateMapping(moving_shape, original_shape,
+                                            voxel_size, flip, indices)
+                result = mapping.moving_to_original(points)
+                expected = [scalar_moving_to_original(
+                    point, moving_shape, original_shape, voxel_size, flip,
+                    indices) for point in points]
+                np.testing.assert_allclose(result, expected)
+                np.testing.assert_allclose(
+                    mapping.original_to_moving(result), points)
+
+    def test_single_point(self):
+        mapping = CoordinateMapping((10, 10, 10), (100, 200, 300), (1, 1, 1))
+        np.testing.assert_allclose(
+            mapping.moving_to_original([1, 2, 3]), [[10, 40, 90]])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,62 @@
+import unittest
+
+import numpy as np
+
+from nuggt.utils.histogram import ImageHistogram
+
+
+class TestImageHistogram(unittest.TestCase):
+    def setUp(self):
+        self.r = np.random.RandomState(1234)
+
+    def check(self, img, histogram, places=7):
+        for percentile in (0, 1, 50, 99, 99.9, 100):
+            self.assertAlmostEqual(histogram.percentile(percentile),
+                                   np.percentile(img, percentile), places)
+
+    def test_uint16(self):
+        img = self.r.randint(0, 4000, (7, 30, 40)).astype(np.uint16)
+        histogram = ImageHistogram(img, chunk_voxels=1000)
+        self.assertEqual(len(histogram), img.size)
+        self.assertEqual(histogram.max, np.max(img))
+        self.check(img, histogram)
+
+    def test_int16(self):
+        img = self.r.randint(-3000, 3000, (7, 30, 40)).astype(np.int16)
+        self.check(img, ImageHistogram(img, chunk_voxels=1000))
+
+    def test_bool(self):
+        img = self.r.uniform(size=(5, 10, 10)) > .9
+        self.check(img.astype(np.uint8), ImageHistogram(img))
+
+    def test_float(self):
+        img = self.r.uniform(0, 1000, (7, 30, 40)).astype(np.float32)
+        histogram = ImageHistogram(img, chunk_voxels=1000)
+        self.assertEqual(histogram.max, np.max(img))
+        self.check(img, histogram, places=3)
+
+    def test_float_error_bound(self):
+        img = self.r.normal(size=(10, 50, 50))
+        n_bins = 64
+        histogram = ImageHistogram(img, n_bins=n_bins)
+        bin_width = (np.max(img) - np.min(img)) / n_bins
+        for percentile in (1, 50, 99):
+            self.assertLessEqual(
+                abs(histogram.percentile(percentile) -
+                    np.percentile(img, percentile)), bin_width)
+
+    def test_constant(self):
+        img = np.full((3, 4, 5), 2.5)
+        histogram = ImageHistogram(img)
+        self.assertEqual(histogram.percentile(50), 2.5)
+        self.assertEqual(histogram.max, 2.5)
+
+    def test_empty(self):
+        histogram = ImageHistogram(np.full((2, 2, 2), np.nan))
+        self.assertEqual(len(histogram), 0)
+        self.assertEqual(histogram.percentile(50), 0)
+        self.assertEqual(histogram.max, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
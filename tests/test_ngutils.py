@@ -1,6 +1,10 @@
+import neuroglancer
 import numpy as np
 import unittest
-from nuggt.utils.ngutils import soft_max_brightness
+from nuggt.utils.histogram import ImageHistogram
+from nuggt.utils.ngutils import soft_max_brightness, PointLayerManager, \
+    update_viewer_state, scale_multiplier, unsigned_segmentation, \
+    layer
 
 
 class TestNGUtils(unittest.TestCase):
@@ -17,6 +21,118 @@ class TestNGUtils(unittest.TestCase):
         img = np.zeros((10, 10, 10))
         self.assertGreater(soft_max_brightness(img), 0)
 
+    def test_soft_max_brightness_uint16(self):
+        img = np.arange(1000, dtype=np.uint16).reshape(10, 10, 10)
+        self.assertAlmostEqual(np.percentile(img, 99.9),
+                               soft_max_brightness(img), 5)
+
+    def test_soft_max_brightness_histogram(self):
+        img = np.arange(1000).reshape(10, 10, 10).astype(np.float32) / 1000
+        histogram = ImageHistogram(img)
+        self.assertAlmostEqual(.998, soft_max_brightness(histogram), 5)
+        self.assertAlmostEqual(.5, soft_max_brightness(histogram, 50), 3)
+
+    def test_scale_multiplier(self):
+        self.assertEqual(scale_multiplier(np.zeros(1, np.uint16), 2.0),
+                         2.0 * 65535)
+        self.assertEqual(scale_multiplier(np.zeros(1, np.float32), 2.0), 2.0)
+        self.assertEqual(scale_multiplier("precomputed://foo", 2.0), 2.0)
+
+
+    def test_unsigned_segmentation(self):
+        seg = np.arange(-2, 4, dtype=np.int32).reshape(2, 3)
+        result = unsigned_segmentation(seg)
+        self.assertEqual(result.dtype, np.uint32)
+        self.assertTrue(np.shares_memory(result, seg))
+        np.testing.assert_array_equal(result[1], [1, 2, 3])
+        seg = np.arange(6, dtype=np.uint16)
+        self.assertIs(unsigned_segmentation(seg), seg)
+        seg = np.arange(6, dtype=np.float64)
+        self.assertEqual(unsigned_segmentation(seg).dtype, np.uint32)
+
+    def test_layer_native_dtype(self):
+        viewer = neuroglancer.Viewer()
+        img = np.zeros((4, 5, 6), np.uint16)
+        with viewer.txn() as txn:
+            source = layer(txn, "image", img)
+        self.assertEqual(source.data.dtype, np.uint16)
+        self.assertTrue(np.shares_memory(source.data, img))
+        with viewer.txn() as txn:
+            source = layer(txn, "image", img.astype(np.float64))
+        self.assertEqual(source.data.dtype, np.float32)
+
+    def test_layer_voxel_size(self):
+        viewer = neuroglancer.Viewer()
+        with viewer.txn() as txn:
+            source = layer(txn, "image", np.zeros((4, 5, 6), np.uint16),
+                           voxel_size=(1.5, 1.5, 3))
+        np.testing.assert_allclose(source.dimensions.scales,
+                                   [1.5e-6, 1.5e-6, 3e-6])
+
+
+class TestPointLayerManager(unittest.TestCase):
+    def setUp(self):
+        self.viewer = neuroglancer.Viewer()
+
+    def annotations(self, name):
+        return [(a.id, list(a.point)) for a in
+                self.viewer.state.layers[name].layer.annotations]
+
+    def test_set_points(self):
+        manager = PointLayerManager(self.viewer, "points")
+        manager.set_points([1, 2], [3, 4], [5, 6])
+        manager.update()
+        self.assertEqual(self.annotations("points"),
+                         [("p0", [5, 3, 1]), ("p1", [6, 4, 2])])
+
+    def test_remove_point(self):
+        manager = PointLayerManager(self.viewer, "points")
+        manager.add(1, 2, 3)
+        manager.add(1.001, 2, 3)
+        manager.remove_point(1.001, 2, 3)
+        manager.remove_point(10, 20, 30)
+        manager.update()
+        self.assertEqual(self.annotations("points"), [("p0", [3, 2, 1])])
+        manager.add(4, 5, 6, "p0")
+        manager.remove_point(1, 2, 3)
+        self.assertEqual(len(manager), 1)
+        manager.remove_point(4, 5, 6)
+        self.assertEqual(len(manager), 0)
+
+    def test_add_remove(self):
+        manager = PointLayerManager(self.viewer, "points")
+        manager.set_points([1, 2], [3, 4], [5, 6], ids=["a", "b"])
+        with self.viewer.txn() as txn:
+            manager.update(txn)
+        manager.add(7, 8, 9, "c")
+        manager.remove("a")
+        manager.update()
+        self.assertEqual(self.annotations("points"),
+                         [("b", [6, 4, 2]), ("c", [9, 8, 7])])
+        self.assertIn("c", manager)
+        self.assertNotIn("a", manager)
+        self.assertEqual(len(manager), 2)
+
+    def test_update_viewer_state(self):
+        first = PointLayerManager(self.viewer, "first")
+        second = PointLayerManager(self.viewer, "second")
+        first.add(1, 2, 3)
+        second.add(4, 5, 6)
+        update_viewer_state(self.viewer, {"first": first.layer_json(),
+                                          "second": second.layer_json()},
+                            position=(1, 2, 3))
+        self.assertEqual([layer.name for layer in self.viewer.state.layers],
+                         ["first", "second"])
+        np.testing.assert_array_equal(self.viewer.state.position, [1, 2, 3])
+        first.add(7, 8, 9)
+        update_viewer_state(self.viewer, {"first": first.layer_json()})
+        self.assertEqual([layer.name for layer in self.viewer.state.layers],
+                         ["first", "second"])
+        self.assertEqual(len(self.annotations("first")), 2)
+        update_viewer_state(self.viewer, {"first": None})
+        self.assertEqual([layer.name for layer in self.viewer.state.layers],
+                         ["second"])
+
 
 if __name__ == '__main__':
     unittest.main()
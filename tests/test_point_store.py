@@ -0,0 +1,83 @@
+import unittest
+
+import numpy as np
+
+from nuggt.utils.point_store import PointStore, MIN_REBUILD_EDITS
+
+
+def sort_points(points):
+    return points[np.lexsort(points.transpose()[::-1])]
+
+
+class TestPointStore(unittest.TestCase):
+    def setUp(self):
+        r = np.random.RandomState(1234)
+        self.points = r.uniform(0, 100, (2000, 3))
+        self.extra = r.uniform(0, 100, (50, 3))
+
+    def check_box(self, store, points, lo, hi):
+        expected = points[np.all((points >= lo) & (points < hi), 1)]
+        np.testing.assert_array_equal(sort_points(store.in_box(lo, hi)),
+                                      sort_points(expected))
+
+    def test_empty(self):
+        store = PointStore()
+        self.assertEqual(len(store), 0)
+        self.assertEqual(store.nearby((1, 2, 3), 10).shape, (0, 3))
+        self.assertIsNone(store.remove_nearest((1, 2, 3), 10))
+        self.assertEqual(store.in_box((0, 0, 0), (10, 10, 10)).shape, (0, 3))
+        store.add((1, 2, 3))
+        self.assertEqual(len(store), 1)
+        np.testing.assert_array_equal(store.array, [[1, 2, 3]])
+
+    def test_nearby(self):
+        store = PointStore(self.points)
+        store.add(self.extra)
+        points = np.vstack((self.points, self.extra))
+        center = np.array([50, 40, 30])
+        distances = np.sqrt(np.sum(np.square(points - center), 1))
+        expected = points[distances < 10]
+        expected = expected[np.argsort(distances[distances < 10])]
+        np.testing.assert_array_equal(store.nearby(center, 10), expected)
+
+    def test_remove_nearest(self):
+        store = PointStore(self.points)
+        store.add(self.extra)
+        for point in (self.points[5], self.extra[3]):
+            removed = store.remove_nearest(point + .01, 1)
+            np.testing.assert_array_equal(removed, point)
+        self.assertEqual(len(store), len(self.points) + len(self.extra) - 2)
+        self.assertEqual(len(store.nearby(self.points[5], .001)), 0)
+        self.assertEqual(len(store.nearby(self.extra[3], .001)), 0)
+
+    def test_box(self):
+        store = PointStore(self.points)
+        store.add(self.extra)
+        points = np.vstack((self.points, self.extra))
+        self.check_box(store, points, (10, 20, 30), (60, 25, 90))
+        self.check_box(store, points, (10, 20, 30), (10, 25, 90))
+
+    def test_remove_box(self):
+        store = PointStore(self.points)
+        store.add(self.extra)
+        points = np.vstack((self.points, self.extra))
+        lo, hi = (10, 20, 30), (60, 50, 90)
+        mask = np.all((points >= lo) & (points < hi), 1)
+        removed = store.remove_box(lo, hi)
+        np.testing.assert_array_equal(sort_points(removed),
+                                      sort_points(points[mask]))
+        np.testing.assert_array_equal(sort_points(store.array),
+                                      sort_points(points[~mask]))
+        self.assertEqual(len(store), np.sum(~mask))
+
+    def test_rebuild(self):
+        store = PointStore(self.points[:10])
+        store.add(self.points[10:10 + MIN_REBUILD_EDITS])
+        self.assertEqual(len(store.delta), 0)
+        self.assertEqual(len(store.indexed), MIN_REBUILD_EDITS + 10)
+        points = self.points[:10 + MIN_REBUILD_EDITS]
+        self.check_box(store, points, (0, 0, 0), (50, 50, 50))
+
+
+if __name__ == '__main__':
+    unittest.main()
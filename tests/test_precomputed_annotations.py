@@ -0,0 +1,111 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+import urllib.error
+import urllib.request
+
+import numpy as np
+
+from nuggt.utils.precomputed_annotations import write_point_annotations, \
+    AnnotationSource, read_points_file
+from nuggt.utils.source_server import SourceServer
+
+
+def decode_chunk(data):
+    count = int(np.frombuffer(data[:8], "<u8")[0])
+    points = np.frombuffer(data[8:8 + count * 12], "<f4").reshape(count, 3)
+    ids = np.frombuffer(data[8 + count * 12:], "<u8")
+    return points, ids
+
+
+class TestPrecomputedAnnotations(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        r = np.random.RandomState(1234)
+        self.points = r.uniform(0, 1000, (5000, 3)) * [1, 1, .25]
+        self.points = self.points.astype(np.float32)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def read_info(self):
+        with open(os.path.join(self.tempdir, "info")) as fd:
+            return json.load(fd)
+
+    def test_spatial_index(self):
+        write_point_annotations(self.tempdir, self.points, limit=100)
+        info = self.read_info()
+        self.assertEqual(info["annotation_type"], "POINT")
+        self.assertGreater(len(info["spatial"]), 1)
+        self.assertEqual(info["spatial"][0]["grid_shape"], [1, 1, 1])
+        lower_bound = np.array(info["lower_bound"])
+        seen = np.zeros(len(self.points), int)
+        for level in info["spatial"]:
+            chunk_size = np.array(level["chunk_size"])
+            directory = os.path.join(self.tempdir, level["key"])
+            for filename in os.listdir(directory):
+                cell = np.array([int(_) for _ in filename.split("_")])
+                self.assertTrue(np.all(cell < level["grid_shape"]))
+                with open(os.path.join(directory, filename), "rb") as fd:
+                    points, ids = decode_chunk(fd.read())
+                self.assertLessEqual(len(points), level["limit"])
+                np.testing.assert_array_equal(points, self.points[ids])
+                lo = lower_bound + cell * chunk_size
+                self.assertTrue(np.all(points >= lo))
+                self.assertTrue(np.all(points < lo + chunk_size))
+                seen[ids.astype(int)] += 1
+        np.testing.assert_array_equal(seen, 1)
+        for level in info["spatial"][:-1]:
+            self.assertLessEqual(level["limit"], 100)
+
+    def test_few_points(self):
+        write_point_annotations(self.tempdir, self.points[:10])
+        info = self.read_info()
+        self.assertEqual(len(info["spatial"]), 1)
+        self.assertEqual(info["spatial"][0]["limit"], 10)
+
+    def test_max_levels(self):
+        write_point_annotations(self.tempdir, self.points, limit=10,
+                                max_levels=2)
+        self.assertEqual(len(self.read_info()["spatial"]), 2)
+
+    def test_server(self):
+        write_point_annotations(self.tempdir, self.points, limit=100)
+        server = SourceServer("127.0.0.1")
+        try:
+            url = server.serve(AnnotationSource(self.tempdir))
+            self.assertTrue(url.startswith("precomputed://http://"))
+            base = url[len("precomputed://"):]
+            with urllib.request.urlopen(base + "/info") as response:
+                self.assertEqual(json.load(response), self.read_info())
+            with urllib.request.urlopen(base + "/spatial0/0_0_0") as response:
+                points, ids = decode_chunk(response.read())
+            np.testing.assert_array_equal(points, self.points[ids])
+            with urllib.request.urlopen(base + "/spatial0/5_5_5") as response:
+                self.assertEqual(len(decode_chunk(response.read())[0]), 0)
+            with urllib.request.urlopen(base + "/by_id/17") as response:
+                np.testing.assert_array_equal(
+                    np.frombuffer(response.read(), "<f4"), self.points[17])
+            with self.assertRaises(urllib.error.HTTPError):
+                urllib.request.urlopen(base + "/by_id/5000")
+            with self.assertRaises(urllib.error.HTTPError):
+                urllib.request.urlopen(base[:base.rindex("/")] + "/x/info")
+        finally:
+            server.close()
+
+    def test_read_points_file(self):
+        path = os.path.join(self.tempdir, "points.json")
+        with open(path, "w") as fd:
+            json.dump(self.points[:5].tolist(), fd)
+        np.testing.assert_array_almost_equal(read_points_file(path),
+                                             self.points[:5])
+        path = os.path.join(self.tempdir, "points.npy")
+        np.save(path, self.points[:5])
+        np.testing.assert_array_equal(read_points_file(path),
+                                      self.points[:5])
+
+
+if __name__ == '__main__':
+    unittest.main()
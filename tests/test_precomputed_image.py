@@ -0,0 +1,176 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+import urllib.error
+import urllib.request
+
+import numpy as np
+import tifffile
+
+from nuggt.utils.precomputed_image import VolumeSource, precomputed_dtype,\
+    pyramid_steps, downsample_mean, downsample_stride, sidecar_directory, \
+    serve_volume
+from nuggt.utils.source_server import SourceServer
+from nuggt.utils.tiff_volume import TiffVolume
+
+
+class TestPrecomputedImage(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        r = np.random.RandomState(1234)
+        self.img = r.randint(0, 65535, (10, 70, 90)).astype(np.uint16)
+        self.path = os.path.join(self.tempdir, "img.tiff")
+        tifffile.imwrite(self.path, self.img)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_precomputed_dtype(self):
+        self.assertEqual(precomputed_dtype(np.uint16), np.uint16)
+        self.assertEqual(precomputed_dtype(np.float64), np.float32)
+        self.assertEqual(precomputed_dtype(np.bool_), np.uint8)
+
+    def test_pyramid_steps(self):
+        self.assertEqual(pyramid_steps((10, 70, 90), (2, 1, 1), (8, 32, 32)),
+                         [(1, 2, 2), (2, 2, 2)])
+        self.assertEqual(pyramid_steps((10, 10, 10), (1, 1, 1), (16, 16, 16)),
+                         [])
+        self.assertEqual(pyramid_steps((1, 70, 90), (1, 1, 1), (1, 64, 64)),
+                         [(1, 2, 2)])
+
+    def test_downsample_mean(self):
+        block = np.arange(27, dtype=np.uint16).reshape(3, 3, 3)
+        result = downsample_mean(block, (2, 2, 2))
+        self.assertEqual(result.dtype, np.uint16)
+        self.assertEqual(result.shape, (2, 2, 2))
+        self.assertEqual(result[0, 0, 0], np.rint(np.mean(block[:2, :2, :2])))
+        self.assertEqual(result[1, 1, 1], block[2, 2, 2])
+        block = np.arange(8, dtype=np.float32).reshape(1, 2, 4)
+        np.testing.assert_array_equal(downsample_mean(block, (1, 2, 2)),
+                                      [[[2.5, 4.5]]])
+
+    def test_downsample_stride(self):
+        block = np.arange(27).reshape(3, 3, 3)
+        np.testing.assert_array_equal(downsample_stride(block, (1, 2, 2)),
+                                      block[:, ::2, ::2])
+
+    def test_info(self):
+        source = VolumeSource(TiffVolume(self.path), (1.5, 1.5, 2),
+                                 chunk_size=(32, 32, 4))
+        data, content_type = source.get(["info"])
+        self.assertEqual(content_type, "application/json")
+        info = json.loads(data)
+        self.assertEqual(info["data_type"], "uint16")
+        self.assertEqual(len(info["scales"]), 3)
+        scale = info["scales"][0]
+        self.assertEqual(scale["key"], "1.5_1.5_2")
+        self.assertEqual(scale["size"], [90, 70, 10])
+        self.assertEqual(scale["resolution"], [1500, 1500, 2000])
+        self.assertEqual(scale["voxel_offset"], [0, 0, 0])
+        self.assertEqual(scale["chunk_sizes"], [[32, 32, 4]])
+
+    def test_chunk(self):
+        source = VolumeSource(TiffVolume(self.path))
+        data, _ = source.get(["1_1_1", "64-90_0-64_4-8"])
+        chunk = np.frombuffer(data, "<u2").reshape(4, 64, 26)
+        np.testing.assert_array_equal(chunk, self.img[4:8, :64, 64:90])
+        self.assertIsNone(source.get(["1_1_1", "64-91_0-64_4-8"]))
+        self.assertIsNone(source.get(["2_2_2", "64-90_0-64_4-8"]))
+        self.assertIsNone(source.get(["1_1_1", "x"]))
+
+    def test_window(self):
+        volume = TiffVolume(self.path).window(2, 8, 10, 50, 20, 60)
+        source = VolumeSource(volume)
+        info = source.info()
+        self.assertEqual(info["scales"][0]["voxel_offset"], [20, 10, 2])
+        self.assertEqual(info["scales"][0]["size"], [40, 40, 6])
+        data, _ = source.get(["1_1_1", "20-60_10-50_2-8"])
+        np.testing.assert_array_equal(
+            np.frombuffer(data, "<u2").reshape(6, 40, 40),
+            self.img[2:8, 10:50, 20:60])
+
+    def test_pyramid(self):
+        source = VolumeSource(TiffVolume(self.path), chunk_size=(32, 32, 4))
+        info = source.info()
+        scale = info["scales"][1]
+        self.assertEqual(scale["key"], "2_2_2")
+        self.assertEqual(scale["size"], [45, 35, 5])
+        data, _ = source.get(["2_2_2", "32-45_0-32_4-5"])
+        expected = downsample_mean(self.img, (2, 2, 2))[4:5, :32, 32:45]
+        np.testing.assert_array_equal(
+            np.frombuffer(data, "<u2").reshape(1, 32, 13), expected)
+        key = info["scales"][-1]["key"]
+        data, _ = source.get([key, "0-23_0-18_0-3"])
+        self.assertEqual(len(data), 23 * 18 * 3 * 2)
+
+    def test_array(self):
+        img = self.img.astype(np.float64)
+        source = VolumeSource(img, chunk_size=(32, 32, 4))
+        self.assertEqual(source.info()["data_type"], "float32")
+        data, _ = source.get(["1_1_1", "0-32_32-64_4-8"])
+        np.testing.assert_array_equal(
+            np.frombuffer(data, "<f4").reshape(4, 32, 32),
+            img[4:8, 32:64, :32])
+
+    def test_sidecar(self):
+        volume = TiffVolume(self.path)
+        directory = sidecar_directory(volume)
+        self.assertEqual(directory, self.path + ".image-pyramid")
+        source = VolumeSource(volume, chunk_size=(32, 32, 4),
+                              cache_directory=directory)
+        data, _ = source.get(["2_2_2", "0-32_0-32_0-4"])
+        path = os.path.join(directory, "2_2_2", "0-32_0-32_0-4")
+        self.assertTrue(os.path.exists(path))
+        with open(path, "rb") as fd:
+            self.assertEqual(fd.read(), data)
+        self.assertEqual(sidecar_directory(volume), directory)
+        self.assertTrue(os.path.exists(path))
+        tifffile.imwrite(self.path, self.img[:5])
+        os.utime(self.path, (0, 0))
+        self.assertEqual(sidecar_directory(TiffVolume(self.path)), directory)
+        self.assertFalse(os.path.exists(path))
+
+    def test_segmentation(self):
+        img = self.img.astype(np.int32)
+        path = os.path.join(self.tempdir, "seg.tiff")
+        tifffile.imwrite(path, img)
+        source = VolumeSource(TiffVolume(path), volume_type="segmentation")
+        self.assertEqual(source.info()["data_type"], "uint32")
+        data, _ = source.get(["1_1_1", "0-10_0-10_0-1"])
+        np.testing.assert_array_equal(
+            np.frombuffer(data, "<u4").reshape(1, 10, 10), img[:1, :10, :10])
+
+    def test_serve_volume_again(self):
+        url = serve_volume(self.img, (1.0, 1.0, 2.0))
+        self.assertEqual(serve_volume(self.img, (1.0, 1.0, 2.0)), url)
+        self.assertNotEqual(serve_volume(self.img.copy(), (1.0, 1.0, 2.0)),
+                            url)
+        self.assertNotEqual(serve_volume(self.img), url)
+        url = serve_volume(TiffVolume(self.path))
+        self.assertEqual(serve_volume(self.path), url)
+        self.assertNotEqual(
+            serve_volume(self.path, volume_type="segmentation"), url)
+
+    def test_server(self):
+        server = SourceServer("127.0.0.1")
+        try:
+            url = server.serve(VolumeSource(TiffVolume(self.path)))
+            self.assertTrue(url.startswith("precomputed://http://"))
+            base = url[len("precomputed://"):]
+            with urllib.request.urlopen(base + "/info") as response:
+                self.assertEqual(json.load(response)["data_type"], "uint16")
+            with urllib.request.urlopen(
+                    base + "/1_1_1/0-64_0-64_0-10") as response:
+                chunk = np.frombuffer(response.read(), "<u2")
+            np.testing.assert_array_equal(chunk.reshape(10, 64, 64),
+                                          self.img[:, :64, :64])
+            with self.assertRaises(urllib.error.HTTPError):
+                urllib.request.urlopen(base + "/1_1_1/0-64_0-64_0-11")
+        finally:
+            server.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,98 @@
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import numpy as np
+import tifffile
+
+from nuggt.utils.prefetch import neighboring_windows, read_repositioning_log,\
+    WindowPrefetcher
+from nuggt.utils.tiff_volume import TiffVolume
+
+
+class TestNeighboringWindows(unittest.TestCase):
+    def test_interior(self):
+        neighbors = neighboring_windows((10, 20, 10, 20, 10, 20),
+                                        (100, 100, 100))
+        self.assertEqual(len(neighbors), 26)
+        self.assertEqual(len(set(neighbors)), 26)
+        for neighbor in neighbors[:6]:
+            self.assertEqual(
+                sum([a != b for a, b in
+                     zip(neighbor, (10, 20, 10, 20, 10, 20))]), 2)
+        self.assertIn((20, 30, 10, 20, 10, 20), neighbors[:6])
+        self.assertIn((0, 10, 0, 10, 0, 10), neighbors[-8:])
+
+    def test_clipped(self):
+        neighbors = neighboring_windows((0, 10, 0, 10, 0, 10), (15, 10, 10))
+        self.assertEqual(neighbors, [(5, 15, 0, 10, 0, 10)])
+
+
+class TestWindowPrefetcher(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        r = np.random.RandomState(1234)
+        self.img = r.randint(0, 65535, (20, 40, 40)).astype(np.uint16)
+        self.path = os.path.join(self.tempdir, "img.tiff")
+        tifffile.imwrite(self.path, self.img)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_read_repositioning_log(self):
+        path = os.path.join(self.tempdir, "log.json")
+        with open(path, "w") as fd:
+            for window in ((0, 10, 0, 10, 0, 5), (10, 20, 0, 10, 0, 5)):
+                json.dump(dict(zip(("x0", "x1", "y0", "y1", "z0", "z1"),
+                                   window)), fd)
+                fd.write("\n")
+        self.assertEqual(read_repositioning_log(path),
+                         [(0, 10, 0, 10, 0, 5), (10, 20, 0, 10, 0, 5)])
+
+    def test_unvisited_first(self):
+        volume = TiffVolume(self.path, tile_size=10)
+        prefetcher = WindowPrefetcher(
+            [volume], (40, 40, 20), visited=[(20, 30, 10, 20, 5, 10)])
+        try:
+            candidates = prefetcher.candidates((10, 20, 10, 20, 5, 10))
+            self.assertEqual(len(candidates), 26)
+            self.assertEqual(candidates[-1], (20, 30, 10, 20, 5, 10))
+        finally:
+            prefetcher.close()
+
+    def test_budget(self):
+        volume = TiffVolume(self.path, tile_size=10)
+        window_bytes = 10 * 10 * 5 * 2
+        prefetcher = WindowPrefetcher([volume], (40, 40, 20),
+                                      max_bytes=3 * window_bytes)
+        try:
+            self.assertEqual(
+                len(prefetcher.candidates((10, 20, 10, 20, 5, 10))), 3)
+        finally:
+            prefetcher.close()
+
+    def test_prefetch(self):
+        volume = TiffVolume(self.path, tile_size=10)
+        prefetcher = WindowPrefetcher([volume], (40, 40, 20),
+                                      max_bytes=10 * 10 * 5 * 2)
+        try:
+            prefetcher.prefetch_around((10, 20, 10, 20, 5, 10))
+            x0, x1, y0, y1, z0, z1 = prefetcher.candidates(
+                (10, 20, 10, 20, 5, 10))[0]
+            deadline = time.time() + 10
+            while len(volume.cache) < z1 - z0 and time.time() < deadline:
+                time.sleep(.01)
+        finally:
+            prefetcher.close()
+        self.assertIn((10, 20, 10, 20, 5, 10), prefetcher.visited)
+        for z in range(z0, z1):
+            tile = volume.cache.get((z, y0 // 10, x0 // 10))
+            self.assertIsNotNone(tile)
+            np.testing.assert_array_equal(tile, self.img[z, y0:y1, x0:x1])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import tifffile
+
+from nuggt.utils.ngutils import reverse_dimensions
+from nuggt.utils.tiff_volume import TiffVolume, ChunkCache, read_tiff
+
+
+class TestTiffVolume(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        r = np.random.RandomState(1234)
+        self.img = r.randint(0, 65535, (5, 70, 90)).astype(np.uint16)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def write_stack(self, **kwargs):
+        for z, plane in enumerate(self.img):
+            tifffile.imwrite(
+                os.path.join(self.tempdir, "img_%04d.tiff" % z), plane,
+                **kwargs)
+        return os.path.join(self.tempdir, "img_*.tiff")
+
+    def write_volume(self, **kwargs):
+        path = os.path.join(self.tempdir, "img.tiff")
+        tifffile.imwrite(path, self.img, **kwargs)
+        return path
+
+    def check(self, volume):
+        self.assertEqual(volume.shape, self.img.shape)
+        self.assertEqual(volume.dtype, self.img.dtype)
+        np.testing.assert_array_equal(volume[:], self.img)
+        np.testing.assert_array_equal(volume[1:4, 5:60, 17:83],
+                                      self.img[1:4, 5:60, 17:83])
+        np.testing.assert_array_equal(volume[2, 10:20], self.img[2, 10:20])
+        window = volume.window(1, 4, 10, 50, 20, 70)
+        np.testing.assert_array_equal(window[:], self.img[1:4, 10:50, 20:70])
+        np.testing.assert_array_equal(window[1:2, 3:30, 4:40],
+                                      self.img[2:3, 13:40, 24:60])
+        transposed = reverse_dimensions(window)
+        self.assertEqual(transposed.shape, (50, 40, 3))
+        np.testing.assert_array_equal(
+            transposed[5:20, 1:30, 0:2],
+            reverse_dimensions(self.img[1:4, 10:50, 20:70])[5:20, 1:30, 0:2])
+
+    def test_stack(self):
+        self.check(TiffVolume(self.write_stack(), tile_size=32))
+
+    def test_compressed_stack(self):
+        self.check(TiffVolume(self.write_stack(compression="zlib"),
+                              tile_size=32))
+
+    def test_volume(self):
+        self.check(TiffVolume(self.write_volume(), tile_size=32))
+
+    def test_compressed_volume(self):
+        self.check(TiffVolume(self.write_volume(compression="zlib"),
+                              tile_size=32))
+
+    def test_cache_is_bounded(self):
+        volume = TiffVolume(self.write_stack(), tile_size=32,
+                            cache_bytes=32 * 32 * 2 * 4)
+        volume[:]
+        self.assertLessEqual(volume.cache.nbytes, 32 * 32 * 2 * 4)
+
+    def test_read_tiff(self):
+        img = read_tiff(self.write_volume())
+        self.assertIsInstance(img, np.memmap)
+        np.testing.assert_array_equal(img, self.img)
+        img = read_tiff(self.write_volume(compression="zlib"))
+        self.assertNotIsInstance(img, np.memmap)
+        np.testing.assert_array_equal(img, self.img)
+
+
+class TestChunkCache(unittest.TestCase):
+    def test_lru(self):
+        cache = ChunkCache(250)
+        for i in range(3):
+            cache.put(i, np.zeros(100, np.uint8))
+        self.assertIsNone(cache.get(0))
+        self.assertIsNotNone(cache.get(1))
+        cache.put(3, np.zeros(100, np.uint8))
+        self.assertIsNone(cache.get(2))
+        self.assertIsNotNone(cache.get(1))
+        self.assertEqual(cache.nbytes, 200)
+
+
+if __name__ == '__main__':
+    unittest.main()
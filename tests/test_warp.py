@@ -1,6 +1,9 @@
 import unittest
+import unittest.mock
 import numpy as np
-from nuggt.utils.warp import Warper
+from scipy.interpolate import RegularGridInterpolator
+from nuggt.utils.warp import Warper, ThinPlateSpline, Approximator, \
+    WendlandSpline, IncrementalWarper, leave_one_out_errors
 
 
 class TestWarp(unittest.TestCase):
@@ -83,5 +86,511 @@ class TestWarp(unittest.TestCase):
             self.assertLessEqual(min_k, kout)
             self.assertGreaterEqual(max_k, kout)
 
+
+class TestThinPlateSpline(unittest.TestCase):
+    def test_interpolates_nodes(self):
+        r = np.random.RandomState(1234)
+        src = r.uniform(0, 100, (50, 3))
+        dest = r.uniform(0, 100, (50, 3))
+        tps = ThinPlateSpline(src, dest)
+        np.testing.assert_almost_equal(tps(src), dest, 6)
+
+    def test_affine(self):
+        r = np.random.RandomState(1234)
+        src = r.uniform(0, 100, (20, 3))
+        matrix = np.array([[1.5, .2, 0], [0, .8, .1], [.3, 0, 2]])
+        dest = np.dot(src, matrix) + np.array([5, -3, 10])
+        tps = ThinPlateSpline(src, dest)
+        np.testing.assert_almost_equal(tps.weights, 0, 6)
+        test = r.uniform(-50, 150, (10, 3))
+        np.testing.assert_almost_equal(
+            tps(test), np.dot(test, matrix) + np.array([5, -3, 10]), 6)
+
+    def test_smooth(self):
+        r = np.random.RandomState(1234)
+        src = r.uniform(0, 100, (30, 3))
+        dest = src + r.normal(0, 5, (30, 3))
+        warper = Warper(src, dest, smooth=100)
+        self.assertGreater(np.max(np.abs(warper(src) - dest)), .1)
+
+    def test_smooth_sign(self):
+        # Smoothing makes both splines flatter, not more wiggly
+        r = np.random.RandomState(1234)
+        src = r.uniform(0, 100, (200, 3))
+        dest = src + r.normal(0, 3, (200, 3))
+        test = r.uniform(10, 90, (1000, 3))
+        for function, epsilon in (("thin_plate", None), ("wendland", 40)):
+            roughness = [np.std(Warper(src, dest, function=function,
+                                       epsilon=epsilon, smooth=smooth)(test)
+                                - test) for smooth in (0, 100)]
+            self.assertLess(roughness[1], roughness[0] * .9)
+
+    def test_chunked(self):
+        r = np.random.RandomState(1234)
+        src = r.uniform(0, 100, (30, 3))
+        dest = src + r.normal(0, 5, (30, 3))
+        warper = Warper(src, dest)
+        test = r.uniform(0, 100, (1000, 3))
+        expected = warper.engine(test)
+        np.testing.assert_almost_equal(
+            warper.transform(test, chunk_size=7), expected)
+        out = np.zeros((1000, 3))
+        result = warper.transform(test, max_bytes=10000, out=out)
+        self.assertIs(result, out)
+        np.testing.assert_almost_equal(out, expected)
+
+    def test_other_function(self):
+        r = np.random.RandomState(1234)
+        src = r.uniform(0, 100, (30, 3))
+        dest = src + r.normal(0, 5, (30, 3))
+        warper = Warper(src, dest, function="multiquadric")
+        np.testing.assert_almost_equal(warper(src), dest, 4)
+
+
+class TestFarField(unittest.TestCase):
+    def make_warper(self):
+        r = np.random.RandomState(1234)
+        g = np.linspace(0, 100, 12)
+        src = np.column_stack([_.flatten() for _ in
+                               np.meshgrid(g, g, g, indexing="ij")])
+        dest = src * 1.1 + 5 * np.sin(src[:, [1, 2, 0]] / 30)
+        coords = r.uniform(0, 100, (50000, 3))
+        return Warper(src, dest), coords
+
+    def test_tolerance(self):
+        warper, coords = self.make_warper()
+        expected = warper(coords)
+        for tolerance in (.1, .001):
+            result, error = warper.transform(
+                coords, tolerance=tolerance, return_error=True)
+            self.assertTrue(np.any(error > 0))
+            self.assertTrue(np.all(error <= tolerance))
+            actual = np.max(np.abs(result - expected), 1)
+            self.assertTrue(np.all(actual <= error + 1e-8))
+
+    def test_exact(self):
+        warper, coords = self.make_warper()
+        result, error = warper.transform(coords[:100], return_error=True)
+        np.testing.assert_array_equal(error, 0)
+        np.testing.assert_almost_equal(result, warper(coords[:100]))
+
+    def test_other_function(self):
+        r = np.random.RandomState(1234)
+        src = r.uniform(0, 100, (30, 3))
+        warper = Warper(src, src, function="multiquadric")
+        with self.assertRaises(ValueError):
+            warper.transform(src, tolerance=1)
+
+
+class TestWendlandSpline(unittest.TestCase):
+    def test_interpolates_nodes(self):
+        r = np.random.RandomState(1234)
+        src = r.uniform(0, 100, (500, 3))
+        dest = src + r.normal(0, 5, (500, 3))
+        warper = Warper(src, dest, function="wendland")
+        self.assertIsInstance(warper.engine, WendlandSpline)
+        np.testing.assert_almost_equal(warper(src), dest, 6)
+
+    def test_old_scipy(self):
+        from scipy.sparse.linalg import cg
+
+        def old_cg(A, b, tol=1e-5):
+            return cg(A, b, rtol=tol)
+
+        r = np.random.RandomState(1234)
+        src = r.uniform(0, 100, (100, 3))
+        dest = src + r.normal(0, 5, (100, 3))
+        with unittest.mock.patch("nuggt.utils.warp.cg", old_cg):
+            wendland = WendlandSpline(src, dest, radius=20)
+        np.testing.assert_almost_equal(wendland(src), dest, 6)
+
+    def test_affine(self):
+        r = np.random.RandomState(1234)
+        src = r.uniform(0, 100, (100, 3))
+        matrix = np.array([[1.5, .2, 0], [0, .8, .1], [.3, 0, 2]])
+        dest = np.dot(src, matrix) + np.array([5, -3, 10])
+        wendland = WendlandSpline(src, dest, radius=20)
+        np.testing.assert_almost_equal(wendland.weights, 0, 6)
+        test = r.uniform(-50, 150, (10, 3))
+        np.testing.assert_almost_equal(
+            wendland(test), np.dot(test, matrix) + np.array([5, -3, 10]), 6)
+
+    def test_compact_support(self):
+        r = np.random.RandomState(1234)
+        src = r.uniform(0, 100, (100, 3))
+        dest = src + r.normal(0, 5, (100, 3))
+        wendland = WendlandSpline(src, dest, radius=10)
+        test = np.vstack([r.uniform(0, 100, (1000, 3)),
+                          r.uniform(110, 200, (10, 3))])
+        distance, _ = wendland.tree.query(test)
+        far = distance >= 10
+        self.assertTrue(np.any(far) and not np.all(far))
+        affine = wendland.affine[0] + np.dot(test, wendland.affine[1:])
+        result = wendland(test)
+        np.testing.assert_almost_equal(result[far], affine[far])
+        self.assertGreater(np.max(np.abs(result - affine)[~ far]), .01)
+
+    def test_chunked(self):
+        r = np.random.RandomState(1234)
+        src = r.uniform(0, 100, (200, 3))
+        dest = src + r.normal(0, 5, (200, 3))
+        warper = Warper(src, dest, function="wendland", epsilon=30)
+        self.assertEqual(warper.engine.radius, 30)
+        test = r.uniform(0, 100, (1000, 3))
+        np.testing.assert_almost_equal(
+            warper.transform(test, chunk_size=7), warper.engine(test))
+
+
+class TestApproximator(unittest.TestCase):
+    def make_grid(self):
+        r = np.random.RandomState(1234)
+        axes = [np.array([0, 2, 3, 7, 10.]),
+                np.array([-5, 0, 5, 10.]),
+                np.array([1, 4, 6.])]
+        values = r.uniform(0, 10, (5, 4, 3, 3))
+        return r, axes, values
+
+    def test_linear(self):
+        r, axes, values = self.make_grid()
+        approximator = Approximator(axes, values)
+        coords = np.column_stack([
+            r.uniform(a[0], a[-1], 100) for a in axes])
+        result = approximator(coords)
+        for idx in range(3):
+            expected = RegularGridInterpolator(axes, values[..., idx])(coords)
+            np.testing.assert_almost_equal(result[:, idx], expected)
+
+    def test_outside(self):
+        r, axes, values = self.make_grid()
+        approximator = Approximator(axes, values, order=3)
+        result = approximator([[-1, 0, 2], [0, 0, 2], [10, 10, 6],
+                               [5, 5, 6.5]])
+        self.assertTrue(np.all(np.isnan(result[0])))
+        self.assertFalse(np.any(np.isnan(result[1:3])))
+        self.assertTrue(np.all(np.isnan(result[3])))
+
+    def test_cubic(self):
+        r = np.random.RandomState(1234)
+        values = r.uniform(0, 10, (6, 5, 4, 2))
+        axes = [np.arange(6) * 2., np.arange(5) * 3., np.arange(4) + 1.]
+        approximator = Approximator(axes, values, order=3)
+        coords = np.column_stack([
+            r.uniform(a[0], a[-1], 100) for a in axes])
+        result = approximator(coords)
+        self.assertFalse(np.any(np.isnan(result)))
+        # The spline goes through the nodes
+        for node in ((2, 2, 2), (0, 0, 0), (5, 4, 3), (1, 3, 0)):
+            coords = [[a[n] for a, n in zip(axes, node)]]
+            np.testing.assert_almost_equal(
+                approximator(coords)[0], values[node])
+
+    def test_cubic_linear(self):
+        # A linear function is reproduced exactly, even near the edges
+        axes = [np.arange(6) * 2., np.arange(5) * 3., np.arange(3) + 1.]
+        grid = np.stack(np.meshgrid(*axes, indexing="ij"), -1)
+        matrix = np.array([[1.5, .2, 0], [0, .8, .1], [.3, 0, 2]])
+        approximator = Approximator(axes, np.dot(grid, matrix), order=3)
+        coords = np.column_stack([
+            np.random.RandomState(1234).uniform(a[0], a[-1], 100)
+            for a in axes])
+        np.testing.assert_almost_equal(
+            approximator(coords), np.dot(coords, matrix))
+
+    def test_cubic_is_more_accurate(self):
+        i, j, k = np.mgrid[0:100:10, 0:100:10, 0:100:10]
+        src = np.column_stack([i.flatten(), j.flatten(), k.flatten()])
+        dest = src + 10 * np.sin(src / 30)
+        warper = Warper(src, dest)
+        axes = [np.linspace(0, 90, 6)] * 3
+        coords = np.random.RandomState(1234).uniform(0, 90, (100, 3))
+        expected = warper(coords)
+        linear = warper.approximate(*axes)(coords)
+        cubic = warper.approximate(*axes, order=3)(coords)
+        self.assertLess(np.max(np.abs(cubic - expected)),
+                        np.max(np.abs(linear - expected)))
+
+
+    def test_warp_plane(self):
+        r, axes, values = self.make_grid()
+        for order in (1, 3):
+            approximator = Approximator(axes, values, order=order)
+            for z, stride in ((2.5, 1), (7, 2), (11, 1)):
+                result = approximator.warp_plane(z, (12, 8), stride)
+                self.assertEqual(result.shape, (3, (12 + stride - 1) // stride,
+                                                (8 + stride - 1) // stride))
+                y, x = np.mgrid[0:12:stride, 0:8:stride]
+                expected = approximator(np.column_stack(
+                    [np.ones(y.size) * z, y.flatten(), x.flatten()]))
+                np.testing.assert_almost_equal(
+                    result.reshape(3, -1).transpose(), expected)
+
+
+    def test_float32(self):
+        r, axes, values = self.make_grid()
+        coords = np.column_stack([
+            r.uniform(a[0], a[-1], 100) for a in axes])
+        for order in (1, 3):
+            expected = Approximator(axes, values, order=order)(coords)
+            approximator = Approximator(axes, values, order=order,
+                                        dtype=np.float32)
+            self.assertEqual(approximator.coefficients.dtype, np.float32)
+            result = approximator(coords)
+            self.assertEqual(result.dtype, np.float32)
+            np.testing.assert_allclose(result, expected, atol=1e-4)
+            plane = approximator.warp_plane(5, (10, 8))
+            self.assertEqual(plane.dtype, np.float32)
+
+    def test_integer_output(self):
+        r, axes, values = self.make_grid()
+        approximator = Approximator(axes, values)
+        coords = np.array([[0, 0, 1], [2.5, 3, 4.5], [-1, 0, 2]])
+        expected = np.round(approximator(coords)).astype(np.int32)
+        expected[2] = -1
+        result = approximator(coords, out=np.zeros((3, 3), np.int32))
+        np.testing.assert_array_equal(result, expected)
+        out = np.zeros((3, 12, 8), np.int32)
+        result = approximator.warp_plane(2.5, (12, 8), out=out)
+        self.assertIs(result, out)
+        expected = approximator.warp_plane(2.5, (12, 8))
+        expected[np.isnan(expected)] = -1
+        np.testing.assert_array_equal(out, np.round(expected))
+
+    def test_warp_plane_start(self):
+        r, axes, values = self.make_grid()
+        approximator = Approximator(axes, values, order=3)
+        result = approximator.warp_plane(4.5, (12, 8), start=(3, 2))
+        np.testing.assert_almost_equal(
+            result, approximator.warp_plane(4.5, (12, 8))[:, 3:, 2:])
+
+    def test_changed_region(self):
+        axes = [np.linspace(0, 100, 11)] * 3
+        grid = np.stack(np.meshgrid(*axes, indexing="ij"), -1)
+        bumped = grid.copy()
+        bumped[5, 4, 6] += 2
+        bumped[5, 4, 7] += .1
+        shape = (101, 101)
+        for order in (1, 3):
+            old = Approximator(axes, grid, order=order)
+            new = Approximator(axes, bumped, order=order)
+            changed = new.changed_coefficients(old, .5)
+            self.assertTrue(np.any(changed))
+            self.assertEqual(changed.shape, new.coefficient_shape)
+            np.testing.assert_array_equal(
+                changed, new.changed_coefficients(old.coefficients, .5))
+            n_changed = 0
+            for z in range(0, 101, 5):
+                region = new.changed_region(changed, z, shape)
+                expected = new.warp_plane(z, shape)
+                actual = old.warp_plane(z, shape)
+                if region is not None:
+                    n_changed += 1
+                    (y0, x0), (y1, x1) = region
+                    actual[:, y0:y1, x0:x1] = new.warp_plane(
+                        z, (y1, x1), start=(y0, x0))
+                    self.assertLess((y1 - y0) * (x1 - x0), shape[0] * shape[1])
+                self.assertLessEqual(np.max(np.abs(actual - expected)), .5)
+            self.assertGreater(n_changed, 0)
+            self.assertLess(n_changed, 21)
+
+
+class TestAdaptiveApproximation(unittest.TestCase):
+    def make_warper(self):
+        r = np.random.RandomState(1234)
+        src = r.uniform(0, 200, (200, 3))
+        bump = 20 * np.exp(-np.sum(np.square(src - 50), 1) / 800)
+        return r, Warper(src, src + bump[:, np.newaxis])
+
+    def test_linear(self):
+        r, warper = self.make_warper()
+        axes = [np.linspace(0, 200, 3)] * 3
+        approximator = warper.approximate(*axes, tolerance=.5)
+        self.assertLessEqual(approximator.max_error, .5)
+        coords = r.uniform(0, 200, (1000, 3))
+        error = np.max(np.abs(approximator(coords) - warper(coords)))
+        self.assertLess(error, 1)
+        # The refinement should be concentrated near the bump
+        for axis in approximator.axes:
+            self.assertGreater(np.sum(axis < 100), np.sum(axis > 100))
+
+    def test_cubic(self):
+        r, warper = self.make_warper()
+        axes = [np.linspace(0, 200, 3)] * 3
+        approximator = warper.approximate(*axes, tolerance=.5, order=3)
+        self.assertLessEqual(approximator.max_error, .5)
+        for axis in approximator.axes:
+            np.testing.assert_almost_equal(np.diff(axis, 2), 0)
+
+    def test_max_iterations(self):
+        r, warper = self.make_warper()
+        axes = [np.linspace(0, 200, 3)] * 3
+        approximator = warper.approximate(*axes, tolerance=.001,
+                                          max_iterations=1)
+        self.assertTrue(all([len(axis) <= 5 for axis in approximator.axes]))
+        self.assertGreater(approximator.max_error, .001)
+
+    def test_max_error_of_unrefined_cells(self):
+        r, warper = self.make_warper()
+        axes = [np.linspace(0, 200, 3)] * 3
+        for kwds in (dict(min_spacing=30),
+                     dict(min_spacing=30, max_iterations=2)):
+            approximator = warper.approximate(*axes, tolerance=.5, **kwds)
+            cells = np.meshgrid(*[(axis[:-1] + axis[1:]) / 2
+                                  for axis in approximator.axes],
+                                indexing="ij")
+            centers = np.column_stack([_.flatten() for _ in cells])
+            error = np.max(np.abs(approximator(centers) - warper(centers)))
+            self.assertGreater(error, .5)
+            self.assertGreaterEqual(approximator.max_error, error - 1e-6)
+
+
+class TestInverse(unittest.TestCase):
+    def make_warper(self):
+        r = np.random.RandomState(1234)
+        src = r.uniform(0, 100, (50, 3))
+        dest = src * 1.2 + 5 * np.sin(src / 20) + 10
+        return r, Warper(src, dest)
+
+    def test_jacobian(self):
+        r, warper = self.make_warper()
+        for order in (1, 3):
+            approximator = warper.approximate(
+                *[np.linspace(0, 100, 11)] * 3, order=order)
+            coords = r.uniform(1, 99, (20, 3))
+            values, jacobian = approximator.jacobian(coords)
+            np.testing.assert_almost_equal(values, approximator(coords))
+            for d in range(3):
+                delta = np.zeros(3)
+                delta[d] = 1e-5
+                fd = (approximator(coords + delta) -
+                      approximator(coords - delta)) / 2e-5
+                np.testing.assert_almost_equal(jacobian[:, :, d], fd, 4)
+
+    def test_inverse(self):
+        r, warper = self.make_warper()
+        for order in (1, 3):
+            forward = warper.approximate(*[np.linspace(0, 100, 21)] * 3,
+                                         order=order)
+            inverse = forward.inverse(*[np.linspace(20, 120, 21)] * 3)
+            self.assertTrue(np.all(inverse.converged[5:-5, 5:-5, 5:-5]))
+            coords = r.uniform(30, 70, (100, 3))
+            np.testing.assert_allclose(
+                forward(inverse(coords)), coords, atol=.1)
+
+    def test_not_converged(self):
+        r, warper = self.make_warper()
+        inverse = warper.inverse(*[np.linspace(-100, 200, 4)] * 3,
+                                 src_axes=[np.linspace(0, 100, 11)] * 3)
+        self.assertFalse(inverse.converged[0, 0, 0])
+        self.assertTrue(np.all(np.isnan(inverse.values[0, 0, 0])))
+
+    def test_not_converged_cubic(self):
+        r, warper = self.make_warper()
+        inverse = warper.inverse(*[np.linspace(-100, 200, 16)] * 3,
+                                 src_axes=[np.linspace(0, 100, 11)] * 3,
+                                 order=3)
+        self.assertFalse(np.all(inverse.converged))
+        self.assertTrue(np.all(np.isnan(inverse.values[~ inverse.converged])))
+        self.assertTrue(np.all(np.isfinite(inverse.coefficients)))
+        coords = warper(r.uniform(40, 60, (100, 3)))
+        result = inverse(coords)
+        self.assertTrue(np.all(np.isfinite(result)))
+        np.testing.assert_allclose(warper(result), coords, atol=1)
+
+    def test_warper_inverse(self):
+        r, warper = self.make_warper()
+        inverse = warper.inverse(*[np.linspace(40, 100, 11)] * 3)
+        coords = r.uniform(40, 100, (100, 3))
+        np.testing.assert_allclose(
+            warper(inverse(coords)), coords, atol=1)
+
+
+class TestLeaveOneOut(unittest.TestCase):
+    def test_matches_refits(self):
+        r = np.random.RandomState(1234)
+        src = r.uniform(0, 100, (30, 3))
+        dest = src * 1.1 + r.normal(0, .5, (30, 3))
+        dest[7] += 20
+        for smooth in (0, 10):
+            errors = leave_one_out_errors(src, dest, smooth)
+            self.assertEqual(errors.shape, (30, 3))
+            for k in (0, 7, 29):
+                others = np.delete(np.arange(30), k)
+                warper = Warper(src[others], dest[others], smooth=smooth)
+                np.testing.assert_allclose(
+                    errors[k], dest[k] - warper(src[k:k+1])[0], atol=1e-5)
+            distances = np.sqrt(np.sum(np.square(errors), 1))
+            self.assertGreater(distances[7], 10 * np.median(distances))
+
+    def test_incremental(self):
+        r = np.random.RandomState(1234)
+        src = r.uniform(0, 100, (30, 3))
+        dest = src + r.normal(0, 5, (30, 3))
+        warper = IncrementalWarper(src[:20], dest[:20])
+        for i in range(20, 30):
+            warper.insert(i, src[i], dest[i])
+        np.testing.assert_allclose(warper.leave_one_out_errors(),
+                                   leave_one_out_errors(src, dest),
+                                   atol=1e-6)
+
+    def test_too_few(self):
+        r = np.random.RandomState(1234)
+        src = r.uniform(0, 100, (4, 3))
+        errors = leave_one_out_errors(src, src + 1)
+        self.assertTrue(np.all(np.isinf(errors)))
+
+
+class TestIncrementalWarper(unittest.TestCase):
+    def setUp(self):
+        r = np.random.RandomState(1234)
+        self.src = r.uniform(0, 100, (40, 3))
+        self.dest = self.src + r.normal(0, 5, (40, 3))
+        self.test = r.uniform(0, 100, (100, 3))
+
+    def assert_matches(self, warper):
+        expected = Warper(warper.src_coords, warper.dest_coords)(self.test)
+        np.testing.assert_allclose(warper(self.test), expected, atol=1e-5)
+
+    def test_insert(self):
+        warper = IncrementalWarper(np.zeros((0, 3)), np.zeros((0, 3)))
+        for i in range(len(self.src)):
+            self.assertEqual(warper.fitted, i >= 4)
+            warper.insert(i // 2, self.src[i], self.dest[i])
+        self.assertGreater(warper.n_updates, 0)
+        self.assert_matches(warper)
+
+    def test_insert_smooth(self):
+        warper = IncrementalWarper(self.src[:10], self.dest[:10], smooth=10)
+        for i in range(10, len(self.src)):
+            warper.insert(i, self.src[i], self.dest[i])
+        self.assertGreater(warper.n_updates, 0)
+        expected = Warper(self.src, self.dest, smooth=10)(self.test)
+        np.testing.assert_allclose(warper(self.test), expected, atol=1e-5)
+
+    def test_remove(self):
+        warper = IncrementalWarper(self.src, self.dest)
+        for idx in (5, 0, 30):
+            src_coord, dest_coord = warper.remove(idx)
+            self.assert_matches(warper)
+        np.testing.assert_array_equal(src_coord, self.src[32])
+        np.testing.assert_array_equal(dest_coord, self.dest[32])
+        self.assertEqual(len(warper), 37)
+
+    def test_move(self):
+        warper = IncrementalWarper(self.src, self.dest)
+        warper.move(10, self.src[10] + 3, self.dest[10] - 2)
+        np.testing.assert_array_equal(warper.src_coords[10], self.src[10] + 3)
+        self.assert_matches(warper)
+
+    def test_singular(self):
+        warper = IncrementalWarper(self.src[:10], self.dest[:10])
+        warper.insert(3, self.src[0], self.dest[0])
+        self.assertFalse(warper.fitted)
+        with self.assertRaises(np.linalg.LinAlgError):
+            warper(self.test)
+        warper.remove(0)
+        self.assertTrue(warper.fitted)
+        self.assert_matches(warper)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,101 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import numpy as np
+
+from nuggt.utils.warp import Warper
+from nuggt.utils.warp_cache import WarpCache
+
+
+class TestWarpCache(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        r = np.random.RandomState(1234)
+        self.src = r.uniform(0, 100, (30, 3))
+        self.dest = self.src + r.normal(0, 5, (30, 3))
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def test_warper(self):
+        cache = WarpCache(self.cache_dir)
+        warper = cache.warper(self.src, self.dest)
+        self.assertEqual(len(os.listdir(self.cache_dir)), 1)
+        cached = cache.warper(self.src, self.dest)
+        self.assertEqual(len(os.listdir(self.cache_dir)), 1)
+        test = np.random.RandomState(5678).uniform(0, 100, (10, 3))
+        np.testing.assert_almost_equal(cached(test), warper(test))
+        np.testing.assert_almost_equal(
+            cached(test), Warper(self.src, self.dest)(test))
+
+    def test_different_alignment(self):
+        cache = WarpCache(self.cache_dir)
+        cache.warper(self.src, self.dest)
+        cache.warper(self.src, self.dest + 1)
+        self.assertEqual(len(os.listdir(self.cache_dir)), 2)
+        cache.warper(self.src, self.dest, smooth=1)
+        self.assertEqual(len(os.listdir(self.cache_dir)), 3)
+
+    def test_approximate(self):
+        cache = WarpCache(self.cache_dir)
+        axes = [np.linspace(0, 100, 5)] * 3
+        approximator = cache.approximate(self.src, self.dest, axes, order=3)
+        cached = cache.approximate(self.src, self.dest, axes, order=3)
+        self.assertEqual(cached.order, 3)
+        test = np.random.RandomState(5678).uniform(0, 100, (10, 3))
+        np.testing.assert_almost_equal(cached(test), approximator(test))
+        linear = cache.approximate(self.src, self.dest, axes)
+        self.assertEqual(linear.order, 1)
+        self.assertFalse(hasattr(cache.approximate(self.src, self.dest, axes),
+                                 "max_error"))
+
+    def test_max_error(self):
+        cache = WarpCache(self.cache_dir)
+        axes = [np.linspace(0, 100, 3)] * 3
+        approximator = cache.approximate(self.src, self.dest, axes,
+                                         tolerance=.5)
+        cached = cache.approximate(self.src, self.dest, axes, tolerance=.5)
+        self.assertEqual(cached.max_error, approximator.max_error)
+        for axis, cached_axis in zip(approximator.axes, cached.axes):
+            np.testing.assert_array_equal(cached_axis, axis)
+
+    def test_corrupt(self):
+        cache = WarpCache(self.cache_dir)
+        warper = cache.warper(self.src, self.dest)
+        path = cache.path(cache.key("warper", self.src, self.dest))
+        with open(path, "rb") as fd:
+            data = fd.read()
+        with open(path, "wb") as fd:
+            fd.write(data[:len(data) // 2])
+        self.assertIsNone(cache.load(
+            cache.key("warper", self.src, self.dest)))
+        self.assertFalse(os.path.exists(path))
+        cached = cache.warper(self.src, self.dest)
+        self.assertTrue(os.path.exists(path))
+        test = np.random.RandomState(5678).uniform(0, 100, (10, 3))
+        np.testing.assert_almost_equal(cached(test), warper(test))
+
+    def test_prune(self):
+        cache = WarpCache(self.cache_dir)
+        cache.warper(self.src, self.dest)
+        cache.warper(self.src, self.dest + 1)
+        size = os.stat(cache.path(cache.key(
+            "warper", self.src, self.dest))).st_size
+        old = time.time() - 100
+        os.utime(cache.path(cache.key("warper", self.src, self.dest + 1)),
+                 (old, old))
+        # Touch the first entry by using it
+        cache.warper(self.src, self.dest)
+        cache.max_bytes = int(size * 2.5)
+        cache.warper(self.src, self.dest + 2)
+        self.assertTrue(os.path.exists(cache.path(cache.key(
+            "warper", self.src, self.dest))))
+        self.assertFalse(os.path.exists(cache.path(cache.key(
+            "warper", self.src, self.dest + 1))))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,107 @@
+import unittest
+
+import numpy as np
+from scipy.ndimage import map_coordinates
+
+from nuggt.utils.warp import Approximator
+from nuggt.utils.warp_pool import SharedArray, WarpPool, WORKER_STATE, \
+    initialize_worker, warp_region
+
+
+class TestWarpPool(unittest.TestCase):
+    def setUp(self):
+        r = np.random.RandomState(1234)
+        self.moving = r.uniform(0, 1000, (12, 20, 16)).astype(np.float32)
+        self.shape = (10, 18, 14)
+        axes = [np.linspace(0, s, 4) for s in self.shape]
+        grid = np.stack(np.meshgrid(*axes, indexing="ij"), -1)
+        self.approximator = Approximator(
+            axes, grid * .9 + r.uniform(0, 1, grid.shape))
+
+    def expected(self, approximator):
+        z, y, x = np.mgrid[0:self.shape[0], 0:self.shape[1], 0:self.shape[2]]
+        coords = approximator(np.column_stack(
+            [z.flatten(), y.flatten(), x.flatten()]))
+        return map_coordinates(self.moving, coords.transpose(),
+                               output=np.float32).reshape(self.shape)
+
+    def check(self, start_method):
+        pool = WarpPool(self.moving, self.shape, np.float32, n_workers=2,
+                        start_method=start_method)
+        try:
+            regions = [(z, ((0, 0), self.shape[1:]))
+                       for z in range(self.shape[0])]
+            self.assertEqual(sorted(pool.warp(self.approximator, regions)),
+                             list(range(self.shape[0])))
+            np.testing.assert_allclose(pool.alignment_image,
+                                       self.expected(self.approximator),
+                                       rtol=1e-4, atol=1e-2)
+            #
+            # A new grid, warped into part of one plane
+            #
+            values = self.approximator.values + 1
+            other = Approximator(self.approximator.axes, values)
+            before = pool.alignment_image.copy()
+            list(pool.warp(other, [(4, ((3, 2), (9, 7)))]))
+            expected = before
+            expected[4, 3:9, 2:7] = self.expected(other)[4, 3:9, 2:7]
+            np.testing.assert_allclose(pool.alignment_image, expected,
+                                       rtol=1e-4, atol=1e-2)
+            self.assertEqual(pool.version, 2)
+        finally:
+            pool.close()
+
+    def test_fork(self):
+        self.check("fork")
+
+    def test_cancel(self):
+        pool = WarpPool(self.moving, self.shape, np.float32, n_workers=2,
+                        start_method="fork")
+        try:
+            regions = [(z, ((0, 0), self.shape[1:]))
+                       for z in range(self.shape[0])]
+            pool.warp(self.approximator, regions)
+            pool.cancel()
+            list(pool.warp(self.approximator, regions))
+            np.testing.assert_allclose(pool.alignment_image,
+                                       self.expected(self.approximator),
+                                       rtol=1e-4, atol=1e-2)
+        finally:
+            pool.close()
+
+    def test_stale_region(self):
+        pool = WarpPool(self.moving, self.shape, np.float32, n_workers=1,
+                        start_method="fork")
+        try:
+            token = pool.set_grid(self.approximator)
+            initialize_worker(pool.moving, pool.alignment, pool.order,
+                              pool.current_warp)
+            pool.current_warp.value = 5
+            warp_region(token, 4, 2, (0, 0), self.shape[1:])
+            self.assertTrue(np.all(pool.alignment_image == 0))
+            warp_region(token, 5, 2, (0, 0), self.shape[1:])
+            np.testing.assert_allclose(pool.alignment_image[2],
+                                       self.expected(self.approximator)[2],
+                                       rtol=1e-4, atol=1e-2)
+        finally:
+            WORKER_STATE.clear()
+            pool.close()
+
+    def test_spawn(self):
+        self.check("spawn")
+
+
+class TestSharedArray(unittest.TestCase):
+    def test_attach(self):
+        a = SharedArray.copy_of(np.arange(12).reshape(3, 4))
+        try:
+            b = SharedArray(a.shape, a.dtype, a.name)
+            b.array[1, 2] = 100
+            self.assertEqual(a.array[1, 2], 100)
+            b.close()
+        finally:
+            a.close()
+
+
+if __name__ == '__main__':
+    unittest.main()